@@ -1,10 +1,10 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from django.db.models import Count, Avg, Min, Max
+from django.db.models import Count, Min, Max, Q, Sum
 
 from .models import (Apartment, ApartmentSensor, ApartmentSensorValue, Sensor,
                      SensorAttribute, Service, Subscription, User, ApartmentSensorAttribute, CustomReportService,
-                     CustomReportSubscription)
+                     CustomReportSubscription, Delivery, ApartmentSensorRollup, DeadLetter)
 
 
 class MyUserAdmin(UserAdmin):
@@ -27,29 +27,46 @@ class ApartmentSensorAdmin(admin.ModelAdmin):
 
 
 class ApartmentSensorAttributeAdmin(admin.ModelAdmin):
-    list_display = ['apartment_sensor', 'attribute', 'values', 'min', 'avg', 'max']
+    list_display = ['apartment_sensor', 'attribute', 'latest_value', 'updated_at', 'values', 'min', 'avg', 'max']
+    list_select_related = ['apartment_sensor', 'attribute', 'latest']
     list_filter = ['attribute']
     search_fields = ['apartment_sensor__identifier']
 
     def get_queryset(self, request):
+        # Aggregated from the daily rollups rather than from every stored value
+        daily = Q(rollups__resolution=ApartmentSensorRollup.DAY)
         return super().get_queryset(request).annotate(
-            values_count=Count('values'),
-            min=Min('values__value'),
-            avg=Avg('values__value'),
-            max=Max('values__value')
+            values_count=Sum('rollups__count', filter=daily),
+            values_sum=Sum('rollups__sum', filter=daily),
+            min=Min('rollups__min', filter=daily),
+            max=Max('rollups__max', filter=daily)
         )
 
+    def latest_value(self, attr):
+        latest = attr.latest_value()
+        return latest and latest.value
+
+    def updated_at(self, attr):
+        latest = attr.latest_value()
+        return latest and latest.updated_at
+
     def values(self, attr):
-        return attr.values_count
+        return attr.values_count or 0
 
     def min(self, attr):
-        return '%s' % float('%.4g' % attr.min)
+        return self._format(attr.min)
 
     def avg(self, attr):
-        return '%s' % float('%.4g' % attr.avg)
+        return self._format(attr.values_sum / attr.values_count if attr.values_count else None)
 
     def max(self, attr):
-        return '%s' % float('%.4g' % attr.max)
+        return self._format(attr.max)
+
+    @staticmethod
+    def _format(value):
+        if value is None:
+            return None
+        return '%s' % float('%.4g' % value)
 
 
 class SensorAttributeAdmin(admin.ModelAdmin):
@@ -71,6 +88,17 @@ class ApartmentSensorValueAdmin(admin.ModelAdmin):
     list_filter = ('apartment_sensor_attribute__attribute', )
     search_fields = ['apartment_sensor__identifier']
     date_hierarchy = 'updated_at'
+    ordering = ('-updated_at', )
+
+
+class DeliveryAdmin(admin.ModelAdmin):
+    list_display = ('id', 'subscription', 'created_at', 'attempts', 'next_attempt_at', 'last_error')
+    list_filter = ('subscription__service', )
+
+
+class DeadLetterAdmin(admin.ModelAdmin):
+    list_display = ('id', 'subscription', 'created_at', 'failed_at', 'attempts', 'last_error')
+    list_filter = ('subscription__service', )
 
 
 admin.site.register(Apartment, ApartmentAdmin)
@@ -80,6 +108,8 @@ admin.site.register(Sensor)
 admin.site.register(ApartmentSensorValue, ApartmentSensorValueAdmin)
 admin.site.register(Service)
 admin.site.register(Subscription)
+admin.site.register(Delivery, DeliveryAdmin)
+admin.site.register(DeadLetter, DeadLetterAdmin)
 admin.site.register(SensorAttribute, SensorAttributeAdmin)
 admin.site.register(User, MyUserAdmin)
 
@@ -100,12 +100,10 @@ class CreateSubscriptionSerializer(serializers.ModelSerializer):
         with transaction.atomic():
             subscription = super().create(dict(user=self.context['request'].user, **validated_data))
             subscription.create_in_service()
+            if self.include_history:
+                subscription.request_history()
         return subscription
 
-    def submit_history(self):
-        if self.include_history and self.instance:
-            self.instance.submit_history()
-
 
 class SubscriptionSerializer(serializers.HyperlinkedModelSerializer):
     service = ServiceSerializer()
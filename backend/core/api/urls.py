@@ -19,7 +19,10 @@ schema_view = get_schema_view(title='SenseHel API')
 urls = [
     url(r'schema/', schema_view),
     url(r'available-services', views.AvailableServicesList.as_view(), name='available-services'),
+    url(r'digita-gw-batch', views.digita_gw_batch, name='digita-gw-batch'),
     url(r'digita-gw', views.digita_gw, name='digita-gw'),
+    url(r'live/token/', views.live_token, name='live-token'),
+    url(r'live/', views.live_values, name='live-values'),
 ]
 
 urlpatterns = router.urls + urls
@@ -1,29 +1,119 @@
-import binascii
+import hashlib
+import json
 import logging
+import time
+from datetime import timedelta
 
 from django.conf import settings
+from django.db import connection
+from django.db.models import Prefetch
+from django.http import HttpResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from django.utils.http import parse_etags, quote_etag
 from requests import HTTPError
-from rest_framework import generics, status, viewsets, permissions
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework import fields, generics, status, viewsets, permissions
+from rest_framework.authentication import BaseAuthentication, TokenAuthentication
+from rest_framework.decorators import action, api_view, authentication_classes, permission_classes
+from rest_framework.exceptions import APIException, AuthenticationFailed, ValidationError
 from rest_framework.response import Response
 
 import core.models.apartment_sensor_models
 import core.models.sensor_models
 import core.models.service
-from core.utils.elsys import decode_elsys_payload
-
 from . import serializers
-from .. import models
+from .. import ingest, live, models
+from ..utils import metrics
 
 log = logging.getLogger(__name__)
 
 
-class ServiceViewSet(viewsets.ReadOnlyModelViewSet):
+class NotModified(APIException):
+    status_code = status.HTTP_304_NOT_MODIFIED
+
+    def __init__(self, etag):
+        super().__init__()
+        self.etag = etag
+
+
+class MetricsMixin:
+    """
+    Record the time spent in `initial` (authentication, permission and throttling checks, conditional GETs), in the
+    handler of the action and in `finalize_response`, on top of what MetricsMiddleware records for every request.
+    Should come first in the bases of a view, so that the other mixins are timed too.
+    """
+
+    def initial(self, request, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            super().initial(request, *args, **kwargs)
+        finally:
+            self.metrics_phases['initial'] = time.perf_counter() - start
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        start = time.perf_counter()
+        response = super().finalize_response(request, response, *args, **kwargs)
+        self.metrics_phases['finalize'] = time.perf_counter() - start
+        return response
+
+    def dispatch(self, request, *args, **kwargs):
+        self.metrics_phases = {}
+        start = time.perf_counter()
+        response = super().dispatch(request, *args, **kwargs)
+        phases = self.metrics_phases
+        phases['handler'] = time.perf_counter() - start - sum(phases.values())
+        metrics.observe_phases(metrics.view_name(request), request.method, phases)
+        return response
+
+
+class ConditionalGetMixin:
+    """
+    Answer GET requests with a strong ETag computed from the DataVersion counters of `get_version_keys`, and with
+    304 Not Modified when the client already has the current representation, before any data is queried or
+    serialized.
+    """
+
+    def get_version_keys(self):
+        raise NotImplementedError
+
+    def get_etag(self, request):
+        # Kept for views that key cached data on the same versions
+        self.versions = versions = models.DataVersion.get_many(self.get_version_keys())
+        # The same URL has a different representation for every user and renderer
+        state = [
+            request.get_full_path(), request.META.get('HTTP_ACCEPT', ''), request.user.pk, sorted(versions.items())]
+        return quote_etag(hashlib.sha1(json.dumps(state).encode()).hexdigest())
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self.etag = None
+        if request.method in ('GET', 'HEAD'):
+            self.etag = self.get_etag(request)
+            if self.etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+                raise NotModified(self.etag)
+
+    def handle_exception(self, exc):
+        if isinstance(exc, NotModified):
+            return Response(status=exc.status_code, headers={'ETag': exc.etag})
+        return super().handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if getattr(self, 'etag', None) and response.status_code == status.HTTP_200_OK:
+            response['ETag'] = self.etag
+        return response
+
+
+class ServiceViewSet(MetricsMixin, ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
     queryset = core.models.service.Service.objects.all()
     serializer_class = serializers.ServiceSerializer
 
+    def get_version_keys(self):
+        return [models.DataVersion.SERVICES]
+
 
-class ApartmentViewSet(viewsets.ReadOnlyModelViewSet):
+class ApartmentViewSet(MetricsMixin, ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
     """
     Serialize Apartments current authenticated user belongs to.
     """
@@ -31,18 +121,79 @@ class ApartmentViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = core.models.apartment_sensor_models.Apartment.objects.none()  # For inspection only; get_queryset is used live
 
     def get_queryset(self):
-        return self.request.user.apartments.all()
+        ApartmentSensor = core.models.apartment_sensor_models.ApartmentSensor  # noqa
+        return self.request.user.apartments.prefetch_related(
+            Prefetch('apartment_sensors', queryset=ApartmentSensor.objects.select_related('sensor')),
+            *ApartmentSensor.prefetch_attributes('apartment_sensors__attributes'))
+
+    def get_version_keys(self):
+        DataVersion = models.DataVersion  # noqa
+        return [DataVersion.STRUCTURE, DataVersion.VALUES.format(self.request.user.pk)]
 
 
-class ApartmentSensorViewSet(viewsets.ModelViewSet):
+class ApartmentSensorViewSet(MetricsMixin, viewsets.ModelViewSet):
     serializer_class = serializers.ApartmentSensorSerializer
     queryset = core.models.apartment_sensor_models.ApartmentSensor.objects.none()  # For inspection only; get_queryset is used live
 
     def get_queryset(self):
-        return core.models.apartment_sensor_models.ApartmentSensor.list_for_user(self.request.user)
+        ApartmentSensor = core.models.apartment_sensor_models.ApartmentSensor  # noqa
+        return ApartmentSensor.list_for_user(self.request.user).select_related('sensor').prefetch_related(
+            *ApartmentSensor.prefetch_attributes())
+
+    @action(detail=True, url_path=r'attributes/(?P<attribute_pk>[^/.]+)/history')
+    def history(self, request, pk=None, attribute_pk=None):
+        """
+        Values of one attribute of the sensor aggregated into hourly, daily, weekly or monthly buckets between the
+        `from` and `to` query parameters (defaulting to the past week). The requested `bucket` is made larger if
+        needed to return at most `settings.HISTORY_MAX_POINTS` buckets, and defaults to the smallest such bucket.
+        """
+        Rollup = models.ApartmentSensorRollup  # noqa
+        apsen_attr = get_object_or_404(self.get_object().attributes, pk=attribute_pk)
+
+        end = self._datetime_param('to') or timezone.now()
+        start = self._datetime_param('from') or end - timedelta(days=7)
+        if start >= end:
+            raise ValidationError({'from': 'Must be before to.'})
+        bucket = request.query_params.get('bucket') or Rollup.HOUR
+        if bucket not in Rollup.BUCKETS:
+            raise ValidationError({'bucket': f'Must be one of: {", ".join(Rollup.BUCKETS)}.'})
+        buckets = list(Rollup.BUCKETS)
+        bucket = max(bucket, Rollup.bucket_for(start, end, settings.HISTORY_MAX_POINTS), key=buckets.index)
+
+        rows = list(Rollup.history(apsen_attr.id, bucket, start, end)[:settings.HISTORY_MAX_POINTS])
+        header = {'attribute': apsen_attr.id, 'bucket': bucket, 'from': start.isoformat(), 'to': end.isoformat()}
+        return StreamingHttpResponse(_columnar_history(header, rows), content_type='application/json')
+
+    def _datetime_param(self, name):
+        value = self.request.query_params.get(name)
+        if not value:
+            return None
+        try:
+            return fields.DateTimeField().to_internal_value(value)
+        except ValidationError as err:
+            raise ValidationError({name: err.detail})
 
 
-class AvailableServicesList(generics.ListAPIView):
+def _columnar_history(header, rows):
+    """
+    Yield a history response as JSON, with bucket start times (as Unix timestamps) and aggregates in parallel
+    arrays, one array at a time.
+    """
+    yield json.dumps(header)[:-1] + ', "columns": {'
+    columns = [
+        ('t', lambda row: int(row[0].timestamp())),
+        ('count', lambda row: row[1]),
+        ('min', lambda row: float(row[2])),
+        ('max', lambda row: float(row[3])),
+        ('avg', lambda row: round(float(row[4]) / row[1], 2)),
+    ]
+    for index, (name, column) in enumerate(columns):
+        separator = ', ' if index else ''
+        yield f'{separator}"{name}": {json.dumps([column(row) for row in rows])}'
+    yield '}}'
+
+
+class AvailableServicesList(MetricsMixin, ConditionalGetMixin, generics.ListAPIView):
     """
     Serialize all services current authenticated user could
     subscribe to considering what sensors are available and what
@@ -52,7 +203,13 @@ class AvailableServicesList(generics.ListAPIView):
     serializer_class = serializers.ServiceSerializer
 
     def get_queryset(self):
-        return core.models.service.Service.list_available_for_user(self.request.user)
+        # The versions the ETag was computed from, so that the list and the ETag always match
+        versions = getattr(self, 'versions', None)
+        return core.models.service.Service.list_available_for_user(
+            self.request.user, versions).prefetch_related('requires')
+
+    def get_version_keys(self):
+        return [models.DataVersion.SERVICES, models.DataVersion.STRUCTURE]
 
 
 class SensorViewSet(viewsets.ModelViewSet):
@@ -65,18 +222,9 @@ class SensorAttributeViewSet(viewsets.ModelViewSet):
     serializer_class = serializers.SensorAttributeSerializer
 
 
-class AftereffectResponse(Response):
-    def __init__(self, *args, **kwargs):
-        self.aftereffect = kwargs.pop('aftereffect', None)
-        return super().__init__(*args, **kwargs)
-
-    def close(self):
-        super().close()
-        if self.aftereffect:
-            self.aftereffect()
-
-
 class SubscriptionViewSet(
+    MetricsMixin,
+    ConditionalGetMixin,
     viewsets.mixins.ListModelMixin,
     viewsets.mixins.CreateModelMixin,
     viewsets.mixins.DestroyModelMixin,
@@ -96,6 +244,10 @@ class SubscriptionViewSet(
     def get_queryset(self):
         return models.Subscription.objects.filter(user=self.request.user)
 
+    def get_version_keys(self):
+        # Subscriptions show their services
+        return [models.DataVersion.SUBSCRIPTIONS.format(self.request.user.pk), models.DataVersion.SERVICES]
+
     def get_serializer_class(self):
         return self.serializer_classes.get(self.action, self.serializer_class)
 
@@ -119,10 +271,9 @@ class SubscriptionViewSet(
         except HTTPError:
             return Response('Could not register subscription with service.', status=502)
 
+        # Requested history is submitted by the process_deliveries worker
         headers = self.get_success_headers(serializer.data)
-        return AftereffectResponse(
-            serializer.data, status=status.HTTP_201_CREATED, headers=headers,
-            aftereffect=lambda: serializer.submit_history())
+        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
 
 
 class CustomReportSubscriptionViewSet(viewsets.mixins.ListModelMixin, viewsets.GenericViewSet):
@@ -133,6 +284,79 @@ class CustomReportSubscriptionViewSet(viewsets.mixins.ListModelMixin, viewsets.G
         return models.CustomReportSubscription.objects.filter(user=self.request.user)
 
 
+class StreamTokenAuthentication(BaseAuthentication):
+    """
+    Authentication with a stream token from `live_token` in the `token` query parameter, for clients such as
+    EventSource that can not set headers. Stream tokens are only valid for opening streams, and only for
+    `settings.LIVE_TOKEN_MAX_AGE` seconds, so that the tokens ending up in access logs can not be reused.
+    """
+
+    def authenticate(self, request):
+        token = request.query_params.get('token')
+        if not token:
+            return None
+        user_id = live.check_stream_token(token)
+        if user_id is None:
+            raise AuthenticationFailed('Invalid or expired stream token.')
+        user = models.User.objects.filter(id=user_id, is_active=True).first()
+        if user is None:
+            raise AuthenticationFailed('Invalid or expired stream token.')
+        return user, None
+
+    def authenticate_header(self, request):
+        # Answer failed authentication with 401 rather than 403, so that clients fetch a new token
+        return 'Token'
+
+
+@api_view(['POST'])
+def live_token(request):
+    """
+    Issue a short-lived token for opening a live value stream of the current user.
+    """
+    return Response({'token': live.stream_token(request.user)})
+
+
+@api_view(['GET'])
+@authentication_classes([StreamTokenAuthentication, TokenAuthentication])
+def live_values(request):
+    """
+    Stream the new latest values of the current user's apartment sensor attributes as server-sent `values`
+    events, each with a list of attribute ids, values and update times. A `reload` event tells the client it has
+    missed values and should fetch its apartments again.
+
+    Answers 503 unless `settings.LIVE_STREAMS` is set, so that streams never tie up the sync workers serving the
+    rest of the API.
+    """
+    if not settings.LIVE_STREAMS:
+        return Response({'detail': 'Live values are not served here'}, status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        headers={'Retry-After': str(settings.LIVE_RETRY_AFTER)})
+    stream = live.broker.subscribe(request.user.pk)
+    response = StreamingHttpResponse(_live_events(stream), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def _live_events(stream):
+    # Release the database connection, which the stream does not need while open
+    connection.close()
+    try:
+        yield from stream.events()
+    finally:
+        live.broker.unsubscribe(stream)
+
+
+def prometheus_metrics(request):
+    """
+    Expose the request metrics of all worker processes in the Prometheus text format. Requires
+    `Authorization: Bearer <METRICS_TOKEN>` when `settings.METRICS_TOKEN` is set.
+    """
+    token = settings.METRICS_TOKEN
+    if token and not constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {token}'):
+        return HttpResponse(status=status.HTTP_401_UNAUTHORIZED)
+    return HttpResponse(metrics.exposition(), content_type=metrics.CONTENT_TYPE)
+
+
 @api_view(['POST'])
 @permission_classes([permissions.AllowAny])
 def digita_gw(request):
@@ -140,29 +364,37 @@ def digita_gw(request):
     Digita GW endpoint implementation
     """
     try:
-        identifier = request.data['DevEUI_uplink']['DevEUI']
-    except KeyError:
-        return Response({"message": "Message ignored"})
-
-    apsen = core.models.apartment_sensor_models.ApartmentSensor.objects.get_or_create(identifier=identifier)[0]
-    payload = binascii.unhexlify(request.data['DevEUI_uplink']['payload_hex'])
+        identifier, fport, payload = ingest.parse_uplink(request.data)
+    except ingest.UplinkError as err:
+        return Response({"message": str(err)})
 
     try:
-        decoded_payload = decode_elsys_payload(payload)
-    except IndexError as err:
-        return Response({"message": "Failed to decode payload: {}".format(err)})
-
-    mapping = settings.DIGITA_GW_PAYLOAD_TO_ATTRIBUTES  # type: dict
-
-    new_values = []
-    for key, value in decoded_payload.items():
-        uri = mapping.get(key, '')
-        if uri:
-            attr = core.models.sensor_models.SensorAttribute.objects.get_or_create(uri=uri, defaults={'description': key})[0]
-        else:
-            attr = core.models.sensor_models.SensorAttribute.objects.get_or_create(description=key)[0]
-        apsen_attr = apsen.attributes.get_or_create(attribute=attr)[0]
-        new_values.append(apsen_attr.values.create(value=value))
-    models.Subscription.handle_new_values(new_values)
+        decoded_payload = ingest.decode_payload(identifier, fport, payload)
+    except ingest.UplinkError as err:
+        ingest.process_readings([(identifier, {})])
+        return Response({"message": str(err)})
+
+    ingest.process_readings([(identifier, decoded_payload)])
     return Response({"message": "Updated successfully"})
 
+
+@api_view(['POST'])
+@permission_classes([permissions.AllowAny])
+def digita_gw_batch(request):
+    """
+    Digita GW batch endpoint implementation. Accepts a list of uplink messages, as buffered and replayed by the
+    gateways, and stores them with a fixed number of queries regardless of the batch size.
+    """
+    if not isinstance(request.data, list):
+        return Response({"message": "Expected a list of uplink messages"}, status=status.HTTP_400_BAD_REQUEST)
+    if len(request.data) > settings.DIGITA_GW_MAX_BATCH:
+        return Response({"message": f"At most {settings.DIGITA_GW_MAX_BATCH} uplink messages are accepted at a time"},
+                        status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+    new_values, errors = ingest.ingest_uplinks(request.data)
+    return Response({
+        "message": "Updated successfully",
+        "received": len(request.data),
+        "stored": len(new_values),
+        "errors": [{"index": index, "message": message} for index, message in errors],
+    })
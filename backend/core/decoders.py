@@ -0,0 +1,83 @@
+"""
+Registry of uplink payload decoders.
+
+The decoder of an uplink is chosen by the name of the Sensor model of the ApartmentSensor sending it and the
+LoRaWAN FPort of the uplink, as configured in `settings.PAYLOAD_DECODERS` or registered with `register`. The most
+specific match wins: (sensor, port), (sensor, any port), (any sensor, port) and finally (any sensor, any port).
+
+A decoder is a function taking the payload bytes and returning a dict of payload key: value. It should raise
+ValueError when the payload can not be decoded.
+
+The Sensor of every DevEUI is cached per process once looked up, like the ids resolved by core.ingest, so ingesting
+uplinks does not query it again.
+"""
+import threading
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from core.utils.cache import LRUCache
+
+from . import models
+
+_registry = {}
+_registry_loaded = False
+_registry_lock = threading.Lock()
+
+# DevEUI: Sensor name, or None for ApartmentSensors without a Sensor
+_sensor_names = LRUCache(settings.INGEST_CACHE_SIZE, settings.INGEST_CACHE_TTL)
+
+
+def register(decoder, sensor=None, fport=None):
+    """
+    Use `decoder` for uplinks of ApartmentSensors of the Sensor named `sensor` sent to `fport`. None matches any
+    sensor or port.
+    """
+    _load_settings()
+    _registry[(sensor, fport)] = decoder
+
+
+def _load_settings():
+    global _registry_loaded
+    if _registry_loaded:
+        return
+    with _registry_lock:
+        if not _registry_loaded:
+            for key, path in settings.PAYLOAD_DECODERS.items():
+                _registry.setdefault(key, import_string(path))
+            _registry_loaded = True
+
+
+def get_decoder(sensor, fport):
+    """
+    Return the decoder for uplinks of the Sensor named `sensor` sent to `fport`, or None if there is none.
+    """
+    _load_settings()
+    for key in ((sensor, fport), (sensor, None), (None, fport), (None, None)):
+        decoder = _registry.get(key)
+        if decoder is not None:
+            return decoder
+    return None
+
+
+def sensor_names(identifiers):
+    """
+    Return a dict of the Sensor names of the ApartmentSensors with the given DevEUIs, looking up the ones not cached
+    yet with a single query. Unknown DevEUIs map to None.
+
+    Looked up names are cached once the current transaction commits, so that the cache never holds names from
+    transactions that are rolled back.
+    """
+    names = _sensor_names.get_many(identifiers)
+    missing = set(identifiers) - names.keys()
+    if missing:
+        found = dict.fromkeys(missing)
+        found.update(models.ApartmentSensor.objects.filter(
+            identifier__in=missing).values_list('identifier', 'sensor__name'))
+        names.update(found)
+        _sensor_names.set_many_on_commit(found)
+    return names
+
+
+def clear_cache():
+    _sensor_names.clear()
@@ -0,0 +1,258 @@
+"""
+Ingestion of Digita GW uplink messages into ApartmentSensorValues.
+
+Uplinks are processed in batches: all ApartmentSensors, SensorAttributes and ApartmentSensorAttributes referenced
+by a batch are resolved with a fixed number of set-based queries and every decoded value is written with a single
+`bulk_create`, so the number of database round-trips does not grow with the number of uplinks in the batch.
+
+The ids of these objects are cached per process, see `settings.INGEST_CACHE_SIZE`, so that in the steady state only
+the values themselves and what is derived from them are written. That takes 9 queries per batch, however many
+uplinks it has: insert the values, lock and update the latest values, look up the users of the attributes and
+bump their values versions, lock the attributes, read and update their rollups, and read the version of the cached
+subscription routes. Each is a single set-based query, so the cost per uplink falls with the batch size.
+
+The caches are cleared when the objects are changed in this process (see core.signals) and entries expire after
+`settings.INGEST_CACHE_TTL` seconds to pick up changes made elsewhere. Objects created here are created in bulk,
+without signals, so the DataVersions the signals would bump are bumped here.
+"""
+import binascii
+import logging
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+
+from core.utils.cache import LRUCache
+
+from . import decoders, models
+
+log = logging.getLogger(__name__)
+
+
+class UplinkError(Exception):
+    """
+    Raised when an uplink message can not be ingested. The message is meant to be returned to the gateway.
+    """
+
+
+def parse_uplink(data):
+    """
+    Return the DevEUI, FPort (None if missing) and raw payload of the uplink message.
+    """
+    try:
+        uplink = data['DevEUI_uplink']
+        identifier = uplink['DevEUI']
+    except (KeyError, TypeError):
+        raise UplinkError('Message ignored')
+    if not isinstance(identifier, str):
+        raise UplinkError('Invalid DevEUI: {!r}'.format(identifier))
+
+    try:
+        payload = binascii.unhexlify(uplink['payload_hex'])
+    except (KeyError, TypeError, binascii.Error) as err:
+        raise UplinkError('Invalid payload: {}'.format(err))
+
+    try:
+        fport = int(uplink['FPort'])
+    except (KeyError, TypeError, ValueError):
+        fport = None
+    return identifier, fport, payload
+
+
+def decode_payload(identifier, fport, payload, sensor_names=None):
+    """
+    Decode the payload with the decoder registered for the Sensor of the ApartmentSensor `identifier` and `fport`.
+    `sensor_names` is a dict of Sensor names by DevEUI as returned by `decoders.sensor_names`; it is looked up if
+    not given.
+    """
+    if sensor_names is None:
+        sensor_names = decoders.sensor_names([identifier])
+    sensor = sensor_names.get(identifier)
+    decoder = decoders.get_decoder(sensor, fport)
+    if decoder is None:
+        raise UplinkError(f'No decoder for sensor {sensor} on FPort {fport}')
+    try:
+        return decoder(payload)
+    except ValueError as err:
+        raise UplinkError('Failed to decode payload: {}'.format(err))
+
+
+_apartment_sensor_ids = LRUCache(settings.INGEST_CACHE_SIZE, settings.INGEST_CACHE_TTL)
+_attribute_ids = LRUCache(settings.INGEST_CACHE_SIZE, settings.INGEST_CACHE_TTL)
+_apartment_sensor_attribute_ids = LRUCache(settings.INGEST_CACHE_SIZE, settings.INGEST_CACHE_TTL)
+
+
+def clear_caches():
+    for cache in (_apartment_sensor_ids, _attribute_ids, _apartment_sensor_attribute_ids):
+        cache.clear()
+
+
+def _cached(cache, keys, resolve):
+    """
+    Return a dict of ids by key, taken from `cache` or, for keys not cached, from `resolve(missing keys)`.
+    """
+    ids = cache.get_many(keys)
+    missing = keys - ids.keys()
+    if missing:
+        resolved = resolve(missing)
+        cache.set_many_on_commit(resolved)
+        ids.update(resolved)
+    return ids
+
+
+def _created(*keys):
+    # Objects created with bulk_create send no post_save signals, so bump the versions core.signals would bump
+    models.DataVersion.bump(keys)
+
+
+def _resolve_apartment_sensors(identifiers):
+    """
+    Return a dict of ApartmentSensor ids by identifier, creating the ones that do not exist yet.
+    """
+    def fetch():
+        return dict(models.ApartmentSensor.objects.filter(identifier__in=identifiers).values_list('identifier', 'id'))
+
+    sensors = fetch()
+    missing = identifiers - sensors.keys()
+    if missing:
+        models.ApartmentSensor.objects.bulk_create(
+            [models.ApartmentSensor(identifier=identifier) for identifier in missing], ignore_conflicts=True)
+        _created(models.DataVersion.STRUCTURE)
+        sensors = fetch()
+    return sensors
+
+
+def _resolve_attributes(keys):
+    """
+    Return a dict of SensorAttribute ids by (payload key, URI) tuples, creating the ones that do not exist yet.
+
+    Keys with a URI, as listed in `settings.DIGITA_GW_PAYLOAD_TO_ATTRIBUTES`, are matched by URI, the rest by
+    description.
+    """
+    keys_by_uri = {uri: (key, uri) for key, uri in keys if uri}
+    keys_by_description = {key: (key, uri) for key, uri in keys if not uri}
+
+    def fetch():
+        attrs = {}
+        query = Q(uri__in=list(keys_by_uri)) | Q(description__in=list(keys_by_description))
+        for attr_id, uri, description in models.SensorAttribute.objects.filter(query).order_by('id').values_list(
+                'id', 'uri', 'description'):
+            if uri in keys_by_uri:
+                attrs.setdefault(keys_by_uri[uri], attr_id)
+            if description in keys_by_description:
+                attrs.setdefault(keys_by_description[description], attr_id)
+        return attrs
+
+    attrs = fetch()
+    missing = keys - attrs.keys()
+    if missing:
+        models.SensorAttribute.objects.bulk_create(
+            [models.SensorAttribute(uri=uri, description=key) for key, uri in sorted(missing)])
+        _created(models.DataVersion.STRUCTURE, models.DataVersion.SERVICES)
+        attrs = fetch()
+    return attrs
+
+
+def _resolve_apartment_sensor_attributes(pairs):
+    """
+    Return a dict of ApartmentSensorAttribute ids by (apartment sensor id, attribute id), creating the ones that do
+    not exist yet.
+    """
+    def fetch():
+        apsen_attrs = {}
+        queryset = models.ApartmentSensorAttribute.objects.filter(
+            apartment_sensor__in={apsen_id for apsen_id, _ in pairs},
+            attribute__in={attr_id for _, attr_id in pairs},
+        ).order_by('id')
+        for apsen_attr_id, apsen_id, attr_id in queryset.values_list('id', 'apartment_sensor_id', 'attribute_id'):
+            apsen_attrs.setdefault((apsen_id, attr_id), apsen_attr_id)
+        return apsen_attrs
+
+    apsen_attrs = fetch()
+    missing = pairs - apsen_attrs.keys()
+    if missing:
+        models.ApartmentSensorAttribute.objects.bulk_create([
+            models.ApartmentSensorAttribute(apartment_sensor_id=apsen_id, attribute_id=attr_id)
+            for apsen_id, attr_id in sorted(missing)])
+        _created(models.DataVersion.STRUCTURE)
+        apsen_attrs = fetch()
+    return apsen_attrs
+
+
+def store_readings(readings):
+    """
+    Store decoded readings, given as a list of (identifier, {payload key: value}) tuples, as new
+    ApartmentSensorValues and return the created values. Should be called within a transaction.
+    """
+    readings = list(readings)
+    if not readings:
+        return []
+
+    mapping = settings.DIGITA_GW_PAYLOAD_TO_ATTRIBUTES  # type: dict
+    attr_keys = {key: (key, mapping.get(key, '')) for _, decoded in readings for key in decoded}
+
+    sensors = _cached(_apartment_sensor_ids, {identifier for identifier, _ in readings}, _resolve_apartment_sensors)
+    attrs = _cached(_attribute_ids, set(attr_keys.values()), _resolve_attributes)
+    apsen_attrs = _cached(_apartment_sensor_attribute_ids, {
+        (sensors[identifier], attrs[attr_keys[key]]) for identifier, decoded in readings for key in decoded
+    }, _resolve_apartment_sensor_attributes)
+
+    new_values = [
+        models.ApartmentSensorValue(
+            apartment_sensor_attribute_id=apsen_attrs[(sensors[identifier], attrs[attr_keys[key]])], value=value)
+        for identifier, decoded in readings
+        for key, value in decoded.items()
+    ]
+    models.ApartmentSensorValue.objects.bulk_create(new_values)
+    models.ApartmentSensorLatestValue.update_from_values(new_values)
+    models.ApartmentSensorRollup.update_from_values(new_values)
+    return new_values
+
+
+def process_readings(readings):
+    """
+    Store decoded readings and queue the new values for subscribed services in the same transaction, or send them
+    once it commits, so that deliveries are never lost or sent for values that were not stored.
+    """
+    try:
+        return _process_readings(readings)
+    except IntegrityError:
+        # Cached ids may refer to objects deleted by another process since
+        clear_caches()
+        return _process_readings(readings)
+
+
+def _process_readings(readings):
+    with transaction.atomic():
+        new_values = store_readings(readings)
+        if new_values:
+            models.Subscription.handle_new_values(new_values)
+    return new_values
+
+
+def ingest_uplinks(uplinks):
+    """
+    Decode and store a batch of Digita GW uplink messages and pass the new values on to subscribed services.
+
+    Returns a tuple of the created values and a list of (index, message) tuples for the uplinks that were skipped.
+    """
+    parsed = []
+    errors = []
+    for index, data in enumerate(uplinks):
+        try:
+            parsed.append((index, parse_uplink(data)))
+        except UplinkError as err:
+            errors.append((index, str(err)))
+
+    sensor_names = decoders.sensor_names({identifier for _, (identifier, _, _) in parsed})
+    readings = []
+    for index, (identifier, fport, payload) in parsed:
+        try:
+            readings.append((identifier, decode_payload(identifier, fport, payload, sensor_names)))
+        except UplinkError as err:
+            errors.append((index, str(err)))
+            # The sensor is still created, as by the single uplink endpoint, so that it can be set up
+            readings.append((identifier, {}))
+    errors.sort()
+
+    return process_readings(readings), errors
@@ -0,0 +1,198 @@
+"""
+Live sensor values pushed to browsers as server-sent events.
+
+New latest values are published per user once the transaction storing them commits. On PostgreSQL they are sent
+with NOTIFY, and every process serving live streams LISTENs on a dedicated connection and passes them on to the
+streams of the user, so that the process ingesting data and the processes serving streams can be different. On
+other databases values are passed on to the streams of the publishing process only.
+
+Streams stay open for as long as the browser is connected, so they are only served by gunicorn's gevent workers
+started with `LIVE_STREAMS=1`, never by the sync workers serving the rest of the API, see docs/dev-tips.md.
+"""
+import json
+import logging
+import queue
+import select
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.core import signing
+from django.db import connection, transaction
+from rest_framework import fields
+
+log = logging.getLogger(__name__)
+
+CHANNEL = 'sensehel_live'
+TOKEN_SALT = 'core.live.stream-token'
+
+# Seconds between checks for stopping while waiting for notifications
+POLL_INTERVAL = 1
+
+# Values per message, keeping NOTIFY payloads well below their 8000 byte limit
+MESSAGE_SIZE = 50
+
+
+def stream_token(user):
+    """
+    Return a signed token for opening a stream of `user`, valid for `settings.LIVE_TOKEN_MAX_AGE` seconds.
+    """
+    return signing.dumps(user.pk, salt=TOKEN_SALT)
+
+
+def check_stream_token(token):
+    """
+    Return the id of the user of a stream token, or None if it is invalid or expired.
+    """
+    try:
+        return signing.loads(token, salt=TOKEN_SALT, max_age=settings.LIVE_TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return None
+
+
+class Stream:
+    """
+    Messages waiting to be sent to one connected browser. If the browser falls too far behind, the waiting
+    messages are dropped and it is told to reload instead.
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.messages = queue.Queue(maxsize=settings.LIVE_QUEUE_SIZE)
+        self.lost = False
+
+    def put(self, message):
+        try:
+            self.messages.put_nowait(message)
+        except queue.Full:
+            self.lost = True
+
+    def events(self):
+        """
+        Yield the messages as server-sent events forever, with a comment every `settings.LIVE_KEEPALIVE` seconds
+        so that proxies do not close an idle connection.
+        """
+        yield 'retry: 5000\n\n'
+        while True:
+            if self.lost:
+                self.lost = False
+                yield 'event: reload\ndata: {}\n\n'
+            try:
+                message = self.messages.get(timeout=settings.LIVE_KEEPALIVE)
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            yield f'event: values\ndata: {json.dumps(message)}\n\n'
+
+
+class Broker:
+    """
+    Passes published messages on to the streams of their users in this process.
+    """
+
+    def __init__(self):
+        self._streams = defaultdict(set)
+        self._lock = threading.Lock()
+        self._listener = None
+        # Set while LISTENing on PostgreSQL
+        self.listening = threading.Event()
+        self._stopping = threading.Event()
+
+    def subscribe(self, user_id):
+        if connection.vendor == 'postgresql':
+            self._start_listener()
+        stream = Stream(user_id)
+        with self._lock:
+            self._streams[user_id].add(stream)
+        return stream
+
+    def unsubscribe(self, stream):
+        with self._lock:
+            streams = self._streams.get(stream.user_id, set())
+            streams.discard(stream)
+            if not streams:
+                self._streams.pop(stream.user_id, None)
+
+    def dispatch(self, user_id, message):
+        with self._lock:
+            streams = list(self._streams.get(user_id, ()))
+        for stream in streams:
+            stream.put(message)
+
+    def _start_listener(self):
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, name='live-listener', daemon=True)
+                self._listener.start()
+
+    def stop(self):
+        """
+        Stop listening and close the listening connection, e.g. before the test database is dropped.
+        """
+        with self._lock:
+            listener, self._listener = self._listener, None
+        if listener is not None:
+            self._stopping.set()
+            listener.join()
+            self._stopping.clear()
+
+    def _listen(self):
+        while not self._stopping.is_set():
+            try:
+                self._listen_once()
+            except Exception as err:
+                log.warning(f'Listening for live values failed, reconnecting: {err}')
+                self._stopping.wait(settings.LIVE_KEEPALIVE)
+
+    def _listen_once(self):
+        conn = connection.Database.connect(**connection.get_connection_params())
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute(f'LISTEN {CHANNEL}')
+            self.listening.set()
+            while not self._stopping.is_set():
+                select.select([conn], [], [], POLL_INTERVAL)
+                conn.poll()
+                while conn.notifies:
+                    data = json.loads(conn.notifies.pop(0).payload)
+                    self.dispatch(data['user'], data['message'])
+        finally:
+            self.listening.clear()
+            conn.close()
+
+
+broker = Broker()
+
+
+def publish_values(users, rows):
+    """
+    Publish the ApartmentSensorLatestValues `rows` to the streams of the users in the `users` dict of
+    ApartmentSensorAttribute id: user id, once the current transaction commits.
+    """
+    value_field = fields.IntegerField()
+    datetime_field = fields.DateTimeField()
+    values = defaultdict(list)
+    for row in rows:
+        user_id = users.get(row.apartment_sensor_attribute_id)
+        if user_id is not None:
+            values[user_id].append({
+                'id': row.apartment_sensor_attribute_id,
+                'value': value_field.to_representation(row.value),
+                'updated_at': datetime_field.to_representation(row.updated_at),
+            })
+    messages = [
+        (user_id, {'values': user_values[start:start + MESSAGE_SIZE]})
+        for user_id, user_values in values.items() for start in range(0, len(user_values), MESSAGE_SIZE)]
+    if messages:
+        transaction.on_commit(lambda: _send(messages))
+
+
+def _send(messages):
+    if connection.vendor != 'postgresql':
+        for user_id, message in messages:
+            broker.dispatch(user_id, message)
+        return
+    payloads = [json.dumps({'user': user_id, 'message': message}) for user_id, message in messages]
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload', [CHANNEL, payloads])
@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from core.utils import archive, partitions
+
+
+class Command(BaseCommand):
+    help = ('Export sensor values older than the retention period to gzip-compressed CSV files, one per month and '
+            'apartment sensor attribute, and delete them in small batches. Run e.g. daily from cron.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=settings.SENSOR_VALUE_RETENTION_DAYS,
+            help='Days of values to keep (default: SENSOR_VALUE_RETENTION_DAYS)')
+        parser.add_argument(
+            '--archive-dir', default=settings.SENSOR_VALUE_ARCHIVE_DIR,
+            help='Directory to export values to (default: SENSOR_VALUE_ARCHIVE_DIR)')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Values exported and deleted at a time')
+        parser.add_argument('--pause', type=float, default=0, help='Seconds to sleep between batches')
+
+    def handle(self, *args, **options):
+        if not options['days']:
+            self.stdout.write('No retention period configured, nothing to do')
+            return
+
+        before = archive.retention_cutoff(options['days'])
+        total = 0
+        for attr_id, count in archive.archive_values(
+                before, options['archive_dir'], batch_size=options['batch_size'], pause=options['pause']):
+            self.stdout.write(f'Archived {count} values of attribute {attr_id}')
+            total += count
+        self.stdout.write(f'Archived {total} values stored before {before.isoformat()}')
+
+        if partitions.is_partitioned(connection):
+            with transaction.atomic(), connection.cursor() as cursor:
+                for name in partitions.drop_empty_partitions(cursor, before):
+                    self.stdout.write(f'Dropped empty partition {name}')
@@ -0,0 +1,180 @@
+import json
+import random
+import secrets
+import threading
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from core import models
+from core.utils import benchmark
+
+ENDPOINTS = ['/api/apartments/', '/api/apartmentsensors/', '/api/available-services', '/api/subscriptions/']
+
+ATTRIBUTES = [
+    ('temperature', 'http://urn.fi/URN:NBN:fi:au:ucum:r73', 'TEMPERATURE', (18, 26)),
+    ('humidity', 'http://www.yso.fi/onto/yso/p6453', 'HUMIDITY', (20, 60)),
+    ('co2', 'http://finto.fi/afo/en/page/p4770', 'CO2', (400, 1500)),
+]
+
+
+def _ids(model, count):
+    """
+    Return the ids of the `count` newest rows of `model` in creation order. Needed since `bulk_create` does not
+    set primary keys on all databases.
+    """
+    return list(reversed(model.objects.order_by('-id').values_list('id', flat=True)[:count]))
+
+
+class Command(BaseCommand):
+    help = ('Benchmark the endpoints polled by the frontend with concurrent clients against seeded data in a '
+            'throwaway test database, measuring latency, queries and response size, and save the results as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--apartments', type=int, default=1000, help='Apartments, each with its own user')
+        parser.add_argument('--sensors', type=int, default=2, help='Sensors per apartment')
+        parser.add_argument('--days', type=int, default=7, help='Days of readings per sensor attribute')
+        parser.add_argument('--interval', type=int, default=10, help='Minutes between readings')
+        parser.add_argument('--services', type=int, default=5, help='Services, each subscribed by every user')
+        parser.add_argument('--clients', type=int, default=8, help='Concurrent clients')
+        parser.add_argument('--requests', type=int, default=50, help='Requests per client and endpoint')
+        parser.add_argument('--seed', type=int, default=0, help='Seed for the generated data and clients')
+        parser.add_argument('--output', default='benchmark-api.json', help='File to save the results to')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        with benchmark.test_database():
+            start = time.perf_counter()
+            tokens = self.seed(rng, options)
+            seed_seconds = round(time.perf_counter() - start, 1)
+            self.stdout.write(f'Seeded data in {seed_seconds} s')
+
+            results = {'seed_seconds': seed_seconds, 'values': models.ApartmentSensorValue.objects.count()}
+            for endpoint in ENDPOINTS:
+                results[endpoint] = self.run(endpoint, tokens, rng, options)
+                self.stdout.write(f'{endpoint}: {results[endpoint]}')
+
+        parameters = {key: options[key] for key in (
+            'apartments', 'sensors', 'days', 'interval', 'services', 'clients', 'requests', 'seed')}
+        data = benchmark.write_results(options['output'], 'api', parameters, results)
+        self.stdout.write(json.dumps(data, indent=2))
+
+    def seed(self, rng, options):
+        """
+        Create the apartments with their users, sensors, readings and subscriptions, and return the users' tokens.
+        """
+        count = options['apartments']
+        attributes = [
+            models.SensorAttribute.objects.create(description=description, uri=uri, ui_type=ui_type)
+            for description, uri, ui_type, _ in ATTRIBUTES]
+        sensor = models.Sensor.objects.create(name='Elsys ERS CO2')
+        sensor.provides.set(attributes)
+        services = []
+        for i in range(options['services']):
+            service = models.Service.objects.create(
+                name=f'Service {i}', price='0', benefit_short='-', benefit_long='-', description='-')
+            service.requires.set(rng.sample(attributes, rng.randint(1, len(attributes))))
+            services.append(service)
+
+        models.User.objects.bulk_create(
+            [models.User(username=f'benchmark{i}', invite_code='') for i in range(count)], batch_size=500)
+        user_ids = _ids(models.User, count)
+        tokens = [secrets.token_hex(20) for _ in user_ids]
+        Token.objects.bulk_create(
+            [Token(key=key, user_id=user_id) for key, user_id in zip(tokens, user_ids)], batch_size=500)
+        models.Apartment.objects.bulk_create([
+            models.Apartment(user_id=user_id, street=f'Benchmarkinkatu {i}', city='Helsinki', postal_code='00100')
+            for i, user_id in enumerate(user_ids)], batch_size=500)
+        apartment_ids = _ids(models.Apartment, count)
+
+        models.ApartmentSensor.objects.bulk_create([
+            models.ApartmentSensor(apartment_id=apartment_id, sensor=sensor, identifier=f'{apartment_id:012X}{i:04X}')
+            for apartment_id in apartment_ids for i in range(options['sensors'])], batch_size=500)
+        apsen_ids = _ids(models.ApartmentSensor, count * options['sensors'])
+        models.ApartmentSensorAttribute.objects.bulk_create([
+            models.ApartmentSensorAttribute(apartment_sensor_id=apsen_id, attribute=attribute)
+            for apsen_id in apsen_ids for attribute in attributes], batch_size=500)
+        apsen_attr_ids = _ids(models.ApartmentSensorAttribute, len(apsen_ids) * len(attributes))
+
+        self.seed_values(rng, apsen_attr_ids, options)
+
+        Subscription = models.Subscription  # noqa
+        Subscription.objects.bulk_create([
+            Subscription(user_id=user_id, service=service) for user_id in user_ids for service in services],
+            batch_size=500)
+        subscription_ids = _ids(Subscription, len(user_ids) * len(services))
+        attrs_by_user = [apsen_attr_ids[i * len(attributes) * options['sensors']:][:len(attributes)]
+                         for i in range(len(user_ids))]
+        Subscription.attributes.through.objects.bulk_create([
+            Subscription.attributes.through(subscription_id=subscription_id, apartmentsensorattribute_id=attr_id)
+            for i, subscription_id in enumerate(subscription_ids)
+            for attr_id in attrs_by_user[i // len(services)]], batch_size=500)
+        return tokens
+
+    def seed_values(self, rng, apsen_attr_ids, options):
+        """
+        Create readings every `interval` minutes for the past `days` days, and their latest values and rollups.
+        """
+        now = timezone.now()
+        times = [now - timedelta(minutes=minutes)
+                 for minutes in range(options['days'] * 24 * 60 - options['interval'], -1, -options['interval'])]
+        ranges = [value_range for _, _, _, value_range in ATTRIBUTES]
+        ApartmentSensorValue = models.ApartmentSensorValue  # noqa
+        for updated_at in times:
+            last_id = ApartmentSensorValue.objects.order_by('-id').values_list('id', flat=True).first() or 0
+            ApartmentSensorValue.objects.bulk_create([
+                ApartmentSensorValue(
+                    apartment_sensor_attribute_id=attr_id, value=round(rng.uniform(*ranges[index % len(ranges)]), 1))
+                for index, attr_id in enumerate(apsen_attr_ids)], batch_size=500)
+            # updated_at is set with auto_now on insert, so set the time of the readings afterwards
+            ApartmentSensorValue.objects.filter(id__gt=last_id).update(updated_at=updated_at)
+        models.ApartmentSensorLatestValue.rebuild()
+        models.ApartmentSensorRollup.rebuild()
+
+    def run(self, endpoint, tokens, rng, options):
+        """
+        Request `endpoint` with concurrent clients, each as a random user, and return the measurements.
+        """
+        recorders = []
+        sizes = []
+        failed = []
+        users = [rng.choice(tokens) for _ in range(options['clients'])]
+
+        def client_thread(token):
+            client = APIClient()
+            client.credentials(HTTP_AUTHORIZATION=f'Token {token}')
+            recorder = benchmark.Recorder()
+            try:
+                for _ in range(options['requests']):
+                    with recorder.measure():
+                        response = client.get(endpoint)
+                    sizes.append(len(response.content))
+                    if response.status_code != 200:
+                        failed.append(response.status_code)
+            finally:
+                connection.close()
+            recorders.append(recorder)
+
+        threads = [threading.Thread(target=client_thread, args=(token,)) for token in users]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.perf_counter() - start
+
+        combined = benchmark.Recorder()
+        for recorder in recorders:
+            combined.latencies += recorder.latencies
+            combined.queries += recorder.queries
+        return dict(
+            combined.summary(),
+            requests_per_second=round(len(combined.latencies) / seconds, 1),
+            mean_bytes=round(sum(sizes) / len(sizes)) if sizes else 0,
+            failed_requests=len(failed),
+        )
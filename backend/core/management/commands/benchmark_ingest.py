@@ -0,0 +1,109 @@
+import json
+import random
+import struct
+import time
+
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from core import decoders, ingest
+from core.models import ApartmentSensor, Delivery, Service, User
+from core.tests.data import sensor_data_package
+from core.utils import benchmark, elsys
+
+
+def elsys_payload(rng):
+    """
+    Return a random Elsys ERS payload with temperature, humidity, light, motion, CO2 and VDD.
+    """
+    return struct.pack(
+        '>BhBBBHBBBHBH',
+        elsys.TYPE_TEMP, rng.randint(150, 280), elsys.TYPE_RH, rng.randint(20, 60),
+        elsys.TYPE_LIGHT, rng.randint(0, 2000), elsys.TYPE_MOTION, rng.randint(0, 20),
+        elsys.TYPE_CO2, rng.randint(400, 1500), elsys.TYPE_VDD, rng.randint(3000, 3700))
+
+
+def uplink(identifier, payload):
+    return {'DevEUI_uplink': dict(sensor_data_package['DevEUI_uplink'], DevEUI=identifier, payload_hex=payload.hex())}
+
+
+class Command(BaseCommand):
+    help = ('Benchmark ingesting synthetic Digita GW uplinks of N sensors x M uplinks through the API in a throwaway '
+            'test database, with a share of the sensors subscribed to a local stub service, and save the results '
+            'as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sensors', type=int, default=100, help='Number of sensors (N)')
+        parser.add_argument('--uplinks', type=int, default=10, help='Number of uplinks per sensor (M)')
+        parser.add_argument(
+            '--batch-size', type=int, default=1,
+            help='Uplinks per request; 1 posts to digita-gw, more to digita-gw-batch')
+        parser.add_argument(
+            '--subscribed', type=float, default=0.5, help='Share of sensors subscribed to the stub service')
+        parser.add_argument(
+            '--inline', action='store_true', help='Submit data to the stub service inline instead of via the outbox')
+        parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic payloads')
+        parser.add_argument('--output', default='benchmark-ingest.json', help='File to save the results to')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        identifiers = [f'{0xBE00000000000000 + i:016X}' for i in range(options['sensors'])]
+        batch_size = max(options['batch_size'], 1)
+        url = reverse('digita-gw' if batch_size == 1 else 'digita-gw-batch')
+
+        with benchmark.test_database(), benchmark.stub_service() as stub:
+            decoders.clear_cache()
+            ingest.clear_caches()
+            client = APIClient()
+
+            # Create the sensors and their attributes with one uplink each, and subscribe a share of them
+            client.post(reverse('digita-gw-batch'), [uplink(i, elsys_payload(rng)) for i in identifiers], format='json')
+            self.subscribe(identifiers[:round(len(identifiers) * options['subscribed'])], stub.url)
+
+            uplinks = [uplink(i, elsys_payload(rng)) for _ in range(options['uplinks']) for i in identifiers]
+            recorder = benchmark.Recorder()
+            failed = 0
+            with override_settings(SUBSCRIPTION_OUTBOX=not options['inline']):
+                for start in range(0, len(uplinks), batch_size):
+                    data = uplinks[start] if batch_size == 1 else uplinks[start:start + batch_size]
+                    with recorder.measure():
+                        response = client.post(url, data, format='json')
+                    failed += response.status_code != 200
+
+            requests = recorder.summary()
+            results = {
+                'uplinks': len(uplinks),
+                'failed_requests': failed,
+                'uplinks_per_second': round(len(uplinks) / requests['seconds'], 1),
+                'queries_per_uplink': round(requests['queries'] * len(recorder.queries) / len(uplinks), 2),
+                'requests': requests,
+            }
+            if not options['inline']:
+                results['deliveries'] = self.drain_deliveries()
+            results['service_requests'] = stub.requests
+
+        parameters = {key: options[key] for key in ('sensors', 'uplinks', 'batch_size', 'subscribed', 'inline', 'seed')}
+        data = benchmark.write_results(options['output'], 'ingest', parameters, results)
+        self.stdout.write(json.dumps(data, indent=2))
+
+    def subscribe(self, identifiers, url):
+        service = Service.objects.create(
+            name='Benchmark', price='0', benefit_short='-', benefit_long='-', description='-', data_url=url)
+        user = User.objects.create(username='benchmark')
+        for apsen in ApartmentSensor.objects.filter(identifier__in=identifiers).prefetch_related('attributes'):
+            subscription = user.subscriptions.create(service=service)
+            subscription.attributes.set(apsen.attributes.all())
+
+    def drain_deliveries(self):
+        """
+        Submit all queued deliveries as the `process_deliveries` worker would and return the throughput.
+        """
+        count = Delivery.objects.count()
+        start = time.perf_counter()
+        while Delivery.process_pending():
+            pass
+        seconds = time.perf_counter() - start
+        per_second = round(count / seconds, 1) if seconds else None
+        return {'count': count, 'seconds': round(seconds, 4), 'per_second': per_second}
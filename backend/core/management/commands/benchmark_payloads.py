@@ -0,0 +1,82 @@
+import json
+import random
+import time
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.models import ApartmentSensorValue
+from core.models.subscription import ApartmentSensorValueSerializer, serialize_values
+from core.utils import benchmark, payloads
+
+
+def synthetic_values(count, attributes, rng):
+    """
+    Return `count` unsaved values of `attributes` attributes, one minute apart per attribute.
+    """
+    start = timezone.now() - timedelta(minutes=count)
+    return [
+        ApartmentSensorValue(
+            apartment_sensor_attribute_id=1 + i % attributes,
+            value=Decimal(rng.randint(0, 200000)) / 100,
+            updated_at=start + timedelta(minutes=i // attributes))
+        for i in range(count)
+    ]
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def encoded_body(data, encoding):
+    kwargs = payloads.encode(data, encoding)
+    # requests serializes `json` itself, so do the same for the plain JSON encoding
+    return kwargs['data'] if 'data' in kwargs else json.dumps(kwargs['json']).encode()
+
+
+class Command(BaseCommand):
+    help = ('Benchmark serializing one push of N synthetic values to a service with DRF and with the fast path for '
+            'rows, and encoding it in every data encoding, and save the results as JSON. Does not use the database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--values', type=int, default=100000, help='Number of values in the push (N)')
+        parser.add_argument('--attributes', type=int, default=6, help='Number of attributes the values belong to')
+        parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic values')
+        parser.add_argument('--output', default='benchmark-payloads.json', help='File to save the results to')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        values = synthetic_values(options['values'], max(options['attributes'], 1), rng)
+
+        # Serializing model instances with DRF, and the rows that values_list would read with the fast path
+        results = {}
+        drf, seconds = timed(lambda: ApartmentSensorValueSerializer(values, many=True).data)
+        results['serialize_drf'] = {'seconds': round(seconds, 4), 'values_per_second': round(len(values) / seconds)}
+        rows = [(value.apartment_sensor_attribute_id, value.value, value.updated_at) for value in values]
+        serialized, seconds = timed(serialize_values, rows)
+        results['serialize_rows'] = {'seconds': round(seconds, 4), 'values_per_second': round(len(values) / seconds)}
+        results['serialize_rows']['identical'] = json.dumps(serialized) == json.dumps(drf)
+
+        data = {'uuid': str(uuid.uuid4()), 'values': serialized, 'auth_token': str(uuid.uuid4())}
+        for encoding, _ in payloads.ENCODINGS:
+            try:
+                payloads.check_encoding(encoding)
+            except ImproperlyConfigured as e:
+                results[encoding] = {'skipped': str(e)}
+                continue
+            body, seconds = timed(encoded_body, data, encoding)
+            results[encoding] = {
+                'bytes': len(body),
+                'encode_seconds': round(seconds, 4),
+                'values_per_second': round(len(values) / seconds) if seconds else None,
+            }
+
+        parameters = {key: options[key] for key in ('values', 'attributes', 'seed')}
+        data = benchmark.write_results(options['output'], 'payloads', parameters, results)
+        self.stdout.write(json.dumps(data, indent=2))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from core.utils import partitions
+
+
+class Command(BaseCommand):
+    help = ('Create monthly partitions of the sensor value table for the coming months. '
+            'Only applies to PostgreSQL with PARTITION_SENSOR_VALUES enabled; run e.g. daily from cron.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months', type=int, default=3, help='Number of months ahead to create partitions for')
+
+    def handle(self, *args, **options):
+        if not partitions.is_partitioned(connection):
+            self.stdout.write('Sensor values are not partitioned, nothing to do')
+            return
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            created = partitions.create_partitions(cursor, timezone.now(), options['months'])
+        for name in created:
+            self.stdout.write(f'Created partition {name}')
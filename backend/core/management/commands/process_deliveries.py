@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.models import Delivery, Subscription
+
+
+class Command(BaseCommand):
+    help = ('Submit queued sensor values and requested history to subscribed services. '
+            'Runs until interrupted unless --once is given.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Exit once no deliveries are due')
+        parser.add_argument('--batch-size', type=int, default=100, help='Deliveries attempted per transaction')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds to sleep when the queue is empty')
+        parser.add_argument(
+            '--history-pages', type=int, default=10,
+            help='Pages of history sent per subscription before returning to queued deliveries')
+
+    def handle(self, *args, **options):
+        while True:
+            delivered = Delivery.process_pending(limit=options['batch_size'])
+            if delivered + Subscription.process_pending_history(max_pages=options['history_pages']):
+                continue
+            if options['once']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from core.models import ApartmentSensorLatestValue
+
+
+class Command(BaseCommand):
+    help = 'Recreate the latest value of every apartment sensor attribute from the stored values.'
+
+    def handle(self, *args, **options):
+        count = ApartmentSensorLatestValue.rebuild()
+        self.stdout.write(f'Rebuilt {count} latest values')
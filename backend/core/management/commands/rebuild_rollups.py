@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.models import ApartmentSensorRollup
+from core.utils import archive
+
+
+class Command(BaseCommand):
+    help = ('Recreate the hourly and daily rollups of every apartment sensor attribute from the stored values. With '
+            'SENSOR_VALUE_RETENTION_DAYS set only the rollups of the retention period are recreated, keeping the '
+            'rollups of archived values.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Values read and rollups written at a time')
+
+    def handle(self, *args, **options):
+        days = settings.SENSOR_VALUE_RETENTION_DAYS
+        since = archive.retention_cutoff(days) if days else None
+        count = ApartmentSensorRollup.rebuild(batch_size=options['batch_size'], since=since)
+        self.stdout.write(f'Rebuilt {count} rollups')
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from core.models import DeadLetter
+
+
+class Command(BaseCommand):
+    help = ('Queue dead letters, deliveries that failed too many times, to be resent by the process_deliveries '
+            'worker, and close the circuits of their services. Run once a service has recovered from an outage.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--service', action='append', help='Only replay dead letters of the named service(s)')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Dead letters queued per transaction')
+
+    def handle(self, *args, **options):
+        dead_letters = DeadLetter.objects.all()
+        if options['service']:
+            dead_letters = dead_letters.filter(subscription__service__name__in=options['service'])
+        count = DeadLetter.replay(dead_letters, batch_size=options['batch_size'])
+        self.stdout.write(f'Queued {count} dead letters for delivery')
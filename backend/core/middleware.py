@@ -0,0 +1,24 @@
+import time
+
+from django.db import connection
+
+from core.utils import metrics
+
+
+class MetricsMiddleware:
+    """
+    Record the latency, SQL queries and outgoing service calls of every request, see core.utils.metrics. Should be
+    the first middleware, so that the time spent in the others is included.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request_metrics = metrics.RequestMetrics()
+        start = time.perf_counter()
+        with metrics.collecting(request_metrics), connection.execute_wrapper(request_metrics):
+            response = self.get_response(request)
+        request_metrics.observe(
+            metrics.view_name(request), request.method, response.status_code, time.perf_counter() - start)
+        return response
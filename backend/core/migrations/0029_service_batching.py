@@ -0,0 +1,23 @@
+# Generated by Django 2.2.8 on 2026-10-18 12:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0028_delivery'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='service',
+            name='batch_size',
+            field=models.PositiveIntegerField(default=100, help_text='Maximum number of queued deliveries combined into one request. A full batch is submitted without waiting for the batch window to pass.'),
+        ),
+        migrations.AddField(
+            model_name='service',
+            name='batch_window',
+            field=models.PositiveIntegerField(default=0, help_text='Seconds to collect new data for this service before submitting it in one combined request. With 0 data is submitted separately for every subscription as it arrives.'),
+        ),
+    ]
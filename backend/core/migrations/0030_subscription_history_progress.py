@@ -0,0 +1,23 @@
+# Generated by Django 2.2.8 on 2026-10-18 12:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0029_service_batching'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscription',
+            name='history_cursor',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Id of the last value submitted as history'),
+        ),
+        migrations.AddField(
+            model_name='subscription',
+            name='history_until',
+            field=models.PositiveIntegerField(editable=False, help_text='Id of the newest value to submit as history; null when no history submission is pending', null=True),
+        ),
+    ]
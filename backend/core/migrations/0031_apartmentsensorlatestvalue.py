@@ -0,0 +1,35 @@
+# Generated by Django 2.2.8 on 2026-10-18 12:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def forwards(apps, schema_editor):
+    ApartmentSensorValue = apps.get_model('core', 'ApartmentSensorValue')  # noqa
+    ApartmentSensorLatestValue = apps.get_model('core', 'ApartmentSensorLatestValue')  # noqa
+    newest = ApartmentSensorValue.objects.filter(
+        apartment_sensor_attribute=models.OuterRef('apartment_sensor_attribute')).order_by('-updated_at', '-id')
+    values = ApartmentSensorValue.objects.filter(id=models.Subquery(newest.values('id')[:1])).order_by()
+    ApartmentSensorLatestValue.objects.bulk_create([
+        ApartmentSensorLatestValue(apartment_sensor_attribute_id=attr_id, value=value, updated_at=updated_at)
+        for attr_id, value, updated_at in values.values_list('apartment_sensor_attribute_id', 'value', 'updated_at')
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0030_subscription_history_progress'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ApartmentSensorLatestValue',
+            fields=[
+                ('apartment_sensor_attribute', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='latest', serialize=False, to='core.ApartmentSensorAttribute')),
+                ('value', models.DecimalField(decimal_places=1, max_digits=8)),
+                ('updated_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
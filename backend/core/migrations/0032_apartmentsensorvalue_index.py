@@ -0,0 +1,27 @@
+# Generated by Django 2.2.8 on 2026-10-18 12:56
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0031_apartmentsensorlatestvalue'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='apartmentsensorvalue',
+            options={},
+        ),
+        migrations.AddIndex(
+            model_name='apartmentsensorvalue',
+            index=models.Index(fields=['apartment_sensor_attribute', 'updated_at'], name='core_asv_attr_updated_idx'),
+        ),
+        migrations.AlterField(
+            model_name='apartmentsensorvalue',
+            name='apartment_sensor_attribute',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='values', to='core.ApartmentSensorAttribute'),
+        ),
+    ]
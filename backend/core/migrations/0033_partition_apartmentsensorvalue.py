@@ -0,0 +1,98 @@
+from django.conf import settings
+from django.db import migrations
+from django.utils import timezone
+
+# The SQL is frozen here rather than imported from core.utils.partitions, so that later changes to the helpers do
+# not change what this migration does.
+TABLE = 'core_apartmentsensorvalue'
+DEFAULT_PARTITION = f'{TABLE}_default'
+INDEX = 'core_asv_attr_updated_idx'
+FOREIGN_KEY = 'core_asv_attr_fk'
+MONTHS_AHEAD = 3
+
+
+def month_start(dt):
+    return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(month, months):
+    years, month_index = divmod(month.month - 1 + months, 12)
+    return month.replace(year=month.year + years, month=month_index + 1)
+
+
+def is_partitioned(connection):
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)', [TABLE])
+        return cursor.fetchone() is not None
+
+
+def add_constraints(cursor, primary_key):
+    cursor.execute(f'ALTER TABLE {TABLE} ADD PRIMARY KEY ({primary_key})')
+    cursor.execute(f'''
+        ALTER TABLE {TABLE} ADD CONSTRAINT {FOREIGN_KEY} FOREIGN KEY (apartment_sensor_attribute_id)
+        REFERENCES core_apartmentsensorattribute (id) DEFERRABLE INITIALLY DEFERRED''')
+    cursor.execute(f'CREATE INDEX {INDEX} ON {TABLE} (apartment_sensor_attribute_id, updated_at)')
+
+
+def partition_table(cursor):
+    """
+    Convert the plain table into one partitioned by month of `updated_at`, with a default partition, copying all
+    values. The primary key of a partitioned table must include the partition key, so it becomes (id, updated_at).
+    """
+    cursor.execute(f'ALTER TABLE {TABLE} RENAME TO {TABLE}_unpartitioned')
+    cursor.execute(f'''
+        CREATE TABLE {TABLE} (LIKE {TABLE}_unpartitioned INCLUDING DEFAULTS) PARTITION BY RANGE (updated_at)''')
+    cursor.execute(f'CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {TABLE} DEFAULT')
+    cursor.execute(f'SELECT min(updated_at) FROM {TABLE}_unpartitioned')
+    month = month_start(cursor.fetchone()[0] or timezone.now())
+    last_month = add_months(month_start(timezone.now()), MONTHS_AHEAD)
+    while month <= last_month:
+        cursor.execute(f'''
+            CREATE TABLE {TABLE}_y{month.year}m{month.month:02d} PARTITION OF {TABLE}
+            FOR VALUES FROM (%s) TO (%s)''', [month, add_months(month, 1)])
+        month = add_months(month, 1)
+
+    cursor.execute(f'INSERT INTO {TABLE} SELECT * FROM {TABLE}_unpartitioned')
+    cursor.execute(f'ALTER SEQUENCE {TABLE}_id_seq OWNED BY {TABLE}.id')
+    cursor.execute(f'DROP TABLE {TABLE}_unpartitioned')
+    add_constraints(cursor, 'id, updated_at')
+
+
+def unpartition_table(cursor):
+    """
+    Convert the partitioned table back into a plain one, copying all values.
+    """
+    cursor.execute(f'ALTER TABLE {TABLE} RENAME TO {TABLE}_partitioned')
+    cursor.execute(f'CREATE TABLE {TABLE} (LIKE {TABLE}_partitioned INCLUDING DEFAULTS)')
+    cursor.execute(f'INSERT INTO {TABLE} SELECT * FROM {TABLE}_partitioned')
+    cursor.execute(f'ALTER SEQUENCE {TABLE}_id_seq OWNED BY {TABLE}.id')
+    cursor.execute(f'DROP TABLE {TABLE}_partitioned CASCADE')
+    add_constraints(cursor, 'id')
+
+
+def forwards(apps, schema_editor):
+    # Opt-in and PostgreSQL only; on other setups the table is left as it is
+    if not settings.PARTITION_SENSOR_VALUES or schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        partition_table(cursor)
+
+
+def backwards(apps, schema_editor):
+    if not is_partitioned(schema_editor.connection):
+        return
+    with schema_editor.connection.cursor() as cursor:
+        unpartition_table(cursor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0032_apartmentsensorvalue_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards),
+    ]
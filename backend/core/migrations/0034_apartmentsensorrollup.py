@@ -0,0 +1,37 @@
+# Generated by Django 2.2.8 on 2026-10-18 12:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0033_partition_apartmentsensorvalue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='service',
+            name='history_resolution',
+            field=models.CharField(blank=True, choices=[('hour', 'Hour'), ('day', 'Day')], help_text='Submit the history of new subscriptions as hourly or daily aggregates instead of every stored value. Only complete periods are submitted.', max_length=4),
+        ),
+        migrations.CreateModel(
+            name='ApartmentSensorRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=4)),
+                ('period_start', models.DateTimeField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('min', models.DecimalField(decimal_places=1, max_digits=8)),
+                ('max', models.DecimalField(decimal_places=1, max_digits=8)),
+                ('sum', models.DecimalField(decimal_places=1, max_digits=16)),
+                ('last', models.DecimalField(decimal_places=1, max_digits=8)),
+                ('last_at', models.DateTimeField()),
+                ('apartment_sensor_attribute', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='core.ApartmentSensorAttribute')),
+            ],
+            options={
+                'unique_together': {('apartment_sensor_attribute', 'resolution', 'period_start')},
+            },
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 2.2.8 on 2026-10-18 13:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0035_dataversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='service',
+            name='alerted_at',
+            field=models.DateTimeField(editable=False, help_text='When admins were last alerted of an outage', null=True),
+        ),
+        migrations.AddField(
+            model_name='service',
+            name='circuit_open_until',
+            field=models.DateTimeField(editable=False, help_text='No data is submitted to the service until then', null=True),
+        ),
+        migrations.AddField(
+            model_name='service',
+            name='consecutive_failures',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Number of failed requests since the last successful one'),
+        ),
+        migrations.CreateModel(
+            name='DeadLetter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('values', models.TextField(help_text='Values serialized for the remote service, as JSON')),
+                ('created_at', models.DateTimeField(help_text='When the values were first queued')),
+                ('failed_at', models.DateTimeField(auto_now_add=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('subscription', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dead_letters', to='core.Subscription')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.8 on 2026-10-18 13:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0036_service_circuit_deadletter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='service',
+            name='data_encoding',
+            field=models.CharField(choices=[('json', 'JSON'), ('json-gzip', 'Gzip-compressed JSON'), ('columnar', 'Columnar JSON'), ('columnar-gzip', 'Gzip-compressed columnar JSON'), ('msgpack', 'Columnar MessagePack')], default='json', help_text='Encoding of the sensor data POSTed to the data URL, see core.utils.payloads', max_length=16),
+        ),
+    ]
@@ -0,0 +1,63 @@
+from decimal import Decimal
+
+from django.db import migrations
+from django.utils import timezone
+
+RESOLUTIONS = ('hour', 'day')
+
+
+def period(resolution, dt):
+    # As ApartmentSensorRollup.period at the time of writing
+    dt = timezone.localtime(dt).replace(minute=0, second=0, microsecond=0)
+    if resolution == 'day':
+        dt = timezone.make_aware(dt.replace(hour=0, tzinfo=None))
+    return dt
+
+
+def forwards(apps, schema_editor):
+    """
+    Roll up the values stored before rollups were maintained, as the `rebuild_rollups` management command does, so
+    that aggregates are available right after upgrading. Skipped if there are rollups already.
+    """
+    ApartmentSensorValue = apps.get_model('core', 'ApartmentSensorValue')  # noqa
+    ApartmentSensorRollup = apps.get_model('core', 'ApartmentSensorRollup')  # noqa
+    if ApartmentSensorRollup.objects.exists():
+        return
+    values = ApartmentSensorValue.objects.filter(apartment_sensor_attribute__isnull=False).order_by(
+        'apartment_sensor_attribute', 'updated_at').values_list('apartment_sensor_attribute_id', 'value', 'updated_at')
+
+    rollups = {}
+    current_attr_id = None
+    for attr_id, value, updated_at in values.iterator(chunk_size=1000):
+        # Values are in attribute order, so the rollups of an attribute are complete when the next one starts
+        if attr_id != current_attr_id:
+            ApartmentSensorRollup.objects.bulk_create(rollups.values(), batch_size=1000)
+            rollups = {}
+            current_attr_id = attr_id
+        value = Decimal(str(value))
+        for resolution in RESOLUTIONS:
+            key = (resolution, period(resolution, updated_at))
+            rollup = rollups.get(key)
+            if rollup is None:
+                rollups[key] = ApartmentSensorRollup(
+                    apartment_sensor_attribute_id=attr_id, resolution=resolution, period_start=key[1], count=1,
+                    min=value, max=value, sum=value, last=value, last_at=updated_at)
+                continue
+            rollup.count += 1
+            rollup.sum += value
+            rollup.min = min(rollup.min, value)
+            rollup.max = max(rollup.max, value)
+            rollup.last = value
+            rollup.last_at = updated_at
+    ApartmentSensorRollup.objects.bulk_create(rollups.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0037_service_data_encoding'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
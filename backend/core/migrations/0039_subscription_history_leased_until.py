@@ -0,0 +1,18 @@
+# Generated by Django 2.2.8 on 2026-10-18 13:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0038_backfill_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscription',
+            name='history_leased_until',
+            field=models.DateTimeField(editable=False, help_text='The history is being submitted by a worker until then', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.8 on 2026-10-18 13:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0039_subscription_history_leased_until'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='delivery',
+            name='leased_until',
+            field=models.DateTimeField(editable=False, help_text='Being submitted by a worker until then', null=True),
+        ),
+    ]
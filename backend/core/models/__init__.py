@@ -1,6 +1,9 @@
 from .user import User
 from .sensor_models import Sensor, SensorAttribute
-from .apartment_sensor_models import Apartment, ApartmentSensor, ApartmentSensorAttribute, ApartmentSensorValue
+from .apartment_sensor_models import (Apartment, ApartmentSensor, ApartmentSensorAttribute, ApartmentSensorValue,
+                                      ApartmentSensorLatestValue, ApartmentSensorRollup)
 from .service import Service
 from .subscription import Subscription
-from .custom_report_service import CustomReportService, CustomReportSubscription
\ No newline at end of file
+from .delivery import DeadLetter, Delivery
+from .custom_report_service import CustomReportService, CustomReportSubscription
+from .data_version import DataVersion
@@ -1,5 +1,14 @@
-from django.db import models
+from collections import OrderedDict
+from datetime import timedelta
+from decimal import Decimal
 
+from django.db import models, transaction
+from django.db.models.functions import TruncMonth, TruncWeek
+from django.utils import timezone
+
+from core import live
+
+from .data_version import DataVersion
 from .user import User
 
 
@@ -33,6 +42,16 @@ class ApartmentSensor(models.Model):
     def list_for_user(cls, user):
         return cls.objects.filter(apartment__user=user)
 
+    @staticmethod
+    def prefetch_attributes(lookup='attributes'):
+        """
+        Return the lookups needed to serialize the attributes of ApartmentSensors reached through `lookup`, along
+        with their latest values, in a single query.
+        """
+        return [
+            models.Prefetch(lookup, queryset=ApartmentSensorAttribute.objects.select_related('attribute', 'latest')),
+        ]
+
 
 class ApartmentSensorAttribute(models.Model):
     """
@@ -47,21 +66,333 @@ class ApartmentSensorAttribute(models.Model):
         return "Sensor {}: {}".format(self.apartment_sensor.identifier, self.attribute)
 
     def latest_value(self):
-        return self.values.order_by('-updated_at').first()
+        try:
+            return self.latest
+        except ApartmentSensorLatestValue.DoesNotExist:
+            return None
 
 
 class ApartmentSensorValue(models.Model):
+    """
+    One measured value of an ApartmentSensorAttribute.
+
+    Values are indexed by (attribute, timestamp), which also serves lookups by attribute alone, and have no default
+    ordering, so that queries only sort when asked to. On PostgreSQL the table can be partitioned by month, see
+    `settings.PARTITION_SENSOR_VALUES`.
+    """
+    # Indexed by the composite index below
     apartment_sensor_attribute = models.ForeignKey(
-        ApartmentSensorAttribute, null=True, on_delete=models.CASCADE, related_name='values')
+        ApartmentSensorAttribute, null=True, on_delete=models.CASCADE, related_name='values', db_index=False)
     value = models.DecimalField(max_digits=8, decimal_places=1)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
-        ordering = ['-updated_at']
+        indexes = [
+            models.Index(fields=['apartment_sensor_attribute', 'updated_at'], name='core_asv_attr_updated_idx'),
+        ]
 
     def __str__(self):
         return f'{self.attribute.description} value for {self.apartment_sensor}: {self.value}'
 
     @classmethod
     def list_for_user(cls, user):
-        return cls.objects.filter(apartment_sensor__apartment__user=user)
\ No newline at end of file
+        return cls.objects.filter(apartment_sensor__apartment__user=user)
+
+
+class ApartmentSensorLatestValue(models.Model):
+    """
+    The latest value of an ApartmentSensorAttribute, kept up to date whenever values are stored so that the current
+    reading can be read without sorting the attribute's whole value history.
+
+    Can be rebuilt from ApartmentSensorValues with the `rebuild_latest_values` management command.
+    """
+    apartment_sensor_attribute = models.OneToOneField(
+        ApartmentSensorAttribute, primary_key=True, on_delete=models.CASCADE, related_name='latest')
+    value = models.DecimalField(max_digits=8, decimal_places=1)
+    updated_at = models.DateTimeField()
+
+    def __str__(self):
+        return f'Latest value for {self.apartment_sensor_attribute}: {self.value}'
+
+    @classmethod
+    def update_from_values(cls, values):
+        """
+        Record the passed ApartmentSensorValues as the latest values of their attributes, unless newer values have
+        already been recorded. Should be called in the transaction that stores the values.
+        """
+        latest = {}
+        for value in values:
+            current = latest.get(value.apartment_sensor_attribute_id)
+            if current is None or value.updated_at >= current.updated_at:
+                latest[value.apartment_sensor_attribute_id] = value
+        if not latest:
+            return
+
+        # Locked in attribute order, as are the rows of the rollups, so that concurrent batches can not deadlock
+        existing = cls.objects.select_for_update().filter(
+            apartment_sensor_attribute__in=latest.keys()).order_by('apartment_sensor_attribute_id')
+        existing = {row.apartment_sensor_attribute_id: row for row in existing}
+        updated = []
+        created = []
+        for attr_id, value in latest.items():
+            row = existing.get(attr_id)
+            if row is None:
+                created.append(cls(
+                    apartment_sensor_attribute_id=attr_id, value=value.value, updated_at=value.updated_at))
+            elif value.updated_at >= row.updated_at:
+                row.value = value.value
+                row.updated_at = value.updated_at
+                updated.append(row)
+        cls.objects.bulk_update(updated, ['value', 'updated_at'])
+        cls.objects.bulk_create(created, ignore_conflicts=True)
+        if created:
+            created = cls._update_raced(created)
+        if updated or created:
+            users = DataVersion.bump_values([row.apartment_sensor_attribute_id for row in updated + created])
+            live.publish_values(users, updated + created)
+
+    @classmethod
+    def _update_raced(cls, created):
+        """
+        Return the rows of `created` that are now recorded. Rows that another transaction inserted first were ignored
+        by bulk_create, so they are updated now unless the other transaction recorded a newer value.
+        """
+        rows = cls.objects.select_for_update().filter(
+            apartment_sensor_attribute__in=[row.apartment_sensor_attribute_id for row in created],
+        ).order_by('apartment_sensor_attribute_id')
+        rows = {row.apartment_sensor_attribute_id: row for row in rows}
+        recorded = []
+        raced = []
+        for row in created:
+            current = rows[row.apartment_sensor_attribute_id]
+            if current.updated_at < row.updated_at:
+                raced.append(row)
+            elif current.updated_at > row.updated_at:
+                continue
+            recorded.append(row)
+        cls.objects.bulk_update(raced, ['value', 'updated_at'])
+        return recorded
+
+    @classmethod
+    def rebuild(cls, batch_size=1000):
+        """
+        Recreate the latest values of all attributes from the stored ApartmentSensorValues. The latest values of
+        attributes without stored values, e.g. since they have been archived, are kept. The values versions of the
+        users of the recreated attributes are bumped, so that clients do not keep cached values.
+        """
+        newest = ApartmentSensorValue.objects.filter(
+            apartment_sensor_attribute=models.OuterRef('apartment_sensor_attribute')).order_by('-updated_at', '-id')
+        values = ApartmentSensorValue.objects.filter(id=models.Subquery(newest.values('id')[:1])).order_by()
+        values = values.values_list('apartment_sensor_attribute_id', 'value', 'updated_at')
+
+        with transaction.atomic():
+            cls.objects.filter(apartment_sensor_attribute__in=ApartmentSensorValue.objects.values(
+                'apartment_sensor_attribute')).delete()
+            batch = []
+            for attr_id, value, updated_at in values.iterator(chunk_size=batch_size):
+                batch.append(cls(apartment_sensor_attribute_id=attr_id, value=value, updated_at=updated_at))
+                if len(batch) == batch_size:
+                    cls.objects.bulk_create(batch)
+                    batch = []
+            cls.objects.bulk_create(batch)
+            DataVersion.bump_values(ApartmentSensorValue.objects.values('apartment_sensor_attribute'))
+        return cls.objects.count()
+
+
+class ApartmentSensorRollup(models.Model):
+    """
+    Count, minimum, maximum, sum and last of the values of an ApartmentSensorAttribute within one hour or one day.
+
+    Rollups are updated whenever values are stored, so that aggregates and history over long periods can be read
+    without scanning the raw values. They can be rebuilt with the `rebuild_rollups` management command.
+    """
+    HOUR = 'hour'
+    DAY = 'day'
+    RESOLUTIONS = ((HOUR, 'Hour'), (DAY, 'Day'))
+    # Buckets of history and their approximate lengths; weeks and months are aggregated from daily rollups
+    BUCKETS = OrderedDict([
+        (HOUR, timedelta(hours=1)),
+        (DAY, timedelta(days=1)),
+        ('week', timedelta(weeks=1)),
+        ('month', timedelta(days=31)),
+    ])
+
+    apartment_sensor_attribute = models.ForeignKey(
+        ApartmentSensorAttribute, on_delete=models.CASCADE, related_name='rollups')
+    resolution = models.CharField(max_length=4, choices=RESOLUTIONS)
+    period_start = models.DateTimeField()
+    count = models.PositiveIntegerField(default=0)
+    min = models.DecimalField(max_digits=8, decimal_places=1)
+    max = models.DecimalField(max_digits=8, decimal_places=1)
+    sum = models.DecimalField(max_digits=16, decimal_places=1)
+    last = models.DecimalField(max_digits=8, decimal_places=1)
+    last_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('apartment_sensor_attribute', 'resolution', 'period_start')
+
+    def __str__(self):
+        return f'{self.get_resolution_display()} {self.period_start} for {self.apartment_sensor_attribute_id}'
+
+    @property
+    def avg(self):
+        return self.sum / self.count if self.count else None
+
+    @classmethod
+    def bucket_for(cls, start, end, max_points):
+        """
+        Return the smallest bucket that divides the period from `start` to `end` into at most `max_points` buckets.
+        """
+        for bucket, length in cls.BUCKETS.items():
+            if (end - start) / length <= max_points:
+                return bucket
+        return next(reversed(cls.BUCKETS))
+
+    @classmethod
+    def history(cls, attr_id, bucket, start, end):
+        """
+        Return (bucket start, count, min, max, sum) tuples of the values of an ApartmentSensorAttribute between
+        `start` and `end` in buckets of `bucket`, in time order. Hourly and daily buckets are read from the rollups
+        as they are, weekly and monthly buckets are aggregated from the daily rollups by the database.
+        """
+        resolution = cls.HOUR if bucket == cls.HOUR else cls.DAY
+        rollups = cls.objects.filter(
+            apartment_sensor_attribute=attr_id, resolution=resolution,
+            period_start__gte=cls.period(resolution, start), period_start__lt=end)
+        if bucket in (cls.HOUR, cls.DAY):
+            return rollups.order_by('period_start').values_list('period_start', 'count', 'min', 'max', 'sum')
+
+        trunc = {'week': TruncWeek, 'month': TruncMonth}[bucket]
+        return (rollups
+                .annotate(bucket=trunc('period_start'))
+                .values('bucket')
+                .annotate(total_count=models.Sum('count'), total_min=models.Min('min'),
+                          total_max=models.Max('max'), total_sum=models.Sum('sum'))
+                .order_by('bucket')
+                .values_list('bucket', 'total_count', 'total_min', 'total_max', 'total_sum'))
+
+    @classmethod
+    def period(cls, resolution, dt):
+        """
+        Return the start of the period of `resolution` that `dt` falls in, in the current time zone.
+        """
+        dt = timezone.localtime(dt).replace(minute=0, second=0, microsecond=0)
+        if resolution == cls.DAY:
+            dt = timezone.make_aware(dt.replace(hour=0, tzinfo=None))
+        return dt
+
+    @classmethod
+    def period_end(cls, resolution, period_start):
+        if resolution == cls.DAY:
+            return cls.period(cls.DAY, period_start + timedelta(hours=36))
+        return period_start + timedelta(hours=1)
+
+    def add(self, value, updated_at):
+        """
+        Include a value in this rollup.
+        """
+        if not self.count:
+            self.min = self.max = self.last = value
+            self.sum = Decimal(0)
+            self.last_at = updated_at
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if updated_at >= self.last_at:
+            self.last = value
+            self.last_at = updated_at
+
+    def merge(self, other):
+        """
+        Include the values of another rollup of the same period in this rollup.
+        """
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        if other.last_at >= self.last_at:
+            self.last = other.last
+            self.last_at = other.last_at
+
+    @classmethod
+    def _collect(cls, rows):
+        """
+        Return new rollups of both resolutions for (attribute id, value, updated_at) tuples, keyed by
+        (attribute id, resolution, period start).
+        """
+        rollups = {}
+        for attr_id, value, updated_at in rows:
+            value = Decimal(str(value))
+            for resolution, _ in cls.RESOLUTIONS:
+                key = (attr_id, resolution, cls.period(resolution, updated_at))
+                rollup = rollups.get(key)
+                if rollup is None:
+                    rollup = rollups[key] = cls(
+                        apartment_sensor_attribute_id=attr_id, resolution=resolution, period_start=key[2])
+                rollup.add(value, updated_at)
+        return rollups
+
+    @classmethod
+    def update_from_values(cls, values):
+        """
+        Include the passed ApartmentSensorValues in the rollups of their attributes. Should be called in the
+        transaction that stores the values.
+        """
+        rollups = cls._collect(
+            (value.apartment_sensor_attribute_id, value.value, value.updated_at)
+            for value in values if value.apartment_sensor_attribute_id is not None)
+        if not rollups:
+            return
+
+        # Lock the attributes, so that concurrent updates of their rollups are serialized. In id order, so that
+        # concurrent updates of overlapping attributes cannot deadlock
+        attr_ids = sorted({attr_id for attr_id, _, _ in rollups})
+        list(ApartmentSensorAttribute.objects.select_for_update().filter(id__in=attr_ids).order_by('id')
+             .values_list('id'))
+
+        existing = cls.objects.filter(
+            apartment_sensor_attribute__in=attr_ids, period_start__in={key[2] for key in rollups})
+        updated = []
+        for row in existing:
+            new = rollups.pop((row.apartment_sensor_attribute_id, row.resolution, row.period_start), None)
+            if new is not None:
+                row.merge(new)
+                updated.append(row)
+        cls.objects.bulk_update(updated, ['count', 'min', 'max', 'sum', 'last', 'last_at'])
+        cls.objects.bulk_create(rollups.values())
+
+    @classmethod
+    def rebuild(cls, batch_size=1000, since=None):
+        """
+        Recreate all rollups from the stored ApartmentSensorValues, streaming the values in attribute and time order.
+        With `since`, the start of a day, only the rollups from then on are recreated, e.g. to keep the rollups of
+        archived values.
+        """
+        values = ApartmentSensorValue.objects.filter(apartment_sensor_attribute__isnull=False)
+        rollups = cls.objects.all()
+        if since is not None:
+            values = values.filter(updated_at__gte=since)
+            rollups = rollups.filter(period_start__gte=since)
+        values = values.order_by('apartment_sensor_attribute', 'updated_at').values_list(
+            'apartment_sensor_attribute_id', 'value', 'updated_at')
+
+        with transaction.atomic():
+            rollups.delete()
+            count = 0
+            rows = []
+            for row in values.iterator(chunk_size=batch_size):
+                # Flush only between attributes or days, so that every rollup is complete when it is created
+                if len(rows) >= batch_size and (
+                        row[0] != rows[-1][0] or cls.period(cls.DAY, row[2]) != cls.period(cls.DAY, rows[-1][2])):
+                    count += cls._bulk_create(rows, batch_size)
+                    rows = []
+                rows.append(row)
+            count += cls._bulk_create(rows, batch_size)
+        return count
+
+    @classmethod
+    def _bulk_create(cls, rows, batch_size):
+        rollups = cls._collect(rows).values()
+        cls.objects.bulk_create(rollups, batch_size=batch_size)
+        return len(rollups)
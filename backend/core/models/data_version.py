@@ -0,0 +1,62 @@
+from django.db import models
+
+
+class DataVersion(models.Model):
+    """
+    Counter bumped whenever the data behind a polled API response changes, so that the response's ETag can be
+    computed without querying the data itself.
+
+    Keys are either global, like `services`, or scoped to one user, like `values:<user id>`. Keys without a row
+    have version 0.
+    """
+    SERVICES = 'services'  # Services and their requirements
+    STRUCTURE = 'structure'  # Apartments, sensors and their attributes
+    VALUES = 'values:{}'  # Latest values of the user's apartment sensors
+    SUBSCRIPTIONS = 'subscriptions:{}'  # The user's subscriptions
+    ROUTES = 'subscription-routes'  # Subscribed attributes of all subscriptions, and their services
+
+    key = models.CharField(max_length=64, primary_key=True)
+    version = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.key}: {self.version}'
+
+    @classmethod
+    def get_many(cls, keys):
+        """
+        Return a dict of the current versions of `keys` with a single query.
+        """
+        versions = dict.fromkeys(keys, 0)
+        versions.update(cls.objects.filter(key__in=keys).values_list('key', 'version'))
+        return versions
+
+    @classmethod
+    def bump(cls, keys):
+        """
+        Increment the versions of `keys`. Rows are locked until the current transaction ends, so concurrent bumps of
+        the same key are serialized and never lost.
+        """
+        keys = set(keys)
+        if not keys:
+            return
+        # Existing rows, as usual, are incremented with a single query. Otherwise the missing rows are created and
+        # all keys incremented again, so that concurrent first bumps are not lost; bumping some keys twice is harmless
+        versions = cls.objects.filter(key__in=keys)
+        if versions.update(version=models.F('version') + 1) == len(keys):
+            return
+        cls.objects.bulk_create([cls(key=key) for key in keys], ignore_conflicts=True)
+        versions.update(version=models.F('version') + 1)
+
+    @classmethod
+    def bump_values(cls, attr_ids):
+        """
+        Increment the values versions of the users whose apartments have the ApartmentSensorAttributes `attr_ids`,
+        and return a dict of attribute id: user id of the attributes in apartments of users.
+        """
+        from .apartment_sensor_models import ApartmentSensorAttribute
+
+        users = dict(ApartmentSensorAttribute.objects.filter(
+            id__in=attr_ids, apartment_sensor__apartment__user__isnull=False,
+        ).values_list('id', 'apartment_sensor__apartment__user_id'))
+        cls.bump(cls.VALUES.format(user_id) for user_id in set(users.values()))
+        return users
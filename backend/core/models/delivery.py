@@ -0,0 +1,220 @@
+import json
+import logging
+from collections import OrderedDict
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.db import models, transaction
+from django.utils import timezone
+from requests import RequestException
+
+from core.utils.fanout import fan_out
+
+from .service import Service
+
+log = logging.getLogger(__name__)
+
+
+class Delivery(models.Model):
+    """
+    Sensor values waiting to be submitted to the service of a subscription.
+
+    Serves as a transactional outbox: new values are queued in the same transaction that stores them and the
+    `process_deliveries` management command submits them, so ingesting data never waits for external services.
+    Failed submissions are retried with exponential backoff, and moved to the DeadLetter table after
+    `settings.DELIVERY_MAX_ATTEMPTS` attempts. Deliveries for services whose circuit is open are not attempted.
+    """
+    subscription = models.ForeignKey('Subscription', on_delete=models.CASCADE, related_name='deliveries')
+    values = models.TextField(help_text='Values serialized for the remote service, as JSON')
+    created_at = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now, db_index=True)
+    last_error = models.TextField(blank=True)
+    leased_until = models.DateTimeField(null=True, editable=False, help_text='Being submitted by a worker until then')
+
+    class Meta:
+        verbose_name_plural = 'Deliveries'
+
+    def __str__(self):
+        return f'Delivery {self.id} for {self.subscription}'
+
+    def backoff(self):
+        seconds = settings.DELIVERY_RETRY_BACKOFF * 2 ** (self.attempts - 1)
+        return timedelta(seconds=min(seconds, settings.DELIVERY_RETRY_MAX_BACKOFF))
+
+    def failed(self, error):
+        """
+        Schedule a retry after a failed attempt, or move the delivery to the dead letters after the last attempt.
+        """
+        self.attempts += 1
+        self.last_error = str(error)
+        log.warning(f'Delivery {self.id} failed (attempt {self.attempts}): {error}')
+        if self.attempts >= settings.DELIVERY_MAX_ATTEMPTS:
+            DeadLetter.objects.create(
+                subscription_id=self.subscription_id, values=self.values, created_at=self.created_at,
+                attempts=self.attempts, last_error=self.last_error)
+            self.delete()
+            return
+        self.next_attempt_at = timezone.now() + self.backoff()
+        self.leased_until = None
+        self.save()
+
+    def send(self):
+        """
+        Submit the values to the remote service.
+        """
+        self.subscription.send_serialized_values(json.loads(self.values))
+
+    @staticmethod
+    def send_batch(deliveries):
+        """
+        Submit deliveries for subscriptions of the same batching service in one request.
+        """
+        service = deliveries[0].subscription.service
+        batch = [(delivery.subscription, json.loads(delivery.values)) for delivery in deliveries]
+        deliveries[0].subscription.send_serialized_batch(service, batch)
+
+    @classmethod
+    def attempt(cls, deliveries):
+        """
+        Submit the passed deliveries, delete the ones that were successfully submitted and schedule retries for the
+        rest. Deliveries for different services are submitted concurrently, outside of any transaction, and the
+        results are recorded in a transaction of their own.
+        """
+        by_service = OrderedDict()
+        for delivery in deliveries:
+            by_service.setdefault(delivery.subscription.service, []).append(delivery)
+
+        jobs = []
+        for service, group in by_service.items():
+            if not service.batch_window:
+                jobs += [(service.id, [delivery], delivery.send) for delivery in group]
+                continue
+            batch_size = max(service.batch_size, 1)
+            for i in range(0, len(group), batch_size):
+                batch = group[i:i + batch_size]
+                jobs.append((service.id, batch, partial(cls.send_batch, batch)))
+
+        errors = fan_out([(key, send) for key, _, send in jobs])
+
+        delivered = []
+        service_errors = OrderedDict((service, None) for service in by_service)
+        with transaction.atomic():
+            for (_, batch, _), error in zip(jobs, errors):
+                if error is None:
+                    delivered += [delivery.id for delivery in batch]
+                    continue
+                if not isinstance(error, RequestException):
+                    log.error('Unexpected error submitting deliveries', exc_info=error)
+                service_errors[batch[0].subscription.service] = error
+                for delivery in batch:
+                    delivery.failed(error)
+            cls.objects.filter(id__in=delivered).delete()
+            record_results(service_errors)
+
+    @classmethod
+    def pending(cls, now):
+        """
+        Return the deliveries not claimed by a worker, locked with SKIP LOCKED where the database supports it.
+        """
+        return (cls.objects
+                .select_for_update(skip_locked=True, of=('self',))
+                .exclude(leased_until__gt=now)
+                .select_related('subscription__service')
+                .order_by('id'))
+
+    @classmethod
+    def process_pending(cls, limit=100):
+        """
+        Attempt up to `limit` deliveries that are due and return the number attempted.
+
+        Deliveries for services with a batch window become due once the window has passed, or as soon as the
+        service has a full batch queued, and are submitted together with any newer deliveries for the same service.
+
+        Deliveries are claimed in a short transaction, with rows locked with SKIP LOCKED where the database supports
+        it, by leasing them for `settings.DELIVERY_LEASE` seconds, so several workers can drain the queue
+        concurrently without holding a transaction open while the services respond. Deliveries of a worker that
+        dies while submitting them are attempted again once their lease expires.
+        """
+        now = timezone.now()
+        available = Service.available('subscription__service__', now)
+        full_services = (
+            cls.objects
+            .filter(available, attempts=0, subscription__service__batch_window__gt=0)
+            .exclude(leased_until__gt=now)
+            .values('subscription__service')
+            .annotate(queued=models.Count('id'))
+            .filter(queued__gte=models.F('subscription__service__batch_size'))
+            .values('subscription__service'))
+
+        with transaction.atomic():
+            deliveries = list(cls.pending(now).filter(available).filter(
+                models.Q(next_attempt_at__lte=now) |
+                models.Q(attempts=0, subscription__service__in=full_services))[:limit])
+
+            # Coalesce newer deliveries for batching services that are still within the batch window
+            queued = {}
+            for delivery in deliveries:
+                service = delivery.subscription.service
+                if service.batch_window:
+                    queued[service] = queued.get(service, 0) + 1
+            for service, count in queued.items():
+                deliveries += list(cls.pending(now).filter(attempts=0, subscription__service=service).exclude(
+                    id__in=[delivery.id for delivery in deliveries])[:max(service.batch_size - count, 0)])
+
+            leased_until = now + timedelta(seconds=settings.DELIVERY_LEASE)
+            cls.objects.filter(id__in=[delivery.id for delivery in deliveries]).update(leased_until=leased_until)
+
+        if deliveries:
+            cls.attempt(deliveries)
+        return len(deliveries)
+
+
+def record_results(service_errors):
+    """
+    Record the result of submitting data to every service of the `service_errors` dict of Service: the error
+    of a failed request, or None.
+    """
+    for service, error in service_errors.items():
+        if error is None:
+            service.record_success()
+        else:
+            service.record_failure(error)
+
+
+class DeadLetter(models.Model):
+    """
+    Sensor values that could not be submitted to the service of a subscription in `settings.DELIVERY_MAX_ATTEMPTS`
+    attempts. They are resent with the `replay_dead_letters` management command once the service has recovered.
+    """
+    subscription = models.ForeignKey('Subscription', on_delete=models.CASCADE, related_name='dead_letters')
+    values = models.TextField(help_text='Values serialized for the remote service, as JSON')
+    created_at = models.DateTimeField(help_text='When the values were first queued')
+    failed_at = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f'Dead letter {self.id} for {self.subscription}'
+
+    @classmethod
+    def replay(cls, dead_letters, batch_size=1000):
+        """
+        Queue the `dead_letters` queryset as new Deliveries, due immediately, and close the circuits of their
+        services. Returns the number of dead letters queued.
+        """
+        count = 0
+        while True:
+            with transaction.atomic():
+                batch = list(dead_letters.select_for_update(skip_locked=True, of=('self',)).order_by('id')[:batch_size])
+                if not batch:
+                    break
+                Delivery.objects.bulk_create([
+                    Delivery(subscription_id=dead_letter.subscription_id, values=dead_letter.values)
+                    for dead_letter in batch])
+                cls.objects.filter(id__in=[dead_letter.id for dead_letter in batch]).delete()
+                Service.objects.filter(subscriptions__in={dead_letter.subscription_id for dead_letter in batch}).update(
+                    consecutive_failures=0, circuit_open_until=None)
+            count += len(batch)
+        return count
@@ -1,6 +1,18 @@
 import uuid
-from django.db import models
+from datetime import timedelta
+from functools import partial
 
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.mail import mail_admins
+from django.db import models, transaction
+from django.utils import timezone
+
+from core.utils import payloads
+
+from .apartment_sensor_models import ApartmentSensorRollup
+from .data_version import DataVersion
 from .sensor_models import SensorAttribute
 
 
@@ -30,13 +42,124 @@ class Service(models.Model):
         default='',
         help_text='URL that renders a compact subscription report for inclusion as iframe in user home view')
 
+    batch_window = models.PositiveIntegerField(
+        default=0,
+        help_text='Seconds to collect new data for this service before submitting it in one combined request. '
+                  'With 0 data is submitted separately for every subscription as it arrives.')
+    batch_size = models.PositiveIntegerField(
+        default=100,
+        help_text='Maximum number of queued deliveries combined into one request. A full batch is submitted '
+                  'without waiting for the batch window to pass.')
+
+    data_encoding = models.CharField(
+        max_length=16, choices=payloads.ENCODINGS, default=payloads.JSON,
+        help_text='Encoding of the sensor data POSTed to the data URL, see core.utils.payloads')
+    history_resolution = models.CharField(
+        max_length=4, blank=True, choices=ApartmentSensorRollup.RESOLUTIONS,
+        help_text='Submit the history of new subscriptions as hourly or daily aggregates instead of every stored '
+                  'value. Only complete periods are submitted.')
+
     auth_token = models.UUIDField(
         default=uuid.uuid4,
         help_text='Token that SenseHel will include in all outgoing POST requests as authentication')
 
+    consecutive_failures = models.PositiveIntegerField(
+        default=0, editable=False, help_text='Number of failed requests since the last successful one')
+    circuit_open_until = models.DateTimeField(
+        null=True, editable=False, help_text='No data is submitted to the service until then')
+    alerted_at = models.DateTimeField(null=True, editable=False, help_text='When admins were last alerted of an outage')
+
     def __str__(self):
         return self.name
 
+    def clean(self):
+        try:
+            payloads.check_encoding(self.data_encoding)
+        except ImproperlyConfigured as err:
+            raise ValidationError({'data_encoding': str(err)})
+
+    def is_available(self, now=None):
+        """
+        Return whether data may be submitted to the service, i.e. its circuit is not open.
+        """
+        return self.circuit_open_until is None or self.circuit_open_until <= (now or timezone.now())
+
+    @staticmethod
+    def available(lookup='', now=None):
+        """
+        Return a Q object matching services whose circuit is not open, or objects related to them through `lookup`,
+        e.g. 'subscription__service__'.
+        """
+        return (models.Q(**{f'{lookup}circuit_open_until__isnull': True}) |
+                models.Q(**{f'{lookup}circuit_open_until__lte': now or timezone.now()}))
+
+    def record_success(self):
+        if self.consecutive_failures or self.circuit_open_until:
+            self.consecutive_failures = 0
+            self.circuit_open_until = None
+            # Updated without saving, so that the change does not invalidate what depends on services
+            Service.objects.filter(id=self.id).update(consecutive_failures=0, circuit_open_until=None)
+
+    def record_failure(self, error):
+        """
+        Count a failed request. After `settings.SERVICE_CIRCUIT_THRESHOLD` consecutive failures the circuit of the
+        service is opened, so that no data is submitted to it for a backoff that doubles with every further failure,
+        and admins are alerted at most once per `settings.SERVICE_ALERT_INTERVAL`.
+        """
+        now = timezone.now()
+        # Incremented in the database, so that failures counted concurrently by other workers are not lost
+        Service.objects.filter(id=self.id).update(consecutive_failures=models.F('consecutive_failures') + 1)
+        self.refresh_from_db(fields=['consecutive_failures'])
+        excess = self.consecutive_failures - settings.SERVICE_CIRCUIT_THRESHOLD
+        if excess >= 0:
+            seconds = min(settings.DELIVERY_RETRY_BACKOFF * 2 ** excess, settings.DELIVERY_RETRY_MAX_BACKOFF)
+            self.circuit_open_until = now + timedelta(seconds=seconds)
+            Service.objects.filter(id=self.id).update(circuit_open_until=self.circuit_open_until)
+            self.alert(error, now)
+
+    def alert(self, error, now):
+        # Claim the alert with a conditional update, so that concurrent workers send it only once
+        last_allowed = now - timedelta(seconds=settings.SERVICE_ALERT_INTERVAL)
+        claimed = Service.objects.filter(
+            models.Q(alerted_at__isnull=True) | models.Q(alerted_at__lte=last_allowed), id=self.id,
+        ).update(alerted_at=now)
+        if claimed:
+            self.alerted_at = now
+            # Sent once the results are recorded, so that a slow mail server never holds their transaction open
+            transaction.on_commit(partial(
+                mail_admins,
+                f'Sensehel service error: {self}',
+                f'Submitting data to {self} failed {self.consecutive_failures} times in a row, last with: {error}\n\n'
+                f'Data is kept and submitted once the service recovers. Data that could not be submitted in '
+                f'{settings.DELIVERY_MAX_ATTEMPTS} attempts can be resent with the `replay_dead_letters` '
+                f'management command.',
+                fail_silently=True))
+
+    # Data versions the available services depend on: sensors, apartments and service requirements
+    AVAILABLE_VERSION_KEYS = (DataVersion.SERVICES, DataVersion.STRUCTURE)
+
     @classmethod
-    def list_available_for_user(cls, user):
-        return cls.objects.filter(requires__sensors__apartmentsensor__apartment__user=user).distinct()
\ No newline at end of file
+    def list_available_for_user(cls, user, versions=None):
+        return cls.objects.filter(id__in=cls.available_ids_for_user(user, versions))
+
+    @classmethod
+    def available_ids_for_user(cls, user, versions=None):
+        """
+        Return the ids of the services the user's sensors make available, cached for
+        `settings.AVAILABLE_SERVICES_CACHE_TIMEOUT` seconds under the DataVersions of AVAILABLE_VERSION_KEYS. Pass
+        `versions` if already read in the same transaction, e.g. for an ETag.
+
+        Entries are keyed on the versions stored in the database rather than invalidated, so that the cache of every
+        process sees changes made in any process, even when the cache is not shared. Ids are cached once the current
+        transaction commits, so that rolled back data is never cached.
+        """
+        if versions is None:
+            versions = DataVersion.get_many(cls.AVAILABLE_VERSION_KEYS)
+        version = ':'.join(str(versions[key]) for key in cls.AVAILABLE_VERSION_KEYS)
+        key = f'available-services:{version}:{user.id}'
+        ids = cache.get(key)
+        if ids is None:
+            ids = set(cls.objects.filter(
+                requires__sensors__apartmentsensor__apartment__user=user).values_list('id', flat=True))
+            transaction.on_commit(lambda: cache.set(key, ids, settings.AVAILABLE_SERVICES_CACHE_TIMEOUT))
+        return ids
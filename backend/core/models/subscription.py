@@ -1,15 +1,34 @@
-import requests
+import decimal
+import json
+import logging
 import uuid
-from django.core.mail import mail_admins
-from django.db import models
+from collections import OrderedDict
+from datetime import timedelta
+from functools import partial
+from django.conf import settings
+from django.db import models, transaction
 from django.utils import timezone
-from requests import HTTPError
+from requests import RequestException
 from rest_framework import serializers
+from rest_framework.settings import api_settings
 
-from .apartment_sensor_models import ApartmentSensorAttribute, ApartmentSensorValue
+from core.utils import http, metrics, payloads
+from core.utils.cache import LRUCache
+from core.utils.fanout import fan_out
+
+from .apartment_sensor_models import ApartmentSensorAttribute, ApartmentSensorRollup, ApartmentSensorValue
+from .data_version import DataVersion
+from .delivery import Delivery, record_results
 from .service import Service
 from .user import User
 
+log = logging.getLogger(__name__)
+
+# ApartmentSensorAttribute id: tuple of the Subscriptions to it, with their Services, for routing new values without
+# queries. Valid for the version of DataVersion.ROUTES in `_routes_version`, see `Subscription.routes`.
+_routes = LRUCache(settings.INGEST_CACHE_SIZE, settings.INGEST_CACHE_TTL)
+_routes_version = None
+
 
 class Subscription(models.Model):
     """
@@ -22,13 +41,21 @@ class Subscription(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     registered = models.DateTimeField(null=True, editable=False)
+    history_until = models.PositiveIntegerField(
+        null=True, editable=False,
+        help_text='Id of the newest value to submit as history; null when no history submission is pending')
+    history_cursor = models.PositiveIntegerField(
+        default=0, editable=False, help_text='Id of the last value submitted as history')
+    history_leased_until = models.DateTimeField(
+        null=True, editable=False, help_text='The history is being submitted by a worker until then')
 
     def __str__(self):
         return f'User {self.user} subscription for {self.service}'
 
     def _post(self, *args, **kwargs):
         # Defined here in order to be easily mockable for testing.
-        return requests.post(*args, **kwargs)
+        with metrics.service_call():
+            return http.post(*args, **kwargs)
 
     def create_in_service(self):
         """
@@ -48,37 +75,257 @@ class Subscription(models.Model):
         response = self._post(self.service.unsubscribe_url, json=data)
         response.raise_for_status()  # Raises exception if status code >=400
 
-    def send_values(self, values):
+    def send_serialized_values(self, values):
         """
-        Send the passed values to the external service.
+        Send values already serialized with ApartmentSensorValueSerializer to the external service.
         """
         data = SubscriptionDataSerializer(self, values=values).data
-        response = self._post(self.service.data_url, json=data)
+        response = self._post(self.service.data_url, **payloads.encode(data, self.service.data_encoding))
         response.raise_for_status()  # Raises exception if status code >=400
 
-    def submit_history(self):
+    @classmethod
+    def send_serialized_batch(cls, service, batch):
+        """
+        Send values for several subscriptions of the same service in one request. `batch` is a list of
+        (subscription, values) tuples, with values serialized with ApartmentSensorValueSerializer.
+        """
+        data = ServiceDataSerializer(service, batch=batch).data
+        response = batch[0][0]._post(service.data_url, **payloads.encode(data, service.data_encoding))
+        response.raise_for_status()  # Raises exception if status code >=400
+
+    def request_history(self):
+        """
+        Schedule existing data values for the ApartmentSensorAttributes connected to this subscription to be sent
+        to the external service by the `process_deliveries` worker. Intended to provide new subscriptions with any
+        already collected data.
+        """
+        latest = self.list_history().order_by('-id').values_list('id', flat=True).first()
+        if latest:
+            self.history_until = latest
+            self.history_cursor = 0
+            self.save(update_fields=['history_until', 'history_cursor'])
+
+    def claim_history(self, now=None):
+        """
+        Lease the pending history submission of this subscription for `settings.HISTORY_LEASE` seconds and return
+        whether it was claimed, i.e. is pending and not being submitted by another worker. A worker that dies
+        while submitting leaves the lease to expire, after which another worker resumes the submission.
+        """
+        now = now or timezone.now()
+        claimed = Subscription.objects.filter(
+            models.Q(history_leased_until__isnull=True) | models.Q(history_leased_until__lte=now),
+            id=self.id, history_until__isnull=False,
+        ).update(history_leased_until=now + timedelta(seconds=settings.HISTORY_LEASE))
+        if claimed:
+            self.refresh_from_db(fields=['history_until', 'history_cursor', 'history_leased_until'])
+        return bool(claimed)
+
+    def release_history(self):
+        Subscription.objects.filter(id=self.id).update(history_leased_until=None)
+        self.history_leased_until = None
+
+    def submit_history(self, max_pages=None):
+        """
+        Send the requested history to the external service in pages of `settings.HISTORY_PAGE_SIZE` values, or of
+        rollups if the service has a history resolution. Should be called with the history claimed and outside of
+        transactions.
+
+        Every page is read, sent and recorded as sent on its own, so memory use does not depend on the size of the
+        history, no transaction is held open while waiting for the service, and an interrupted submission resumes
+        after the last page sent. Returns the number of pages sent; stops after `max_pages` pages if given.
+        """
+        if self.history_until is None:
+            return 0
+
+        page_size = settings.HISTORY_PAGE_SIZE
+        values = self.list_history().filter(id__lte=self.history_until).order_by('id')
+        if not self.service.history_resolution:
+            # Values are read as (id, *VALUE_COLUMNS) tuples, see serialize_values
+            values = values.values_list('id', *VALUE_COLUMNS)
+
+        pages = 0
+        while True:
+            page = list(values.filter(id__gt=self.history_cursor)[:page_size])
+            if page:
+                self._submit_history_page(page)
+                pages += 1
+            if len(page) < page_size:
+                break
+            if pages == max_pages:
+                return pages
+
+        # Updated without saving, like the cursor, so that progress does not invalidate what depends on subscriptions
+        self.history_until = self.history_leased_until = None
+        Subscription.objects.filter(id=self.id).update(history_until=None, history_leased_until=None)
+        return pages
+
+    def _submit_history_page(self, page):
+        if self.service.history_resolution:
+            self.send_serialized_values(ApartmentSensorRollupSerializer(page, many=True).data)
+            self.history_cursor = page[-1].id
+        else:
+            self.send_serialized_values(serialize_values(row[1:] for row in page))
+            self.history_cursor = page[-1][0]
+        # Recorded right away and with the lease renewed, so that progress survives an error in a later page
+        self.history_leased_until = timezone.now() + timedelta(seconds=settings.HISTORY_LEASE)
+        Subscription.objects.filter(id=self.id).update(
+            history_cursor=self.history_cursor, history_leased_until=self.history_leased_until)
+
+    @classmethod
+    def process_pending_history(cls, max_pages=10):
         """
-        Send existing data values for the ApartmentSensorAttributes connected to this subscription to the
-        external service. Intended to provide new subscriptions with any already collected data.
+        Send up to `max_pages` pages of history for every subscription with a pending history submission and
+        return the number of pages sent. Subscriptions claimed by another worker, or of services whose circuit is
+        open, are skipped.
         """
-        self.send_values(self.list_values())
+        now = timezone.now()
+        pages = 0
+        pending = cls.objects.filter(
+            Service.available('service__', now), history_until__isnull=False,
+        ).exclude(history_leased_until__gt=now).select_related('service').order_by('id')
+        for subscription in pending:
+            if not subscription.claim_history(now):
+                continue
+            try:
+                pages += subscription.submit_history(max_pages=max_pages)
+            except RequestException as e:
+                log.warning(f'History submission for {subscription} failed: {e}')
+                subscription.service.record_failure(e)
+            finally:
+                subscription.release_history()
+        return pages
 
     def list_values(self):
-        return ApartmentSensorValue.objects.filter(apartment_sensor_attribute__subscriptions=self).distinct()
+        return ApartmentSensorValue.objects.filter(apartment_sensor_attribute__in=self.attributes.all())
+
+    def list_rollups(self, resolution):
+        """
+        Return the rollups of `resolution` for periods that have ended.
+        """
+        return ApartmentSensorRollup.objects.filter(
+            apartment_sensor_attribute__in=self.attributes.all(), resolution=resolution,
+            period_start__lt=ApartmentSensorRollup.period(resolution, timezone.now()))
+
+    def list_history(self):
+        """
+        Return what is submitted as history to the service: rollups of its history resolution, or stored values.
+        """
+        resolution = self.service.history_resolution
+        if resolution:
+            return self.list_rollups(resolution)
+        return self.list_values().only('id', *VALUE_COLUMNS)
+
+    @classmethod
+    def routes(cls, attr_ids):
+        """
+        Return a dict of ApartmentSensorAttribute id: tuple of the Subscriptions to it, with their Services, for the
+        attributes `attr_ids`.
+
+        Subscriptions are cached per process until DataVersion.ROUTES changes, which it does whenever subscribed
+        attributes, subscriptions or services change in any process. Once cached, routing takes only the query
+        reading that version.
+        """
+        global _routes_version
+        if not attr_ids:
+            return {}
+        version = DataVersion.get_many([DataVersion.ROUTES])[DataVersion.ROUTES]
+        if version != _routes_version:
+            _routes.clear()
+            _routes_version = version
+
+        routes = _routes.get_many(attr_ids)
+        missing = set(attr_ids) - routes.keys()
+        if missing:
+            found = {attr_id: [] for attr_id in missing}
+            rows = cls.attributes.through.objects.filter(
+                apartmentsensorattribute__in=missing).select_related('subscription__service')
+            for row in rows:
+                found[row.apartmentsensorattribute_id].append(row.subscription)
+            found = {attr_id: tuple(subscriptions) for attr_id, subscriptions in found.items()}
+            routes.update(found)
+            _routes.set_many_on_commit(found)
+        return routes
 
     @classmethod
     def handle_new_values(cls, new_values):
         """
         For every subscription related to any of the passed values, send the appropriate subset of values to the
-        external service.
+        external service. The values are routed in memory, so they need not have been assigned primary keys (as is
+        the case for values created with `bulk_create` on some databases).
+
+        With `settings.SUBSCRIPTION_OUTBOX` enabled the values are queued as Deliveries for the
+        `process_deliveries` worker. Otherwise they are sent once the current transaction commits, so that values
+        are neither sent twice when storing them is retried nor sent without having been stored.
         """
-        value_ids = [v.id for v in new_values]
-        attr_ids = [v.apartment_sensor_attribute_id for v in new_values]
-        for subscription in cls.objects.filter(attributes__in=attr_ids).distinct():
-            try:
-                subscription.send_values(subscription.list_values().filter(id__in=value_ids))
-            except HTTPError as e:
-                mail_admins(f'Sensehel service error: {subscription.service}', str(e), fail_silently=True)
+        routes = cls.routes({v.apartment_sensor_attribute_id for v in new_values})
+        subscriptions = OrderedDict()
+        for value in new_values:
+            for subscription in routes.get(value.apartment_sensor_attribute_id, ()):
+                subscriptions.setdefault(subscription, []).append(value)
+
+        deliveries = []
+        inline = []
+        for subscription, subscription_values in subscriptions.items():
+            values = serialize_values(
+                (value.apartment_sensor_attribute_id, value.value, value.updated_at) for value in subscription_values)
+            if settings.SUBSCRIPTION_OUTBOX:
+                deliveries.append(Delivery(
+                    subscription=subscription, values=json.dumps(values),
+                    next_attempt_at=timezone.now() + timedelta(seconds=subscription.service.batch_window)))
+            else:
+                inline.append((subscription, values))
+        if inline:
+            transaction.on_commit(partial(cls._send_inline_or_queue, inline))
+        Delivery.objects.bulk_create(deliveries)
+
+    @classmethod
+    def _send_inline_or_queue(cls, inline):
+        # The values have been committed, so errors are not raised to the gateway but the values queued instead
+        try:
+            deliveries = cls._send_inline(inline)
+        except Exception:
+            log.exception('Sending values inline failed, queuing them as deliveries')
+            deliveries = [Delivery(subscription=subscription, values=json.dumps(values))
+                          for subscription, values in inline]
+        Delivery.objects.bulk_create(deliveries)
+
+    @staticmethod
+    def _send_inline(inline):
+        """
+        Send the (subscription, values) tuples of `inline` and return Deliveries for the values that could not be
+        sent, either because the request failed, also with an unexpected error, or because the circuit of the
+        service is open.
+        """
+        # Routed subscriptions are cached, so read the current state of their services
+        services = Service.objects.in_bulk({subscription.service_id for subscription, _ in inline})
+        # Services deleted since the values were stored are skipped along with their subscriptions
+        inline = [(subscription, values) for subscription, values in inline if subscription.service_id in services]
+        now = timezone.now()
+        deliveries = []
+        available = []
+        for subscription, values in inline:
+            if services[subscription.service_id].is_available(now):
+                available.append((subscription, values))
+            else:
+                deliveries.append(Delivery(subscription=subscription, values=json.dumps(values)))
+        inline = available
+
+        # Different services are sent to concurrently
+        errors = fan_out([
+            (subscription.service_id, partial(subscription.send_serialized_values, values))
+            for subscription, values in inline])
+        service_errors = OrderedDict((services[subscription.service_id], None) for subscription, _ in inline)
+        for (subscription, values), error in zip(inline, errors):
+            if error is None:
+                continue
+            if not isinstance(error, RequestException):
+                log.error(f'Unexpected error sending values to {subscription}', exc_info=error)
+            service_errors[services[subscription.service_id]] = error
+            delivery = Delivery(subscription=subscription, values=json.dumps(values), attempts=1, last_error=str(error))
+            delivery.next_attempt_at = now + delivery.backoff()
+            deliveries.append(delivery)
+        record_results(service_errors)
+        return deliveries
 
 
 class SubscriptionSerializer(serializers.ModelSerializer):
@@ -116,7 +363,8 @@ class CreateSubscriptionSerializer(SubscriptionSerializer):
 
 class ApartmentSensorValueSerializer(serializers.ModelSerializer):
     """
-    Serializer used by the Subscription model when submitting values to the remote service.
+    Serializer used by the Subscription model when submitting values to the remote service. New values and history
+    are serialized with the equivalent but faster `serialize_values`, so keep the two in sync.
     """
     attribute = serializers.IntegerField(source='apartment_sensor_attribute_id')
     timestamp = serializers.DateTimeField(source='updated_at')
@@ -126,6 +374,66 @@ class ApartmentSensorValueSerializer(serializers.ModelSerializer):
         fields = ('attribute', 'value', 'timestamp')
 
 
+# Columns of ApartmentSensorValue read for serialize_values, in the order of ApartmentSensorValueSerializer's fields
+VALUE_COLUMNS = ('apartment_sensor_attribute_id', 'value', 'updated_at')
+
+
+def serialize_values(rows):
+    """
+    Return (attribute id, value, updated_at) `rows`, such as `values_list(*VALUE_COLUMNS)` of ApartmentSensorValues,
+    serialized exactly as ApartmentSensorValueSerializer(many=True) serializes the values, but without building
+    model instances or running serializer fields per row.
+
+    Follows the serializer's defaults: values are quantized to the decimal places of the model field and rendered as
+    strings, and timestamps as ISO 8601 in the current time zone.
+    """
+    field = ApartmentSensorValue._meta.get_field('value')
+    places = decimal.Decimal(1).scaleb(-field.decimal_places)
+    context = decimal.getcontext().copy()
+    context.prec = field.max_digits
+    coerce_to_string = api_settings.COERCE_DECIMAL_TO_STRING
+    tz = timezone.get_current_timezone() if settings.USE_TZ else None
+
+    serialized = []
+    for attr_id, value, updated_at in rows:
+        if value is not None:
+            if not isinstance(value, decimal.Decimal):
+                value = decimal.Decimal(str(value).strip())
+            value = value.quantize(places, context=context)
+            if coerce_to_string:
+                value = f'{value:f}'
+        if updated_at:
+            if tz is None:
+                if timezone.is_aware(updated_at):
+                    updated_at = timezone.make_naive(updated_at, timezone.utc)
+            elif timezone.is_aware(updated_at):
+                updated_at = updated_at.astimezone(tz)
+            else:
+                updated_at = timezone.make_aware(updated_at, tz)
+            updated_at = updated_at.isoformat()
+            if updated_at.endswith('+00:00'):
+                updated_at = updated_at[:-6] + 'Z'
+        else:
+            updated_at = None
+        serialized.append({
+            'attribute': None if attr_id is None else int(attr_id), 'value': value, 'timestamp': updated_at})
+    return serialized
+
+
+class ApartmentSensorRollupSerializer(serializers.ModelSerializer):
+    """
+    Serializer used by the Subscription model when submitting history as rollups. The average is included as
+    `value`, so rollups can be read like values.
+    """
+    attribute = serializers.IntegerField(source='apartment_sensor_attribute_id')
+    value = serializers.DecimalField(source='avg', max_digits=8, decimal_places=1)
+    timestamp = serializers.DateTimeField(source='period_start')
+
+    class Meta:
+        model = ApartmentSensorRollup
+        fields = ('attribute', 'value', 'timestamp', 'resolution', 'count', 'min', 'max', 'last')
+
+
 class SubscriptionDataSerializer(SubscriptionSerializer):
     """
     Serializer used by the Subscription model when submitting values to the remote service.
@@ -140,4 +448,28 @@ class SubscriptionDataSerializer(SubscriptionSerializer):
         self._values = values
 
     def get_values(self, subscription):
-        return ApartmentSensorValueSerializer(self._values, many=True).data
+        # Values are serialized with ApartmentSensorValueSerializer by the caller, so that queued deliveries can be
+        # stored in their final form.
+        return self._values
+
+
+class ServiceDataSerializer(serializers.ModelSerializer):
+    """
+    Serializer used when submitting values for several subscriptions of a batching service in one request. Values
+    submitted for the same subscription are combined.
+    """
+    subscriptions = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Service
+        fields = ('subscriptions', 'auth_token')
+
+    def __init__(self, *args, batch=[], **kwargs):
+        super().__init__(*args, **kwargs)
+        self._batch = batch
+
+    def get_subscriptions(self, service):
+        values_by_uuid = OrderedDict()
+        for subscription, values in self._batch:
+            values_by_uuid.setdefault(str(subscription.uuid), []).extend(values)
+        return [{'uuid': uuid, 'values': values} for uuid, values in values_by_uuid.items()]
@@ -0,0 +1,67 @@
+"""
+Signal receivers keeping denormalised data in sync with the models. Connected in CoreConfig.ready().
+"""
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from . import decoders, ingest
+from .models import (Apartment, ApartmentSensor, ApartmentSensorAttribute, ApartmentSensorLatestValue,
+                     ApartmentSensorRollup, ApartmentSensorValue, DataVersion, Sensor, SensorAttribute, Service,
+                     Subscription)
+
+
+@receiver(post_save, sender=ApartmentSensorValue)
+def update_denormalised_values(sender, instance, created=False, raw=False, **kwargs):
+    # Values stored in bulk by core.ingest do not send signals and are recorded there
+    if raw:
+        return
+    ApartmentSensorLatestValue.update_from_values([instance])
+    # Rollups of edited values are corrected with the `rebuild_rollups` management command
+    if created:
+        ApartmentSensorRollup.update_from_values([instance])
+
+
+def clear_ingest_caches(sender, **kwargs):
+    decoders.clear_cache()
+    ingest.clear_caches()
+
+
+for model in (ApartmentSensor, ApartmentSensorAttribute, Sensor, SensorAttribute):
+    post_save.connect(clear_ingest_caches, sender=model)
+    post_delete.connect(clear_ingest_caches, sender=model)
+
+
+def bump_structure_version(sender, **kwargs):
+    DataVersion.bump([DataVersion.STRUCTURE])
+
+
+def bump_services_version(sender, **kwargs):
+    DataVersion.bump([DataVersion.SERVICES])
+
+
+def bump_subscriptions_version(sender, instance, **kwargs):
+    DataVersion.bump([DataVersion.SUBSCRIPTIONS.format(instance.user_id)])
+
+
+for model in (Apartment, ApartmentSensor, ApartmentSensorAttribute, Sensor, SensorAttribute):
+    post_save.connect(bump_structure_version, sender=model)
+    post_delete.connect(bump_structure_version, sender=model)
+m2m_changed.connect(bump_structure_version, sender=Sensor.provides.through)
+# Services show the URIs of the attributes they require
+for model in (Service, SensorAttribute):
+    post_save.connect(bump_services_version, sender=model)
+    post_delete.connect(bump_services_version, sender=model)
+m2m_changed.connect(bump_services_version, sender=Service.requires.through)
+post_save.connect(bump_subscriptions_version, sender=Subscription)
+post_delete.connect(bump_subscriptions_version, sender=Subscription)
+
+
+def bump_routes_version(sender, **kwargs):
+    DataVersion.bump([DataVersion.ROUTES])
+
+
+# Subscriptions are routed by their attributes, which are set after the subscription is created
+m2m_changed.connect(bump_routes_version, sender=Subscription.attributes.through)
+post_delete.connect(bump_routes_version, sender=Subscription)
+post_save.connect(bump_routes_version, sender=Service)
+post_delete.connect(bump_routes_version, sender=Service)
@@ -0,0 +1,129 @@
+import io
+from datetime import timedelta
+from unittest import mock
+
+from django.core.management import call_command
+from django.urls import reverse
+from rest_framework.test import APITestCase
+
+from core.models import (ApartmentSensor, ApartmentSensorAttribute, ApartmentSensorLatestValue, DataVersion, Sensor,
+                         SensorAttribute, User)
+from .data import sensor_data_package
+
+
+class ApartmentTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='Poller')
+        self.apartment = self.user.apartments.create(street='Mannerheimintie 1')
+        self.sensor = Sensor.objects.create(name='Elsys ERS')
+        self.attributes = [
+            SensorAttribute.objects.create(description=description) for description in ('temperature', 'humidity')]
+        self.url = reverse('apartment-list')
+
+    def add_sensor(self, identifier):
+        apsen = self.apartment.apartment_sensors.create(identifier=identifier, sensor=self.sensor)
+        for attr in self.attributes:
+            apsen_attr = apsen.attributes.create(attribute=attr)
+            for value in (20, 21, 22):
+                apsen_attr.values.create(value=value)
+
+    def test_apartments(self):
+        # Given that a user with a sensor in their apartment is logged in
+        self.add_sensor('A1')
+        self.client.force_login(self.user)
+
+        # When requesting the user's apartments
+        response = self.client.get(self.url)
+
+        # Then the apartment is returned with the latest value of each sensor attribute
+        self.assertEqual(200, response.status_code)
+        [apartment] = response.data
+        [apsen] = apartment['apartment_sensors']
+        self.assertEqual(apsen['sensor']['name'], 'Elsys ERS')
+        self.assertEqual([attr['description'] for attr in apsen['attributes']], ['temperature', 'humidity'])
+        self.assertEqual([attr['value'] for attr in apsen['attributes']], [22, 22])
+
+    def test_apartments_query_count(self):
+        # Given that a user with several sensors in their apartment is logged in
+        for identifier in ('A1', 'B2', 'C3'):
+            self.add_sensor(identifier)
+        self.client.force_login(self.user)
+
+        # Then the apartments are serialized with a constant number of queries:
+        # session, user, data versions, apartments, apartment sensors and attributes with their latest values
+        with self.assertNumQueries(6):
+            response = self.client.get(self.url)
+        self.assertEqual(len(response.data[0]['apartment_sensors']), 3)
+
+        # As are the user's apartment sensors
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('apartmentsensor-list'))
+        self.assertEqual(len(response.data), 3)
+
+
+class LatestValueTest(APITestCase):
+    def setUp(self):
+        self.apsen = ApartmentSensor.objects.create(identifier=sensor_data_package['DevEUI_uplink']['DevEUI'])
+
+    def test_latest_value_is_updated_on_ingest(self):
+        # When new data arrives twice for a sensor
+        self.client.post(reverse('digita-gw'), sensor_data_package, format='json')
+        self.client.post(reverse('digita-gw'), sensor_data_package, format='json')
+
+        # Then every attribute records its newest value
+        for apsen_attr in self.apsen.attributes.all():
+            newest = apsen_attr.values.order_by('-updated_at').first()
+            self.assertEqual(apsen_attr.latest_value().value, newest.value)
+            self.assertEqual(apsen_attr.latest_value().updated_at, newest.updated_at)
+
+    def test_older_value_inserted_concurrently_is_replaced(self):
+        # Given an attribute without a latest value, and another transaction that records an older one meanwhile
+        apsen_attr = self.apsen.attributes.create(attribute=SensorAttribute.objects.create(description='co2'))
+        older = apsen_attr.values.create(value=400)
+        newer = apsen_attr.values.create(value=450)
+        newer.updated_at = older.updated_at + timedelta(seconds=1)
+        ApartmentSensorLatestValue.objects.all().delete()
+        bulk_create = ApartmentSensorLatestValue.objects.bulk_create
+
+        def racing_bulk_create(objs, **kwargs):
+            bulk_create([ApartmentSensorLatestValue(
+                apartment_sensor_attribute=apsen_attr, value=older.value, updated_at=older.updated_at)])
+            return bulk_create(objs, **kwargs)
+
+        # When recording the newer value
+        with mock.patch.object(ApartmentSensorLatestValue.objects, 'bulk_create', side_effect=racing_bulk_create):
+            ApartmentSensorLatestValue.update_from_values([newer])
+
+        # Then the newer value wins
+        latest = ApartmentSensorLatestValue.objects.get()
+        self.assertEqual((latest.value, latest.updated_at), (newer.value, newer.updated_at))
+
+    def test_rebuild_latest_values(self):
+        # Given that the latest values have been lost
+        apsen_attr = self.apsen.attributes.create(attribute=SensorAttribute.objects.create(description='co2'))
+        apsen_attr.values.create(value=400)
+        newest = apsen_attr.values.create(value=450)
+        ApartmentSensorLatestValue.objects.all().delete()
+
+        # When rebuilding them
+        call_command('rebuild_latest_values', stdout=io.StringIO())
+
+        # Then the newest value is recorded again
+        apsen_attr = ApartmentSensorAttribute.objects.get()
+        self.assertEqual(apsen_attr.latest_value().value, newest.value)
+
+    def test_rebuild_invalidates_cached_values(self):
+        # Given a user's attribute with stored values
+        user = User.objects.create(username='Cached')
+        self.apsen.apartment = user.apartments.create()
+        self.apsen.save()
+        apsen_attr = self.apsen.attributes.create(attribute=SensorAttribute.objects.create(description='co2'))
+        apsen_attr.values.create(value=400)
+        key = DataVersion.VALUES.format(user.id)
+        version = DataVersion.get_many([key])[key]
+
+        # When rebuilding the latest values
+        call_command('rebuild_latest_values', stdout=io.StringIO())
+
+        # Then the values version of the user changes, so that clients do not keep serving cached values
+        self.assertGreater(DataVersion.get_many([key])[key], version)
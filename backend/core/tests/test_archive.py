@@ -0,0 +1,98 @@
+import csv
+import gzip
+import io
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+from django.core.management import call_command
+from django.test import override_settings
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from core.models import (ApartmentSensor, ApartmentSensorLatestValue, ApartmentSensorRollup, ApartmentSensorValue,
+                         SensorAttribute)
+from core.utils import archive
+
+
+class ArchiveTest(APITestCase):
+    def setUp(self):
+        apsen = ApartmentSensor.objects.create(identifier='A1')
+        self.apsen_attr = apsen.attributes.create(attribute=SensorAttribute.objects.create(description='co2'))
+        self.now = timezone.now()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def add_value(self, value, days_ago):
+        created = self.apsen_attr.values.create(value=value)
+        ApartmentSensorValue.objects.filter(id=created.id).update(updated_at=self.now - timedelta(days=days_ago))
+        return ApartmentSensorValue.objects.get(id=created.id)
+
+    def read_archive(self):
+        """
+        Return the rows of all archive files of the attribute in month order, checking their headers.
+        """
+        rows = []
+        for month in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, month, f'attribute-{self.apsen_attr.id}.csv.gz')
+            with gzip.open(path, 'rt', newline='') as f:
+                header, *month_rows = csv.reader(f)
+            self.assertEqual(header, ['id', 'updated_at', 'value'])
+            rows += month_rows
+        return rows
+
+    def test_expired_values_are_archived(self):
+        # Given values from the past days and from two and three months ago
+        old = [self.add_value(400 + i, 90 - i) for i in range(3)] + [self.add_value(500, 60)]
+        recent = [self.add_value(600, 1), self.add_value(700, 0)]
+        ApartmentSensorRollup.rebuild()
+        rollup_count = ApartmentSensorRollup.objects.count()
+
+        # When archiving values older than 30 days in batches smaller than the number of values
+        call_command('archive_values', '--days=30', f'--archive-dir={self.directory}', '--batch-size=2',
+                     stdout=io.StringIO())
+
+        # Then only the recent values are kept, along with all rollups
+        self.assertEqual(list(self.apsen_attr.values.order_by('id')), recent)
+        self.assertEqual(ApartmentSensorRollup.objects.count(), rollup_count)
+
+        # And the old values are in the archive files of their months, in time order
+        self.assertEqual(self.read_archive(), [
+            [str(value.id), value.updated_at.isoformat(), str(float(value.value))] for value in old])
+
+    def test_archived_values_are_not_archived_again(self):
+        # Given a value that has already been archived
+        old = self.add_value(400, 60)
+        for _ in range(2):
+            list(archive.archive_values(archive.retention_cutoff(30), self.directory))
+
+        # Then it is archived once
+        self.assertEqual(self.read_archive(), [[str(old.id), old.updated_at.isoformat(), '400.0']])
+
+    def test_archiving_keeps_whole_days(self):
+        cutoff = archive.retention_cutoff(30, now=timezone.make_aware(datetime(2020, 3, 15, 12, 30)))
+        self.assertEqual(cutoff, timezone.make_aware(datetime(2020, 2, 14)))
+
+    @override_settings(SENSOR_VALUE_RETENTION_DAYS=None)
+    def test_values_are_kept_without_retention_period(self):
+        self.add_value(400, 3650)
+        call_command('archive_values', f'--archive-dir={self.directory}', stdout=io.StringIO())
+        self.assertEqual(self.apsen_attr.values.count(), 1)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    @override_settings(SENSOR_VALUE_RETENTION_DAYS=30)
+    def test_rebuilding_keeps_archived_rollups_and_latest_values(self):
+        # Given that the values of an attribute have been archived
+        self.add_value(400, 60)
+        ApartmentSensorRollup.rebuild()
+        list(archive.archive_values(archive.retention_cutoff(30), self.directory))
+        rollups = list(ApartmentSensorRollup.objects.values_list('period_start', 'count'))
+
+        # When rebuilding rollups and latest values
+        call_command('rebuild_rollups', stdout=io.StringIO())
+        ApartmentSensorLatestValue.rebuild()
+
+        # Then the rollups and latest value of the archived values are kept
+        self.assertEqual(list(ApartmentSensorRollup.objects.values_list('period_start', 'count')), rollups)
+        self.assertEqual(ApartmentSensorLatestValue.objects.get(apartment_sensor_attribute=self.apsen_attr).value, 400)
@@ -1,5 +1,7 @@
+from django.core.cache import cache
+from django.test import TransactionTestCase
 from django.urls import reverse
-from rest_framework.test import APITestCase
+from rest_framework.test import APIClient, APITestCase
 
 from core.models import SensorAttribute, Service, User, ApartmentSensor
 
@@ -63,3 +65,56 @@ class ServiceTest(APITestCase):
         # And it contains the available service
         self.assertEqual(len(response.data), 1)
         self.assertEqual(response.data[0]['name'], 'Big Brother')
+
+
+class AvailableServicesCacheTest(TransactionTestCase):
+    client_class = APIClient
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='CedrikCached')
+        self.attr = SensorAttribute.objects.create(description='Camera')
+        ApartmentSensor.objects.create(apartment=self.user.apartments.create(), sensor=self.attr.sensors.create())
+        self.service = Service.objects.create(name='Big Brother')
+        self.service.requires.set([self.attr])
+        self.client.force_authenticate(self.user)
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_available_services_are_cached(self):
+        # Given that the available services of a user have been listed
+        self.assertEqual(len(self.client.get(reverse('available-services')).data), 1)
+
+        # Then they are listed again by primary key along with their requirements, without joining the user's sensors
+        # (after reading the data versions for the ETag)
+        with self.assertNumQueries(3) as context:
+            self.assertEqual(len(self.client.get(reverse('available-services')).data), 1)
+        self.assertNotIn('core_apartmentsensor', context.captured_queries[1]['sql'])
+
+    def test_cache_is_invalidated_when_requirements_change(self):
+        # Given that the available services of a user have been listed
+        self.client.get(reverse('available-services'))
+
+        # When the service no longer requires the user's sensors
+        self.service.requires.set([SensorAttribute.objects.create(description='Microphone')])
+
+        # Then it is no longer available
+        self.assertEqual(len(self.client.get(reverse('available-services')).data), 0)
+
+    def test_cache_of_other_process_is_not_stale(self):
+        # Given that the available services of a user have been listed and cached
+        self.client.get(reverse('available-services'))
+        entries, expiry = dict(cache._cache), dict(cache._expire_info)
+
+        # When the service no longer requires the user's sensors, and the cache of another process that is not
+        # notified of the change keeps its entries
+        self.service.requires.set([SensorAttribute.objects.create(description='Microphone')])
+        cache._cache.update(entries)
+        cache._expire_info.update(expiry)
+
+        # Then that process no longer lists the service either, with an ETag that matches the list
+        response = self.client.get(reverse('available-services'))
+        self.assertEqual(len(response.data), 0)
+        response = self.client.get(reverse('available-services'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(304, response.status_code)
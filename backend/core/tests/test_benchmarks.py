@@ -0,0 +1,77 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+from contextlib import nullcontext
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.test import TransactionTestCase
+
+from core import decoders, ingest
+from core.models import ApartmentSensorValue
+from core.utils import benchmark
+
+
+class BenchmarkCommandTest(TransactionTestCase):
+    """
+    Runs the benchmark commands with tiny parameters against the test database instead of a database of their own.
+    The API benchmark requests from several threads, which only see committed data.
+    """
+
+    def setUp(self):
+        decoders.clear_cache()
+        ingest.clear_caches()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        patcher = patch.object(benchmark, 'test_database', nullcontext)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        decoders.clear_cache()
+        ingest.clear_caches()
+
+    def run_benchmark(self, name, *args):
+        output = os.path.join(self.directory, f'{name}.json')
+        call_command(name, *args, f'--output={output}', stdout=io.StringIO())
+        with open(output) as f:
+            return json.load(f)
+
+    def test_benchmark_api(self):
+        # When benchmarking the API with readings every 12 hours for a day
+        data = self.run_benchmark(
+            'benchmark_api', '--apartments=2', '--days=1', '--interval=720', '--services=1', '--clients=2',
+            '--requests=1')
+
+        # Then the readings are stored at their times instead of the time they were inserted
+        times = ApartmentSensorValue.objects.values_list('updated_at', flat=True).distinct()
+        self.assertEqual(len(times), 2)
+        self.assertEqual(data['results']['values'], 2 * 2 * 3 * 2)
+
+        # And every endpoint is measured without failed requests
+        self.assertEqual(data['benchmark'], 'api')
+        for endpoint in ('/api/apartments/', '/api/apartmentsensors/', '/api/subscriptions/'):
+            self.assertEqual(data['results'][endpoint]['count'], 2)
+            self.assertEqual(data['results'][endpoint]['failed_requests'], 0)
+
+    def test_benchmark_ingest(self):
+        # When benchmarking ingest through the outbox
+        data = self.run_benchmark('benchmark_ingest', '--sensors=2', '--uplinks=2', '--batch-size=2')
+
+        # Then all uplinks are accepted and the data of the subscribed sensor is delivered to the stub service
+        self.assertEqual(data['benchmark'], 'ingest')
+        self.assertEqual(data['results']['uplinks'], 4)
+        self.assertEqual(data['results']['failed_requests'], 0)
+        self.assertEqual(data['results']['service_requests'], data['results']['deliveries']['count'])
+        self.assertGreater(data['results']['service_requests'], 0)
+
+    def test_benchmark_payloads(self):
+        # When benchmarking serializing and encoding a push of values
+        data = self.run_benchmark('benchmark_payloads', '--values=10', '--attributes=2')
+
+        # Then the fast path serializes the values as DRF does
+        self.assertEqual(data['benchmark'], 'payloads')
+        self.assertTrue(data['results']['serialize_rows']['identical'])
+        self.assertGreater(data['results']['json']['bytes'], 0)
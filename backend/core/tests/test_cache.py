@@ -0,0 +1,155 @@
+import json
+from unittest import mock
+
+from django.db import connection
+from django.test import SimpleTestCase, TransactionTestCase
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from core import decoders, ingest
+from core.models import ApartmentSensor, ApartmentSensorValue, DataVersion, Delivery, Service, Subscription, User
+from core.utils.cache import LRUCache
+from .test_digita_gw import uplink
+
+
+class LRUCacheTest(SimpleTestCase):
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set_many({'a': 1, 'b': 2})
+        cache.get_many(['a'])
+        cache.set_many({'c': 3})
+        self.assertEqual(cache.get_many(['a', 'b', 'c']), {'a': 1, 'c': 3})
+
+    def test_entries_expire(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+        with mock.patch('time.monotonic', return_value=1000):
+            cache.set_many({'a': 1})
+        with mock.patch('time.monotonic', return_value=1061):
+            self.assertEqual(cache.get_many(['a']), {})
+
+    def test_entries_read_before_clearing_are_not_cached(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+        generation = cache.generation
+        cache.clear()
+        cache.set_many({'a': 1}, generation)
+        self.assertEqual(cache.get_many(['a']), {})
+
+
+class IngestCacheTest(TransactionTestCase):
+    client_class = APIClient
+
+    def setUp(self):
+        decoders.clear_cache()
+        ingest.clear_caches()
+
+    def tearDown(self):
+        decoders.clear_cache()
+        ingest.clear_caches()
+
+    def test_steady_state_ingest_does_not_resolve_sensors(self):
+        # Given that a sensor in a user's apartment has sent data before
+        url = reverse('digita-gw-batch')
+        self.client.post(url, [uplink('A1')], format='json')
+        user = User.objects.create(username='Resident')
+        ApartmentSensor.objects.update(apartment=user.apartments.create())
+        self.client.post(url, [uplink('A1')], format='json')
+
+        # Then its next uplinks only store the values and what is derived from them, with the 9 queries listed in
+        # core.ingest (and BEGIN on SQLite), and no queries for sensors, attributes or subscriptions
+        with self.assertNumQueries(10) as context:
+            self.client.post(url, [uplink('A1')], format='json')
+        self.assertFalse([query for query in context.captured_queries
+                          if 'core_sensorattribute"' in query['sql'] or 'core_subscription' in query['sql']])
+        self.assertEqual(ApartmentSensorValue.objects.count(), 3 * 6)
+
+    def test_created_sensors_bump_structure_version(self):
+        # Given the current versions of the structure and services
+        keys = [DataVersion.STRUCTURE, DataVersion.SERVICES]
+        versions = DataVersion.get_many(keys)
+
+        # When ingest creates a new sensor and its attributes, which sends no post_save signals
+        self.client.post(reverse('digita-gw-batch'), [uplink('A1')], format='json')
+
+        # Then both versions change, so that cached responses listing them are not served
+        new_versions = DataVersion.get_many(keys)
+        self.assertTrue(all(new_versions[key] > versions[key] for key in keys))
+
+        # And the versions do not change once the sensor is known
+        self.client.post(reverse('digita-gw-batch'), [uplink('A1')], format='json')
+        self.assertEqual(DataVersion.get_many(keys), new_versions)
+
+    def test_cache_is_cleared_when_sensors_change(self):
+        # Given that a sensor and its attributes have been resolved and cached
+        url = reverse('digita-gw-batch')
+        self.client.post(url, [uplink('A1')], format='json')
+
+        # When the sensor is deleted
+        ApartmentSensor.objects.get(identifier='A1').delete()
+
+        # Then it is created again by its next uplink
+        self.client.post(url, [uplink('A1')], format='json')
+        self.assertEqual(ApartmentSensor.objects.get(identifier='A1').attributes.count(), 6)
+
+    def test_stale_cache_is_cleared_on_integrity_error(self):
+        # Given cached ids of a sensor deleted by another process, without signals
+        url = reverse('digita-gw-batch')
+        self.client.post(url, [uplink('A1')], format='json')
+        with connection.cursor() as cursor:
+            for table in ('core_apartmentsensorrollup', 'core_apartmentsensorlatestvalue', 'core_apartmentsensorvalue',
+                          'core_apartmentsensorattribute', 'core_apartmentsensor'):
+                cursor.execute(f'DELETE FROM {table}')
+
+        # Then the next uplink is stored nevertheless
+        response = self.client.post(url, [uplink('A1')], format='json')
+        self.assertEqual(response.data['stored'], 6)
+        self.assertEqual(ApartmentSensor.objects.get(identifier='A1').attributes.count(), 6)
+
+
+class SubscriptionRoutingTest(TransactionTestCase):
+    client_class = APIClient
+
+    def setUp(self):
+        decoders.clear_cache()
+        ingest.clear_caches()
+        self.url = reverse('digita-gw-batch')
+        self.client.post(self.url, [uplink('A1')], format='json')
+        self.attributes = ApartmentSensor.objects.get(identifier='A1').attributes.all()
+        self.user = User.objects.create(username='Subscriber')
+
+    def tearDown(self):
+        decoders.clear_cache()
+        ingest.clear_caches()
+
+    def subscribe(self, attributes):
+        subscription = self.user.subscriptions.create(service=Service.objects.create(name='Big Brother'))
+        subscription.attributes.set(attributes)
+        return subscription
+
+    def test_new_values_are_routed_to_new_subscriptions(self):
+        # Given that the sensor's routes without subscriptions have been cached
+        self.client.post(self.url, [uplink('A1')], format='json')
+
+        # When its attributes are subscribed to
+        subscription = self.subscribe(self.attributes[:2])
+
+        # Then the subscribed values of its next uplink are queued for the subscription
+        self.client.post(self.url, [uplink('A1')], format='json')
+        [delivery] = Delivery.objects.all()
+        self.assertEqual(delivery.subscription, subscription)
+        self.assertEqual(len(json.loads(delivery.values)), 2)
+
+    def test_routes_changed_by_another_process_are_reloaded(self):
+        # Given that the routes of a subscription have been cached
+        subscription = self.subscribe(self.attributes[:1])
+        self.client.post(self.url, [uplink('A1')], format='json')
+
+        # When another process adds attributes to it, which only changes the version here
+        Subscription.attributes.through.objects.bulk_create([
+            Subscription.attributes.through(subscription=subscription, apartmentsensorattribute=attr)
+            for attr in self.attributes[1:]])
+        DataVersion.bump([DataVersion.ROUTES])
+
+        # Then all the subscribed values are routed to it
+        Delivery.objects.all().delete()
+        self.client.post(self.url, [uplink('A1')], format='json')
+        self.assertEqual(len(json.loads(Delivery.objects.get().values)), 6)
@@ -0,0 +1,92 @@
+from django.urls import reverse
+from rest_framework.test import APITestCase
+
+from core.models import Sensor, SensorAttribute, Service, User
+
+
+class ConditionalGetTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='Poller')
+        apartment = self.user.apartments.create(street='Mannerheimintie 1')
+        self.attr = SensorAttribute.objects.create(description='temperature')
+        apsen = apartment.apartment_sensors.create(identifier='A1', sensor=Sensor.objects.create(name='Elsys ERS'))
+        self.apsen_attr = apsen.attributes.create(attribute=self.attr)
+        self.apsen_attr.values.create(value=20)
+        self.service = Service.objects.create(name='Big Brother')
+        self.service.requires.set([self.attr])
+        self.client.force_login(self.user)
+
+    def poll(self, url, etag):
+        return self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    def test_unchanged_apartments_are_not_modified(self):
+        # Given that the user's apartments have been fetched
+        url = reverse('apartment-list')
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        etag = response['ETag']
+
+        # When they are polled again with the ETag of the response
+        with self.assertNumQueries(3) as context:
+            response = self.poll(url, etag)
+
+        # Then a 304 response without content is returned after reading only the session, user and data versions
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+        self.assertIn('core_dataversion', context.captured_queries[-1]['sql'])
+
+    def test_new_values_change_apartments_etag(self):
+        # Given that the user's apartments have been fetched
+        url = reverse('apartment-list')
+        etag = self.client.get(url)['ETag']
+
+        # When a new value of the user's sensor is stored
+        self.apsen_attr.values.create(value=21)
+
+        # Then polling returns the apartments with the new value and a new ETag
+        response = self.poll(url, etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data[0]['apartment_sensors'][0]['attributes'][0]['value'], 21)
+
+    def test_etags_differ_between_users(self):
+        # Given that the user's apartments have been fetched
+        url = reverse('apartment-list')
+        etag = self.client.get(url)['ETag']
+
+        # When another user polls with the same ETag
+        self.client.force_login(User.objects.create(username='Other'))
+        response = self.poll(url, etag)
+
+        # Then their own apartments are returned
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(response.data, [])
+
+    def test_subscriptions_etag(self):
+        # Given that the user's subscriptions have been fetched
+        url = reverse('subscription-list')
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(304, self.poll(url, etag).status_code)
+
+        # When the user subscribes to a service
+        self.user.subscriptions.create(service=self.service)
+
+        # Then polling returns the new subscription
+        response = self.poll(url, etag)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(len(response.data), 1)
+
+    def test_services_etag(self):
+        # Given that the services and the user's available services have been fetched
+        urls = [reverse('service-list'), reverse('available-services')]
+        etags = [self.client.get(url)['ETag'] for url in urls]
+        self.assertEqual([304, 304], [self.poll(url, etag).status_code for url, etag in zip(urls, etags)])
+
+        # When the requirements of a service change
+        self.service.requires.set([SensorAttribute.objects.create(description='Microphone')])
+
+        # Then polling returns the changed services
+        responses = [self.poll(url, etag) for url, etag in zip(urls, etags)]
+        self.assertEqual([200, 200], [response.status_code for response in responses])
+        self.assertEqual(len(responses[1].data), 0)
@@ -0,0 +1,64 @@
+from django.test import TransactionTestCase
+from django.urls import reverse
+from rest_framework.test import APITestCase
+
+from core import decoders
+from core.models import ApartmentSensor, Sensor
+from .test_digita_gw import uplink
+
+
+def decode_counter(payload):
+    return {'count': payload[0]}
+
+
+class DecoderRegistryTest(APITestCase):
+    def setUp(self):
+        self.registry = dict(decoders._registry)  # noqa
+        decoders.register(decode_counter, sensor='Counter')
+        self.sensor = Sensor.objects.create(name='Counter')
+
+    def tearDown(self):
+        decoders._registry.clear()  # noqa
+        decoders._registry.update(self.registry)  # noqa
+
+    def test_decoder_is_chosen_by_sensor(self):
+        # Given a sensor of a model with a decoder of its own
+        apsen = ApartmentSensor.objects.create(identifier='C1', sensor=self.sensor)
+
+        # When it sends data
+        response = self.client.post(reverse('digita-gw'), uplink('C1', '2A'), format='json')
+
+        # Then the payload is decoded with its decoder
+        self.assertEqual(response.data['message'], 'Updated successfully')
+        self.assertEqual(apsen.attributes.get().attribute.description, 'count')
+        self.assertEqual(apsen.attributes.get().values.get().value, 42)
+
+    def test_decoder_is_chosen_by_fport(self):
+        decoders.register(lambda payload: {'status': payload[0]}, sensor='Counter', fport=2)
+        self.assertIs(decoders.get_decoder('Counter', 5), decode_counter)
+        self.assertEqual(decoders.get_decoder('Counter', 2)(b'\x01'), {'status': 1})
+
+    def test_other_sensors_use_the_default_decoder(self):
+        self.assertEqual(decoders.get_decoder('Elsys ERS', 5)(b'\x01\x00\xCD'), {'temperature': 20.5})
+
+
+class SensorNameCacheTest(TransactionTestCase):
+    def setUp(self):
+        decoders.clear_cache()
+        ApartmentSensor.objects.create(identifier='C1', sensor=Sensor.objects.create(name='Counter'))
+
+    def tearDown(self):
+        decoders.clear_cache()
+
+    def test_sensor_names_are_cached_until_changed(self):
+        # Given that the sensor of a DevEUI has been looked up
+        self.assertEqual(decoders.sensor_names(['C1', 'X9']), {'C1': 'Counter', 'X9': None})
+
+        # Then it is not looked up again
+        with self.assertNumQueries(0):
+            self.assertEqual(decoders.sensor_names(['C1', 'X9']), {'C1': 'Counter', 'X9': None})
+
+        # Until the apartment sensor changes
+        ApartmentSensor.objects.filter(identifier='C1').get().save()
+        with self.assertNumQueries(1):
+            decoders.sensor_names(['C1'])
@@ -1,10 +1,21 @@
+import copy
+
+from django.test import override_settings
 from django.urls import reverse
 from rest_framework.test import APITestCase
 
-from core.models import Apartment, ApartmentSensor, Sensor
+from core.models import Apartment, ApartmentSensor, ApartmentSensorAttribute, ApartmentSensorValue, Sensor
 from .data import sensor_data_package
 
 
+def uplink(identifier, payload_hex=None):
+    data = copy.deepcopy(sensor_data_package)
+    data['DevEUI_uplink']['DevEUI'] = identifier
+    if payload_hex is not None:
+        data['DevEUI_uplink']['payload_hex'] = payload_hex
+    return data
+
+
 class DigitaTest(APITestCase):
     url = reverse('digita-gw')
 
@@ -22,3 +33,63 @@ class DigitaTest(APITestCase):
         )
         response = self.client.post(self.url, sensor_data_package, format='json')
         self.assertEqual(200, response.status_code)
+
+
+class DigitaBatchTest(APITestCase):
+    url = reverse('digita-gw-batch')
+
+    def test_batch_gw_data(self):
+        # Given a batch of uplinks from two sensors, one of them undecodable
+        uplinks = [uplink('A1'), uplink('B2'), uplink('A1'), uplink('A1', payload_hex='not hex')]
+
+        # When the batch is posted to the batch endpoint
+        response = self.client.post(self.url, uplinks, format='json')
+
+        # Then a 200 response is returned reporting the skipped uplink
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(response.data['received'], 4)
+        self.assertEqual([error['index'] for error in response.data['errors']], [3])
+
+        # And values for every decoded key of every valid uplink are stored
+        self.assertEqual(ApartmentSensor.objects.filter(identifier__in=['A1', 'B2']).count(), 2)
+        self.assertEqual(ApartmentSensorAttribute.objects.count(), 2 * 6)
+        self.assertEqual(ApartmentSensorValue.objects.count(), 3 * 6)
+        self.assertEqual(response.data['stored'], 3 * 6)
+
+    def test_sensors_of_undecodable_uplinks_are_created(self):
+        # When a batch with an uplink that has no decodable values is posted
+        response = self.client.post(self.url, [uplink('A1'), uplink('C3', payload_hex='ff')], format='json')
+
+        # Then the error is reported, but its sensor is created as by the single uplink endpoint
+        self.assertEqual([error['index'] for error in response.data['errors']], [1])
+        self.assertTrue(ApartmentSensor.objects.filter(identifier='C3').exists())
+        self.assertFalse(ApartmentSensorAttribute.objects.filter(apartment_sensor__identifier='C3').exists())
+
+    def test_invalid_dev_eui(self):
+        # When uplinks with a DevEUI that is not a string are posted
+        response = self.client.post(self.url, [uplink(['A1']), uplink('B2'), uplink({'id': 'A1'})], format='json')
+
+        # Then they are reported as errors and the rest of the batch is stored
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([error['index'] for error in response.data['errors']], [0, 2])
+        self.assertEqual(list(ApartmentSensor.objects.values_list('identifier', flat=True)), ['B2'])
+
+    def test_batch_query_count_does_not_depend_on_batch_size(self):
+        # Given that the sensors and attributes of the batch already exist
+        self.client.post(self.url, [uplink('A1'), uplink('B2')], format='json')
+
+        # Then storing a batch takes the same number of queries regardless of its size
+        with self.assertNumQueries(15):
+            self.client.post(self.url, [uplink('A1')], format='json')
+        with self.assertNumQueries(15):
+            self.client.post(self.url, [uplink('A1'), uplink('B2')] * 20, format='json')
+
+    def test_invalid_batch(self):
+        response = self.client.post(self.url, sensor_data_package, format='json')
+        self.assertEqual(400, response.status_code)
+
+    @override_settings(DIGITA_GW_MAX_BATCH=2)
+    def test_batch_size_is_limited(self):
+        response = self.client.post(self.url, [uplink('A1')] * 3, format='json')
+        self.assertEqual(413, response.status_code)
+        self.assertFalse(ApartmentSensor.objects.exists())
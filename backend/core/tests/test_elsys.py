@@ -1,9 +1,47 @@
-from unittest import TestCase
+import binascii
+from unittest import TestCase, skipUnless
 
-from core.utils.elsys import decode_elsys_payload
+from core.utils.elsys import ElsysDecodeError, decode_elsys_payload, decode_elsys_payloads
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class TestElsysDecoder(TestCase):
     def test_decoding(self):
         decoded = decode_elsys_payload(b'\x01\x00\xCD')
         self.assertEqual(decoded, {'temperature': 20.5})
+
+    def test_decoding_several_types(self):
+        decoded = decode_elsys_payload(binascii.unhexlify('01FF9C' '0222' '03FE0140' '09060001000002' '1400018A88'))
+        self.assertEqual(decoded, {
+            'temperature': -10.0, 'humidity': 34, 'x': -2, 'y': 1, 'z': 64, 'lat': 0x060001, 'long': 2,
+            'pressure': 101.0})
+
+    def test_unknown_type(self):
+        with self.assertRaisesRegex(ElsysDecodeError, 'Unknown type 0xff at byte 3'):
+            decode_elsys_payload(b'\x01\x00\xCD\xFF\x00')
+
+    def test_truncated_payload(self):
+        with self.assertRaisesRegex(ElsysDecodeError, 'Truncated co2 at byte 3: expected 2 bytes, got 1'):
+            decode_elsys_payload(b'\x01\x00\xCD\x06\x01')
+
+    @skipUnless(numpy, 'NumPy is not installed')
+    def test_batch_decoding(self):
+        payloads = [b'\x01\x00\xCD\x06\x01\x90', b'\x01\xFF\x9C', b'\x01\x00\xCE\x06\x01\x91', b'\xFF']
+        decoded = decode_elsys_payloads(payloads, strict=False)
+
+        self.assertEqual(list(decoded['temperature'][:3]), [20.5, -10.0, 20.6])
+        self.assertEqual(decoded['co2'][0], 400)
+        self.assertTrue(numpy.isnan(decoded['co2'][1]))
+        self.assertEqual(list(decoded['valid']), [True, True, True, False])
+        for index in range(3):
+            expected = decode_elsys_payload(payloads[index])
+            self.assertEqual({field: decoded[field][index] for field in expected}, expected)
+
+    @skipUnless(numpy, 'NumPy is not installed')
+    def test_batch_decoding_is_strict_by_default(self):
+        with self.assertRaisesRegex(ElsysDecodeError, 'Payload 1: Unknown type 0xff'):
+            decode_elsys_payloads([b'\x01\x00\xCD', b'\xFF'])
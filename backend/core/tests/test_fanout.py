@@ -0,0 +1,39 @@
+import threading
+import time
+
+from django.test import SimpleTestCase, override_settings
+
+from core.utils.fanout import fan_out
+
+
+class FanOutTest(SimpleTestCase):
+    def test_keys_run_concurrently(self):
+        # Both functions can only pass the barrier if they run at the same time
+        barrier = threading.Barrier(2, timeout=5)
+        errors = fan_out([('a', barrier.wait), ('b', barrier.wait)])
+        self.assertEqual(errors, [None, None])
+
+    def test_errors_are_isolated(self):
+        def fail():
+            raise ValueError('service down')
+
+        errors = fan_out([('a', fail), ('b', lambda: None)])
+        self.assertIsInstance(errors[0], ValueError)
+        self.assertIsNone(errors[1])
+
+    @override_settings(SERVICE_MAX_CONCURRENCY=2)
+    def test_concurrency_limit_per_key(self):
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def task():
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.pop()
+
+        fan_out([('a', task)] * 6)
+        self.assertEqual(max(peak), 2)
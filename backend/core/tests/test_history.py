@@ -0,0 +1,64 @@
+import json
+from datetime import datetime, timedelta
+
+from django.test import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from core.models import ApartmentSensorRollup, ApartmentSensorValue, SensorAttribute, User
+
+
+class HistoryTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='Charter')
+        apsen = self.user.apartments.create(street='Mannerheimintie 1').apartment_sensors.create(identifier='A1')
+        self.apsen_attr = apsen.attributes.create(attribute=SensorAttribute.objects.create(description='co2'))
+        self.url = reverse('apartmentsensor-history', args=[apsen.id, self.apsen_attr.id])
+        self.start = timezone.make_aware(datetime(2020, 1, 6))
+
+        # Two values an hour, 400 and 600, for two weeks
+        ApartmentSensorRollup.update_from_values([
+            ApartmentSensorValue(apartment_sensor_attribute=self.apsen_attr, value=value,
+                                 updated_at=self.start + timedelta(hours=hours))
+            for hours in range(24 * 14) for value in (400, 600)])
+        self.client.force_login(self.user)
+
+    def get(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(200, response.status_code)
+        return json.loads(b''.join(response.streaming_content))
+
+    def test_hourly_history(self):
+        # When requesting a day of history
+        data = self.get(**{'from': '2020-01-06T00:00:00Z', 'to': '2020-01-07T00:00:00Z'})
+
+        # Then it is returned as hourly buckets in parallel arrays
+        self.assertEqual(data['bucket'], 'hour')
+        columns = data['columns']
+        self.assertEqual(len(columns['t']), 24)
+        self.assertEqual(columns['t'][1] - columns['t'][0], 3600)
+        self.assertEqual((columns['count'][0], columns['min'][0], columns['max'][0], columns['avg'][0]),
+                         (2, 400, 600, 500))
+
+    def test_weekly_history_is_aggregated_from_daily_rollups(self):
+        data = self.get(**{'from': '2020-01-06T00:00:00Z', 'to': '2020-01-20T00:00:00Z', 'bucket': 'week'})
+        self.assertEqual(data['columns']['count'], [2 * 24 * 7, 2 * 24 * 7])
+        self.assertEqual(data['columns']['avg'], [500, 500])
+
+    @override_settings(HISTORY_MAX_POINTS=10)
+    def test_history_is_capped(self):
+        # When requesting hourly buckets for a period with more of them than allowed
+        data = self.get(**{'from': '2020-01-06T00:00:00Z', 'to': '2020-01-16T00:00:00Z', 'bucket': 'hour'})
+
+        # Then larger buckets are returned instead
+        self.assertEqual(data['bucket'], 'day')
+        self.assertEqual(len(data['columns']['t']), 10)
+
+    def test_invalid_parameters(self):
+        self.assertEqual(400, self.client.get(self.url, {'bucket': 'minute'}).status_code)
+        self.assertEqual(400, self.client.get(self.url, {'from': 'yesterday'}).status_code)
+
+    def test_history_of_other_users_sensors_is_not_found(self):
+        self.client.force_login(User.objects.create(username='Stranger'))
+        self.assertEqual(404, self.client.get(self.url).status_code)
@@ -0,0 +1,38 @@
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from core.utils import http
+
+
+class SharedSessionTest(SimpleTestCase):
+    def tearDown(self):
+        http.close_sessions()
+
+    def test_session_per_host(self):
+        session = http.get_session('https://service.com/api/subscriptions/')
+
+        # Requests to the same host share a session, other hosts get their own
+        self.assertIs(http.get_session('https://service.com/api/measurements/'), session)
+        self.assertIsNot(http.get_session('https://other.com/api/measurements/'), session)
+        self.assertIsNot(http.get_session('http://service.com/api/measurements/'), session)
+
+    @override_settings(SERVICE_HTTP_RETRIES=3)
+    def test_retries(self):
+        retry = http.get_session('https://service.com/').get_adapter('https://service.com/').max_retries
+        self.assertEqual(retry.connect, 3)
+        self.assertEqual(retry.read, 0)
+
+        # POSTs that reached the service are not resent, whatever it answered
+        self.assertEqual(retry.status, 0)
+        for status in (502, 503, 504):
+            self.assertFalse(retry.is_retry('POST', status))
+
+    @override_settings(SERVICE_HTTP_TIMEOUT=(1, 2))
+    def test_default_timeout(self):
+        with mock.patch('requests.Session.post') as post:
+            http.post('https://service.com/api/measurements/', json={})
+            http.post('https://service.com/api/measurements/', json={}, timeout=5)
+
+        self.assertEqual(post.call_args_list[0][1]['timeout'], (1, 2))
+        self.assertEqual(post.call_args_list[1][1]['timeout'], 5)
@@ -0,0 +1,145 @@
+import json
+import threading
+from unittest import skipUnless
+
+from django.db import connection
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from core import decoders, ingest
+from core.live import broker
+from core.models import ApartmentSensor, User
+from .test_digita_gw import uplink
+
+
+@override_settings(LIVE_STREAMS=True)
+class LiveValuesTest(TransactionTestCase):
+    client_class = APIClient
+
+    def setUp(self):
+        decoders.clear_cache()
+        ingest.clear_caches()
+        self.user = User.objects.create(username='Watcher')
+        self.token = Token.objects.create(user=self.user)
+        self.apartment = self.user.apartments.create(street='Mannerheimintie 1')
+        self.client.post(reverse('digita-gw-batch'), [uplink('A1'), uplink('B2')], format='json')
+        ApartmentSensor.objects.filter(identifier='A1').update(apartment=self.apartment)
+
+    def tearDown(self):
+        decoders.clear_cache()
+        ingest.clear_caches()
+
+    def stream_token(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        response = self.client.post(reverse('live-token'))
+        self.client.credentials()
+        self.assertEqual(200, response.status_code)
+        return response.data['token']
+
+    def open_stream(self):
+        response = self.client.get(reverse('live-values'), {'token': self.stream_token()})
+        self.addCleanup(response.close)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = iter(response.streaming_content)
+        self.assertEqual(next(events), b'retry: 5000\n\n')
+        return response, events
+
+    def test_new_values_are_streamed_to_their_user(self):
+        # Given that the user has opened a live stream
+        _, events = self.open_stream()
+
+        # When the gateway posts uplinks of the user's sensor and of another sensor
+        self.client.post(reverse('digita-gw-batch'), [uplink('B2'), uplink('A1')], format='json')
+
+        # Then one event with the new values of the user's sensor attributes is streamed
+        event, data = next(events).decode().splitlines()[:2]
+        self.assertEqual(event, 'event: values')
+        values = json.loads(data[len('data: '):])['values']
+        attr_ids = ApartmentSensor.objects.get(identifier='A1').attributes.values_list('id', flat=True)
+        self.assertCountEqual([value['id'] for value in values], attr_ids)
+        self.assertEqual(len(broker._streams[self.user.pk]), 1)
+        [stream] = broker._streams[self.user.pk]
+        self.assertTrue(stream.messages.empty())
+
+    @override_settings(LIVE_KEEPALIVE=0.01)
+    def test_idle_stream_is_kept_alive(self):
+        _, events = self.open_stream()
+        self.assertEqual(next(events), b': keepalive\n\n')
+
+    @override_settings(LIVE_QUEUE_SIZE=1)
+    def test_client_falling_behind_is_told_to_reload(self):
+        # Given that the user has opened a live stream
+        _, events = self.open_stream()
+
+        # When more values arrive than the stream can hold before it is read
+        for _ in range(2):
+            self.client.post(reverse('digita-gw-batch'), [uplink('A1')], format='json')
+
+        # Then the client is told to reload before receiving the values that fit
+        self.assertTrue(next(events).startswith(b'event: reload\n'))
+        self.assertTrue(next(events).startswith(b'event: values\n'))
+
+    def test_stream_is_closed(self):
+        # Given that the user has opened a live stream
+        response, _ = self.open_stream()
+
+        # When the client disconnects
+        response.close()
+
+        # Then the stream no longer receives values
+        self.assertNotIn(self.user.pk, broker._streams)
+
+    def test_stream_requires_authentication(self):
+        response = self.client.get(reverse('live-values'), {'token': 'invalid'})
+        self.assertEqual(401, response.status_code)
+
+    def test_api_token_is_not_a_stream_token(self):
+        # The permanent API token must not be sent in URLs, which end up in access logs
+        response = self.client.get(reverse('live-values'), {'token': self.token.key})
+        self.assertEqual(401, response.status_code)
+
+    def test_stream_token_expires(self):
+        token = self.stream_token()
+        with override_settings(LIVE_TOKEN_MAX_AGE=-1):
+            response = self.client.get(reverse('live-values'), {'token': token})
+        self.assertEqual(401, response.status_code)
+
+    @override_settings(LIVE_STREAMS=False)
+    def test_streams_are_only_served_by_live_workers(self):
+        # Streams would tie up the sync workers, so clients are told to poll instead
+        response = self.client.get(reverse('live-values'), {'token': self.stream_token()})
+        self.assertEqual(503, response.status_code)
+        self.assertIn('Retry-After', response)
+
+    @skipUnless(connection.vendor == 'postgresql', 'LISTEN/NOTIFY requires PostgreSQL')
+    @override_settings(LIVE_KEEPALIVE=0.1)
+    def test_values_are_passed_on_with_notify(self):
+        # Given that the user has opened a live stream, and the process is listening for notifications
+        _, events = self.open_stream()
+        self.addCleanup(broker.stop)
+        self.assertTrue(broker.listening.wait(5))
+
+        # When values of the user's sensor are stored in another thread, as in another process
+        thread = threading.Thread(target=self.post_uplink_in_thread)
+        thread.start()
+        thread.join()
+
+        # Then they are streamed once the notification is received
+        for _ in range(50):
+            event = next(events).decode()
+            if event.startswith('event: values'):
+                break
+        else:
+            self.fail('No values were streamed')
+        values = json.loads(event.splitlines()[1][len('data: '):])['values']
+        attr_ids = ApartmentSensor.objects.get(identifier='A1').attributes.values_list('id', flat=True)
+        self.assertCountEqual([value['id'] for value in values], attr_ids)
+
+    def post_uplink_in_thread(self):
+        try:
+            APIClient().post(reverse('digita-gw-batch'), [uplink('A1')], format='json')
+        finally:
+            connection.close()
@@ -0,0 +1,89 @@
+from unittest import mock
+
+import requests
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient, APITestCase
+
+from core import decoders, ingest, models
+from core.utils import metrics
+from .data import sensor_data_package
+
+
+def sample(name, **labels):
+    return metrics.registry().get_sample_value(name, labels) or 0
+
+
+class MetricsTest(APITestCase):
+    def setUp(self):
+        self.user = models.User.objects.create(username='Metered')
+        self.client.force_authenticate(self.user)
+
+    def test_request_latency_and_queries_are_recorded(self):
+        # Given the metrics recorded so far for listing services
+        labels = {'view': 'service-list', 'method': 'GET'}
+        count = sample('sensehel_request_duration_seconds_count', **labels)
+        queries = sample('sensehel_request_queries_sum', **labels)
+        responses = sample('sensehel_responses_total', status='200', **labels)
+
+        # When listing services
+        with self.assertNumQueries(2) as context:
+            self.client.get(reverse('service-list'))
+
+        # Then the request and its queries are recorded for the view
+        self.assertEqual(sample('sensehel_request_duration_seconds_count', **labels), count + 1)
+        self.assertEqual(sample('sensehel_request_queries_sum', **labels), queries + len(context.captured_queries))
+        self.assertEqual(sample('sensehel_responses_total', status='200', **labels), responses + 1)
+
+        # And the view with MetricsMixin records the phases of handling it
+        self.assertTrue(sample('sensehel_view_phase_duration_seconds_count', phase='handler', **labels))
+
+    def test_metrics_are_exposed(self):
+        self.client.get(reverse('service-list'))
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(200, response.status_code)
+        self.assertIn(b'sensehel_request_duration_seconds_bucket{', response.content)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_require_token(self):
+        self.assertEqual(401, self.client.get(reverse('metrics')).status_code)
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(200, response.status_code)
+
+
+class ServiceCallMetricsTest(TransactionTestCase):
+    """
+    Values are sent inline once the transaction storing them commits, which TestCase never does.
+    """
+    client_class = APIClient
+
+    def setUp(self):
+        decoders.clear_cache()
+        ingest.clear_caches()
+        self.user = models.User.objects.create(username='Metered')
+
+    def tearDown(self):
+        decoders.clear_cache()
+        ingest.clear_caches()
+
+    def test_service_calls_are_recorded(self):
+        # Given subscriptions to two services, which are called concurrently
+        temperature = models.SensorAttribute.objects.create(
+            description='temperature', uri='http://urn.fi/URN:NBN:fi:au:ucum:r73')
+        apsen = self.user.apartments.create().apartment_sensors.create(
+            identifier=sensor_data_package['DevEUI_uplink']['DevEUI'])
+        apsen_attr = apsen.attributes.create(attribute=temperature)
+        for url in ('https://service.com/data/', 'https://other.com/data/'):
+            service = models.Service.objects.create(data_url=url)
+            self.user.subscriptions.create(service=service).attributes.add(apsen_attr)
+        labels = {'view': 'digita-gw', 'method': 'POST'}
+        calls = sample('sensehel_request_service_calls_sum', **labels)
+
+        # When new data is submitted to them while handling the request
+        response = requests.Response()
+        response.status_code = 200
+        with override_settings(SUBSCRIPTION_OUTBOX=False), mock.patch('core.utils.http.post', return_value=response):
+            self.client.post(reverse('digita-gw'), sensor_data_package, format='json')
+
+        # Then both calls are recorded for the request
+        self.assertEqual(sample('sensehel_request_service_calls_sum', **labels), calls + 2)
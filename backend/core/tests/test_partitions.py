@@ -0,0 +1,83 @@
+import importlib
+import io
+from unittest import skipUnless
+
+from django.apps import apps
+from django.core.management import call_command
+from django.db import connection
+from django.test import TransactionTestCase, override_settings
+from django.utils import timezone
+
+from core.models import ApartmentSensor, ApartmentSensorValue, SensorAttribute
+from core.utils import partitions
+
+migration = importlib.import_module('core.migrations.0033_partition_apartmentsensorvalue')
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Partitioning requires PostgreSQL')
+class PartitionTest(TransactionTestCase):
+    """
+    Partitions are created with DDL that cannot run while deferred foreign key checks are pending, so every statement
+    is committed as in production.
+    """
+
+    def setUp(self):
+        apsen = ApartmentSensor.objects.create(identifier='A1')
+        self.apsen_attr = apsen.attributes.create(attribute=SensorAttribute.objects.create(description='co2'))
+        self.value = self.apsen_attr.values.create(value=400)
+        self.this_month = partitions.month_start(timezone.now())
+
+        # Given that the values are partitioned by migration 0033
+        with override_settings(PARTITION_SENSOR_VALUES=True), connection.schema_editor() as schema_editor:
+            migration.forwards(apps, schema_editor)
+        self.addCleanup(self.unpartition)
+
+    def unpartition(self):
+        with connection.schema_editor() as schema_editor:
+            migration.backwards(apps, schema_editor)
+
+    def partition_of(self, value):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT tableoid::regclass::text FROM {partitions.TABLE} WHERE id = %s', [value.id])
+            return cursor.fetchone()[0]
+
+    def test_migration_partitions_values(self):
+        # Then the existing values are kept in the partition of their month
+        self.assertTrue(partitions.is_partitioned(connection))
+        self.assertEqual(self.partition_of(self.value), partitions.partition_name(self.this_month))
+        self.assertEqual(ApartmentSensorValue.objects.get().value, 400)
+
+        # And new values are stored in it too
+        value = self.apsen_attr.values.create(value=450)
+        self.assertEqual(self.partition_of(value), partitions.partition_name(self.this_month))
+
+        # And migrating back restores the plain table with the values
+        self.unpartition()
+        self.assertFalse(partitions.is_partitioned(connection))
+        self.assertEqual(ApartmentSensorValue.objects.count(), 2)
+        self.apsen_attr.values.create(value=500)
+
+    def test_create_value_partitions(self):
+        # When creating partitions further ahead than the migration did
+        stdout = io.StringIO()
+        call_command('create_value_partitions', '--months=5', stdout=stdout)
+
+        # Then only the missing months are created
+        created = [partitions.partition_name(partitions.add_months(self.this_month, months)) for months in (4, 5)]
+        self.assertEqual(stdout.getvalue().splitlines(), [f'Created partition {name}' for name in created])
+        stdout = io.StringIO()
+        call_command('create_value_partitions', '--months=5', stdout=stdout)
+        self.assertEqual(stdout.getvalue(), '')
+
+    def test_values_are_moved_out_of_the_default_partition(self):
+        # Given a value of a month that has no partition yet
+        month = partitions.add_months(self.this_month, 5)
+        ApartmentSensorValue.objects.filter(id=self.value.id).update(updated_at=month)
+        self.assertEqual(self.partition_of(self.value), partitions.DEFAULT_PARTITION)
+
+        # When the partition of its month is created
+        call_command('create_value_partitions', '--months=5', stdout=io.StringIO())
+
+        # Then the value is moved to it
+        self.assertEqual(self.partition_of(self.value), partitions.partition_name(month))
+        self.assertEqual(ApartmentSensorValue.objects.get().updated_at, month)
@@ -0,0 +1,78 @@
+import json
+from unittest import TestCase, skipIf, skipUnless
+
+from django.core.exceptions import ImproperlyConfigured
+
+from core.utils import payloads
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+VALUES = [
+    {'attribute': 12, 'value': '21.5', 'timestamp': '2020-01-01T12:00:00Z'},
+    {'attribute': 13, 'value': '40.0', 'timestamp': '2020-01-01T12:00:00Z'},
+]
+DATA = {'uuid': '1b4e28ba', 'values': VALUES, 'auth_token': '6f1f0f0e'}
+ROLLUPS = [
+    {'attribute': 12, 'value': '21.5', 'timestamp': '2020-01-01T12:00:00Z', 'resolution': 'hour', 'count': 60,
+     'min': '20.9', 'max': '22.0', 'last': '21.7'},
+    {'attribute': 13, 'value': '40.0', 'timestamp': '2020-01-01T12:00:00Z', 'resolution': 'hour', 'count': 59,
+     'min': '38.0', 'max': '41.5', 'last': '40.1'},
+]
+COLUMNS = {'attribute': [12, 13], 'value': ['21.5', '40.0'], 'timestamp': ['2020-01-01T12:00:00Z'] * 2}
+
+
+class PayloadEncodingTest(TestCase):
+    def roundtrip(self, data, encoding):
+        kwargs = payloads.encode(data, encoding)
+        return kwargs['headers'], payloads.decode(kwargs['data'], kwargs['headers'])
+
+    def test_rollup_history(self):
+        # Rollups submitted as history keep all their aggregates in every encoding
+        data = dict(DATA, values=ROLLUPS)
+        columns = {field: [rollup[field] for rollup in ROLLUPS] for field in ROLLUPS[0]}
+        for encoding, _ in payloads.ENCODINGS:
+            if encoding == payloads.MSGPACK and not msgpack:
+                continue
+            with self.subTest(encoding=encoding):
+                kwargs = payloads.encode(data, encoding)
+                if 'json' in kwargs:
+                    decoded = json.loads(json.dumps(kwargs['json']))
+                else:
+                    decoded = payloads.decode(kwargs['data'], kwargs['headers'])
+                expected = data if encoding in (payloads.JSON, payloads.JSON_GZIP) else dict(data, values=columns)
+                self.assertEqual(decoded, expected)
+
+    def test_fields_missing_from_some_values(self):
+        self.assertEqual(payloads.columns([{'a': 1}, {'a': 2, 'b': 3}]), {'a': [1, 2], 'b': [None, 3]})
+
+    def test_json(self):
+        self.assertEqual(payloads.encode(DATA, payloads.JSON), {'json': DATA})
+
+    def test_gzip_json(self):
+        headers, decoded = self.roundtrip(DATA, payloads.JSON_GZIP)
+        self.assertEqual(headers, {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})
+        self.assertEqual(decoded, DATA)
+
+    def test_columnar_json(self):
+        headers, decoded = self.roundtrip(DATA, payloads.COLUMNAR_GZIP)
+        self.assertEqual(headers['Content-Type'], payloads.COLUMNAR_JSON_TYPE)
+        self.assertEqual(decoded, dict(DATA, values=COLUMNS))
+
+    def test_columnar_batch(self):
+        batch = {'auth_token': '6f1f0f0e', 'subscriptions': [{'uuid': '1b4e28ba', 'values': VALUES}]}
+        _, decoded = self.roundtrip(batch, payloads.COLUMNAR)
+        self.assertEqual(decoded['subscriptions'], [{'uuid': '1b4e28ba', 'values': COLUMNS}])
+
+    @skipUnless(msgpack, 'msgpack is not installed')
+    def test_msgpack(self):
+        headers, decoded = self.roundtrip(DATA, payloads.MSGPACK)
+        self.assertEqual(headers['Content-Type'], payloads.COLUMNAR_MSGPACK_TYPE)
+        self.assertEqual(decoded, dict(DATA, values=COLUMNS))
+
+    @skipIf(msgpack, 'msgpack is installed')
+    def test_msgpack_not_installed(self):
+        with self.assertRaises(ImproperlyConfigured):
+            payloads.check_encoding(payloads.MSGPACK)
@@ -0,0 +1,85 @@
+import importlib
+import io
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from django.apps import apps
+from django.core.management import call_command
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from core.models import ApartmentSensor, ApartmentSensorRollup, ApartmentSensorValue, SensorAttribute
+
+
+class RollupTest(APITestCase):
+    def setUp(self):
+        apsen = ApartmentSensor.objects.create(identifier='A1')
+        self.apsen_attr = apsen.attributes.create(attribute=SensorAttribute.objects.create(description='co2'))
+        self.start = timezone.make_aware(datetime(2020, 1, 1, 10))
+
+    def add_values(self, minutes_and_values):
+        """
+        Store values at the given minutes after 10:00 and return them.
+        """
+        values = []
+        for minutes, value in minutes_and_values:
+            created = self.apsen_attr.values.create(value=value)
+            ApartmentSensorValue.objects.filter(id=created.id).update(
+                updated_at=self.start + timedelta(minutes=minutes))
+            values.append(ApartmentSensorValue.objects.get(id=created.id))
+        return values
+
+    def rollup(self, resolution, period_start):
+        return ApartmentSensorRollup.objects.get(
+            apartment_sensor_attribute=self.apsen_attr, resolution=resolution, period_start=period_start)
+
+    def test_values_are_rolled_up_by_hour_and_day(self):
+        # Given values in two different hours of the same day
+        values = self.add_values([(5, 400), (50, 500), (70, 450)])
+        ApartmentSensorRollup.objects.all().delete()
+
+        # When they are included in the rollups in two steps
+        ApartmentSensorRollup.update_from_values(values[:2])
+        ApartmentSensorRollup.update_from_values(values[2:])
+
+        # Then every hour and the whole day have their own aggregates
+        first_hour = self.rollup(ApartmentSensorRollup.HOUR, self.start)
+        self.assertEqual((first_hour.count, first_hour.min, first_hour.max, first_hour.last), (2, 400, 500, 500))
+        self.assertEqual(first_hour.avg, 450)
+        second_hour = self.rollup(ApartmentSensorRollup.HOUR, self.start + timedelta(hours=1))
+        self.assertEqual((second_hour.count, second_hour.last), (1, 450))
+        day = self.rollup(ApartmentSensorRollup.DAY, self.start - timedelta(hours=10))
+        self.assertEqual((day.count, day.min, day.max, day.sum, day.last), (3, 400, 500, Decimal(1350), 450))
+
+    def test_rebuild_rollups(self):
+        # Given rollups that no longer match the stored values
+        self.add_values([(5, 400), (50, 500), (70, 450)])
+        ApartmentSensorRollup.objects.update(count=0)
+
+        # When rebuilding them
+        call_command('rebuild_rollups', '--batch-size=1', stdout=io.StringIO())
+
+        # Then they are recreated from the values
+        self.assertEqual(ApartmentSensorRollup.objects.count(), 3)
+        self.assertEqual(self.rollup(ApartmentSensorRollup.HOUR, self.start).count, 2)
+        self.assertEqual(self.rollup(ApartmentSensorRollup.DAY, self.start - timedelta(hours=10)).count, 3)
+
+    def test_migration_backfills_rollups(self):
+        # Given values stored before rollups were maintained
+        self.add_values([(5, 400), (50, 500), (70, 450)])
+        ApartmentSensorRollup.objects.all().delete()
+
+        # When migrating
+        migration = importlib.import_module('core.migrations.0038_backfill_rollups')
+        migration.forwards(apps, None)
+
+        # Then the rollups are created from them as when rebuilding
+        self.assertEqual(ApartmentSensorRollup.objects.count(), 3)
+        first_hour = self.rollup(ApartmentSensorRollup.HOUR, self.start)
+        self.assertEqual((first_hour.count, first_hour.min, first_hour.max, first_hour.last), (2, 400, 500, 500))
+        day = self.rollup(ApartmentSensorRollup.DAY, self.start - timedelta(hours=10))
+        self.assertEqual((day.count, day.sum, day.last), (3, Decimal(1350), 450))
+
+        # And migrating again leaves existing rollups alone
+        migration.forwards(apps, None)
+        self.assertEqual(ApartmentSensorRollup.objects.count(), 3)
@@ -1,22 +1,36 @@
+import io
+import json
+from datetime import timedelta
+from unittest.mock import patch
+
 import requests
+from django.core import mail
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.test import TransactionTestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import serializers
+from rest_framework.test import APIClient
 
-from core import models
+from core import decoders, ingest, models
+from core.utils import payloads
 
 from .base import SenseHelAPITestCase
 from .data import sensor_data_package
 
 
 class MockSubscriptionRequests:
+    def __init__(self, status_code=200):
+        self.status_code = status_code
+
     def __enter__(self):
         self.last_request = None
 
         def post(_self, *args, **kwargs):
             self.last_request = (args, kwargs)
-            resp = requests.Response()
-            resp.status_code = 200
-            return resp
+            return self.mock_response(self.status_code)
 
         self.old_post = models.Subscription._post  # noqa
         models.Subscription._post = post
@@ -24,10 +38,14 @@ class MockSubscriptionRequests:
     def __exit__(self, *args):
         models.Subscription._post = self.old_post
 
+    @staticmethod
+    def mock_response(status_code):
+        resp = requests.Response()
+        resp.status_code = status_code
+        return resp
 
-class SubscriptionTest(SenseHelAPITestCase):
-    mock_requests = MockSubscriptionRequests()
 
+class SubscriptionFixtures:
     def setUp(self):
         self.temperature = models.SensorAttribute.objects.create(
             description='temperature', uri='http://urn.fi/URN:NBN:fi:au:ucum:r73')
@@ -43,6 +61,20 @@ class SubscriptionTest(SenseHelAPITestCase):
 
         self.url = reverse('subscription-list')
 
+    def queue_delivery(self):
+        """
+        Subscribe to an attribute and post new data for it, and return the queued delivery.
+        """
+        apsen_attr = self.apsen.attributes.create(attribute=self.temperature)
+        subscription = self.user.subscriptions.create(service=self.service)
+        subscription.attributes.add(apsen_attr)
+        self.client.post(reverse('digita-gw'), sensor_data_package, format='json')
+        return subscription.deliveries.get()
+
+
+class SubscriptionTest(SubscriptionFixtures, SenseHelAPITestCase):
+    mock_requests = MockSubscriptionRequests()
+
     def test_subscribe_with_no_logged_in_user(self):
         # Given that no user is logged in
         # When requesting to create a new subscription
@@ -102,8 +134,12 @@ class SubscriptionTest(SenseHelAPITestCase):
                 'attributes': [apsen_attr.id],
                 'include_history': True})
 
-        # Then a 201 response is returned
-        self.assertEqual(201, response.status_code)
+            # Then a 201 response is returned
+            self.assertEqual(201, response.status_code)
+
+            # And the history is left for the delivery worker to submit
+            self.assertEqual(self.mock_requests.last_request[0], (self.service.subscribe_url,))
+            call_command('process_deliveries', '--once')
 
         # And a new subscription is created in the db
         subscription = models.Subscription.objects.get()
@@ -131,8 +167,12 @@ class SubscriptionTest(SenseHelAPITestCase):
         with self.mock_requests:
             response = self.client.post(reverse('digita-gw'), sensor_data_package, format='json')
 
-        # Then a 200 response is returned
-        self.assertEqual(200, response.status_code)
+            # Then a 200 response is returned
+            self.assertEqual(200, response.status_code)
+
+            # And nothing is submitted before the delivery worker runs
+            self.assertIsNone(self.mock_requests.last_request)
+            call_command('process_deliveries', '--once')
 
         # And new values are added to the db attached to the relevant attributes
         value = apsen_attr.values.get()
@@ -172,3 +212,466 @@ class SubscriptionTest(SenseHelAPITestCase):
         self.assert_dict_contains(kwargs['json'], {
             'uuid': str(subscription.uuid),
             'auth_token': str(self.service.auth_token)})
+
+    def test_failed_delivery_is_retried(self):
+        # Given that there is a subscription for an attribute
+        apsen_attr = self.apsen.attributes.create(attribute=self.temperature)
+        subscription = self.user.subscriptions.create(service=self.service)
+        subscription.attributes.add(apsen_attr)
+
+        # And given that new data has been queued for the subscription
+        self.client.post(reverse('digita-gw'), sensor_data_package, format='json')
+        delivery = subscription.deliveries.get()
+
+        # When the delivery worker runs while the external service is failing
+        with MockSubscriptionRequests(status_code=503):
+            call_command('process_deliveries', '--once')
+
+        # Then the delivery is kept and scheduled for a later retry
+        delivery.refresh_from_db()
+        self.assertEqual(delivery.attempts, 1)
+        self.assertGreater(delivery.next_attempt_at, timezone.now())
+
+        # And once the retry is due, the delivery is submitted and removed from the queue
+        models.Delivery.objects.update(next_attempt_at=timezone.now())
+        with self.mock_requests:
+            call_command('process_deliveries', '--once')
+        self.assertEqual(self.mock_requests.last_request[0], (self.service.data_url,))
+        self.assertFalse(subscription.deliveries.exists())
+
+    @override_settings(SERVICE_CIRCUIT_THRESHOLD=2)
+    def test_concurrent_failures_are_all_counted(self):
+        # Given two workers holding the same service
+        other = models.Service.objects.get(id=self.service.id)
+
+        # When both count a failure
+        self.service.record_failure('503')
+        other.record_failure('503')
+
+        # Then neither failure is lost and the circuit opens at the threshold
+        self.service.refresh_from_db()
+        self.assertEqual(self.service.consecutive_failures, 2)
+        self.assertEqual(other.consecutive_failures, 2)
+        self.assertIsNotNone(self.service.circuit_open_until)
+
+    @override_settings(DELIVERY_MAX_ATTEMPTS=2)
+    def test_dead_letters_are_replayed(self):
+        # Given a delivery that has failed the maximum number of times
+        delivery = self.queue_delivery()
+        for _ in range(2):
+            models.Delivery.objects.update(next_attempt_at=timezone.now())
+            with MockSubscriptionRequests(status_code=503):
+                call_command('process_deliveries', '--once')
+
+        # Then it is moved to the dead letters
+        self.assertFalse(models.Delivery.objects.exists())
+        dead_letter = models.DeadLetter.objects.get()
+        self.assertEqual((dead_letter.values, dead_letter.attempts), (delivery.values, 2))
+
+        # And once replayed, it is submitted by the delivery worker
+        call_command('replay_dead_letters', '--service', self.service.name, stdout=io.StringIO())
+        self.assertFalse(models.DeadLetter.objects.exists())
+        with self.mock_requests:
+            call_command('process_deliveries', '--once')
+        self.assertEqual(self.mock_requests.last_request[1]['json']['values'], json.loads(delivery.values))
+        self.assertFalse(models.Delivery.objects.exists())
+
+    def test_delivery_encoding(self):
+        # Given a service that receives data as gzip-compressed columnar JSON
+        self.service.data_encoding = payloads.COLUMNAR_GZIP
+        self.service.save()
+        delivery = self.queue_delivery()
+
+        # When the delivery worker submits new data
+        with self.mock_requests:
+            call_command('process_deliveries', '--once')
+
+        # Then it is sent in the columnar layout with the service's encoding
+        (_, kwargs) = self.mock_requests.last_request
+        self.assertEqual(kwargs['headers']['Content-Encoding'], 'gzip')
+        data = payloads.decode(kwargs['data'], kwargs['headers'])
+        self.assertEqual(data['values'], payloads.columns(json.loads(delivery.values)))
+        self.assertEqual(data['auth_token'], str(self.service.auth_token))
+
+    def test_batched_deliveries(self):
+        # Given a service that collects data in a batch window
+        self.service.batch_window = 60
+        self.service.save()
+
+        # And given two subscriptions to the service for different attributes
+        humidity = models.SensorAttribute.objects.create(
+            description='humidity', uri='http://www.yso.fi/onto/yso/p6453')
+        subscriptions = []
+        for attr in (self.temperature, humidity):
+            subscription = self.user.subscriptions.create(service=self.service)
+            subscription.attributes.add(self.apsen.attributes.create(attribute=attr))
+            subscriptions.append(subscription)
+
+        # When new data arrives twice for the subscribed attributes
+        self.client.post(reverse('digita-gw'), sensor_data_package, format='json')
+        self.client.post(reverse('digita-gw'), sensor_data_package, format='json')
+        self.assertEqual(models.Delivery.objects.count(), 4)
+
+        # Then nothing is submitted before the batch window has passed
+        with self.mock_requests:
+            call_command('process_deliveries', '--once')
+        self.assertIsNone(self.mock_requests.last_request)
+
+        # And once the oldest delivery is due, all queued data is submitted in one combined request
+        delivery = models.Delivery.objects.earliest('id')
+        delivery.next_attempt_at = timezone.now()
+        delivery.save()
+        with self.mock_requests:
+            call_command('process_deliveries', '--once')
+
+        ([url], kwargs) = self.mock_requests.last_request
+        self.assertEqual(url, self.service.data_url)
+        self.assertEqual(kwargs['json']['auth_token'], str(self.service.auth_token))
+        self.assertEqual(
+            [(item['uuid'], len(item['values'])) for item in kwargs['json']['subscriptions']],
+            [(str(subscription.uuid), 2) for subscription in subscriptions])
+        self.assertFalse(models.Delivery.objects.exists())
+
+    def test_full_batch_is_submitted_before_window(self):
+        # Given a service that collects data in a batch window of at most two deliveries
+        self.service.batch_window = 60
+        self.service.batch_size = 2
+        self.service.save()
+        subscription = self.user.subscriptions.create(service=self.service)
+        subscription.attributes.add(self.apsen.attributes.create(attribute=self.temperature))
+
+        # When a full batch of data has been queued
+        self.client.post(reverse('digita-gw'), sensor_data_package, format='json')
+        self.client.post(reverse('digita-gw'), sensor_data_package, format='json')
+
+        # Then the batch is submitted right away
+        with self.mock_requests:
+            call_command('process_deliveries', '--once')
+        self.assertEqual(len(self.mock_requests.last_request[1]['json']['subscriptions'][0]['values']), 2)
+        self.assertFalse(models.Delivery.objects.exists())
+
+    @override_settings(HISTORY_PAGE_SIZE=2)
+    def test_history_is_submitted_in_resumable_pages(self):
+        # Given a subscription with history requested for an attribute with five stored values
+        apsen_attr = self.apsen.attributes.create(attribute=self.temperature)
+        values = [apsen_attr.values.create(value=20 + i) for i in range(5)]
+        subscription = self.user.subscriptions.create(service=self.service)
+        subscription.attributes.add(apsen_attr)
+        subscription.request_history()
+
+        # When the external service fails after the first page
+        payloads = []
+
+        def post(_self, *args, **kwargs):
+            payloads.append(kwargs['json'])
+            return MockSubscriptionRequests.mock_response(200 if len(payloads) < 2 else 503)
+
+        with MockSubscriptionRequests():
+            models.Subscription._post = post
+            models.Subscription.process_pending_history()
+
+        # Then the first page is submitted and its progress recorded
+        self.assertEqual([value['value'] for value in payloads[0]['values']], ['20.0', '21.0'])
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.history_cursor, values[1].id)
+        self.assertEqual(subscription.history_until, values[-1].id)
+
+        # And the submission resumes from the failed page once the service recovers
+        with self.mock_requests:
+            call_command('process_deliveries', '--once')
+        subscription.refresh_from_db()
+        self.assertIsNone(subscription.history_until)
+        self.assertEqual(
+            [value['value'] for value in self.mock_requests.last_request[1]['json']['values']], ['24.0'])
+
+    @override_settings(HISTORY_PAGE_SIZE=2)
+    def test_history_progress_survives_unexpected_errors(self):
+        # Given a subscription with history requested for five values
+        apsen_attr = self.apsen.attributes.create(attribute=self.temperature)
+        values = [apsen_attr.values.create(value=20 + i) for i in range(5)]
+        subscription = self.user.subscriptions.create(service=self.service)
+        subscription.attributes.add(apsen_attr)
+        subscription.request_history()
+
+        # When sending the second page fails with an unexpected error
+        pages = []
+
+        def post(_self, *args, **kwargs):
+            pages.append(kwargs['json'])
+            if len(pages) == 2:
+                raise ValueError('Unexpected')
+            return MockSubscriptionRequests.mock_response(200)
+
+        with MockSubscriptionRequests(), self.assertRaises(ValueError):
+            models.Subscription._post = post
+            models.Subscription.process_pending_history()
+
+        # Then the first page is recorded as sent and the submission is released for the next attempt
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.history_cursor, values[1].id)
+        self.assertIsNone(subscription.history_leased_until)
+
+    def test_claimed_history_is_skipped(self):
+        # Given a subscription whose history is being submitted by another worker
+        apsen_attr = self.apsen.attributes.create(attribute=self.temperature)
+        apsen_attr.values.create(value=20)
+        subscription = self.user.subscriptions.create(service=self.service)
+        subscription.attributes.add(apsen_attr)
+        subscription.request_history()
+        self.assertTrue(subscription.claim_history())
+
+        # Then it is not submitted again until the lease of the other worker expires
+        with self.mock_requests:
+            self.assertEqual(models.Subscription.process_pending_history(), 0)
+            models.Subscription.objects.update(history_leased_until=timezone.now())
+            self.assertEqual(models.Subscription.process_pending_history(), 1)
+        subscription.refresh_from_db()
+        self.assertEqual((subscription.history_until, subscription.history_leased_until), (None, None))
+
+    @override_settings(SUBSCRIPTION_OUTBOX=False)
+    def test_history_is_queued_without_outbox(self):
+        # Given that values are sent inline
+        self.client.force_login(self.user)
+        apsen_attr = self.apsen.attributes.create(attribute=self.temperature)
+        apsen_attr.values.create(value=22.0)
+
+        # When subscribing with history
+        with self.mock_requests:
+            response = self.client.post(self.url, {
+                'service': self.service.id, 'attributes': [apsen_attr.id], 'include_history': True})
+
+        # Then the history is still left for the delivery worker instead of being sent by the request
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(self.mock_requests.last_request[0], (self.service.subscribe_url,))
+        self.assertIsNotNone(models.Subscription.objects.get().history_until)
+
+    def test_history_is_submitted_as_rollups(self):
+        # Given a service receiving history as hourly rollups and values stored during the past and current hour
+        self.service.history_resolution = models.ApartmentSensorRollup.HOUR
+        self.service.save()
+        apsen_attr = self.apsen.attributes.create(attribute=self.temperature)
+        for value in (20, 22, 24):
+            apsen_attr.values.create(value=value)
+        models.ApartmentSensorRollup.objects.update(period_start=F('period_start') - timedelta(hours=1))
+        apsen_attr.values.create(value=30)
+
+        # When history is requested for a new subscription
+        subscription = self.user.subscriptions.create(service=self.service)
+        subscription.attributes.add(apsen_attr)
+        subscription.request_history()
+        with self.mock_requests:
+            call_command('process_deliveries', '--once')
+
+        # Then the past hour is submitted as one aggregate, but the incomplete current hour is not
+        values = self.mock_requests.last_request[1]['json']['values']
+        self.assertEqual(len(values), 1)
+        self.assertEqual(values[0]['value'], '22.0')
+        self.assertEqual((values[0]['min'], values[0]['max'], values[0]['count']), ('20.0', '24.0', 3))
+
+
+class DeliveryWorkerTest(SubscriptionFixtures, TransactionTestCase):
+    """
+    The worker commits what it claims before submitting it and sends alerts once the results are committed, which
+    TestCase never does.
+    """
+    client_class = APIClient
+    mock_requests = MockSubscriptionRequests()
+
+    def setUp(self):
+        decoders.clear_cache()
+        ingest.clear_caches()
+        super().setUp()
+
+    def tearDown(self):
+        decoders.clear_cache()
+        ingest.clear_caches()
+
+    def test_services_are_called_outside_of_transactions(self):
+        # Given a queued delivery
+        self.queue_delivery()
+
+        # When it is submitted
+        in_transaction = []
+
+        def post(_self, *args, **kwargs):
+            in_transaction.append(transaction.get_connection().in_atomic_block)
+            return MockSubscriptionRequests.mock_response(200)
+
+        with MockSubscriptionRequests():
+            models.Subscription._post = post
+            call_command('process_deliveries', '--once')
+
+        # Then no transaction is held open while waiting for the service
+        self.assertEqual(in_transaction, [False])
+        self.assertFalse(models.Delivery.objects.exists())
+
+    def test_claimed_deliveries_are_skipped(self):
+        # Given a delivery claimed by another worker
+        self.queue_delivery()
+        models.Delivery.objects.update(leased_until=timezone.now() + timedelta(minutes=1))
+
+        # Then it is not attempted until the lease of the other worker expires
+        with self.mock_requests:
+            self.assertEqual(models.Delivery.process_pending(), 0)
+            models.Delivery.objects.update(leased_until=timezone.now())
+            self.assertEqual(models.Delivery.process_pending(), 1)
+        self.assertFalse(models.Delivery.objects.exists())
+
+    @override_settings(SERVICE_CIRCUIT_THRESHOLD=2, ADMINS=[('Admin', 'admin@localhost')])
+    def test_circuit_opens_after_consecutive_failures(self):
+        # Given that new data has been queued for a subscription
+        self.queue_delivery()
+
+        # When the delivery fails as many times in a row as the threshold
+        for _ in range(2):
+            models.Delivery.objects.update(next_attempt_at=timezone.now())
+            with MockSubscriptionRequests(status_code=503):
+                call_command('process_deliveries', '--once')
+
+        # Then the circuit of the service is opened and admins are alerted once
+        self.service.refresh_from_db()
+        self.assertEqual(self.service.consecutive_failures, 2)
+        self.assertGreater(self.service.circuit_open_until, timezone.now())
+        self.assertEqual(len(mail.outbox), 1)
+
+        # And the delivery is not attempted while the circuit is open
+        models.Delivery.objects.update(next_attempt_at=timezone.now())
+        with self.mock_requests:
+            call_command('process_deliveries', '--once')
+        self.assertIsNone(self.mock_requests.last_request)
+
+        # And once the circuit closes and the delivery succeeds, the failures are reset
+        models.Service.objects.update(circuit_open_until=timezone.now())
+        with self.mock_requests:
+            call_command('process_deliveries', '--once')
+        self.assertFalse(models.Delivery.objects.exists())
+        self.service.refresh_from_db()
+        self.assertEqual((self.service.consecutive_failures, self.service.circuit_open_until), (0, None))
+
+    @override_settings(SERVICE_CIRCUIT_THRESHOLD=1, ADMINS=[('Admin', 'admin@localhost')])
+    def test_outage_alerts_are_rate_limited(self):
+        # Given that admins have been alerted of an outage of a service
+        self.service.record_failure('503')
+        self.service.record_success()
+
+        # When the service fails again
+        self.service.record_failure('503')
+
+        # Then admins are not alerted again within the alert interval
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn('replay_dead_letters', mail.outbox[0].body)
+
+
+@override_settings(SUBSCRIPTION_OUTBOX=False)
+class InlineDeliveryTest(SubscriptionFixtures, TransactionTestCase):
+    """
+    Values are sent inline once the transaction storing them commits, which TestCase never does.
+    """
+    client_class = APIClient
+
+    def setUp(self):
+        decoders.clear_cache()
+        ingest.clear_caches()
+        super().setUp()
+
+    def tearDown(self):
+        decoders.clear_cache()
+        ingest.clear_caches()
+
+    def test_inline_delivery_failure_is_queued(self):
+        # Given a subscription to a service that can not be connected to
+        apsen_attr = self.apsen.attributes.create(attribute=self.temperature)
+        self.user.subscriptions.create(service=self.service).attributes.add(apsen_attr)
+
+        def post(_self, *args, **kwargs):
+            raise requests.ConnectionError('Connection refused')
+
+        # When new data arrives with the outbox disabled
+        with MockSubscriptionRequests():
+            models.Subscription._post = post
+            response = self.client.post(reverse('digita-gw'), sensor_data_package, format='json')
+
+        # Then the gateway request succeeds and the data is queued for a retry
+        self.assertEqual(200, response.status_code)
+        delivery = models.Delivery.objects.get()
+        self.assertEqual((delivery.attempts, delivery.last_error), (1, 'Connection refused'))
+        self.assertGreater(delivery.next_attempt_at, timezone.now())
+        self.service.refresh_from_db()
+        self.assertEqual(self.service.consecutive_failures, 1)
+
+    def test_unexpected_inline_error_is_queued(self):
+        # Given subscriptions to two services, one of which fails with an unexpected error
+        apsen_attr = self.apsen.attributes.create(attribute=self.temperature)
+        other_service = models.Service.objects.create(data_url='https://other.com/api/measurements/')
+        for service in (self.service, other_service):
+            self.user.subscriptions.create(service=service).attributes.add(apsen_attr)
+
+        def post(_self, url, *args, **kwargs):
+            if url == self.service.data_url:
+                raise ValueError('Unexpected')
+            return MockSubscriptionRequests.mock_response(200)
+
+        # When new data arrives with the outbox disabled
+        with MockSubscriptionRequests(), self.assertLogs('core.models.subscription', 'ERROR'):
+            models.Subscription._post = post
+            response = self.client.post(reverse('digita-gw'), sensor_data_package, format='json')
+
+        # Then the stored data is not lost for the failing service, but queued for a retry
+        self.assertEqual(200, response.status_code)
+        delivery = models.Delivery.objects.get()
+        self.assertEqual(delivery.subscription.service, self.service)
+        self.assertEqual((delivery.attempts, delivery.last_error), (1, 'Unexpected'))
+
+    def test_inline_values_are_queued_if_sending_fails(self):
+        # Given a subscription
+        apsen_attr = self.apsen.attributes.create(attribute=self.temperature)
+        self.user.subscriptions.create(service=self.service).attributes.add(apsen_attr)
+
+        # When sending the stored values fails before any service is called
+        with patch.object(models.Service.objects, 'in_bulk', side_effect=RuntimeError('Unexpected')), \
+                self.assertLogs('core.models.subscription', 'ERROR'):
+            response = self.client.post(reverse('digita-gw'), sensor_data_package, format='json')
+
+        # Then they are queued instead
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(models.Delivery.objects.get().attempts, 0)
+
+    def test_inline_delivery_to_several_services(self):
+        # Given subscriptions to two services for the same attribute
+        apsen_attr = self.apsen.attributes.create(attribute=self.temperature)
+        other_service = models.Service.objects.create(data_url='https://other.com/api/measurements/')
+        for service in (self.service, other_service):
+            self.user.subscriptions.create(service=service).attributes.add(apsen_attr)
+
+        # When new data arrives with the outbox disabled
+        urls = []
+        mock = MockSubscriptionRequests()
+        with mock:
+            post = models.Subscription._post
+
+            def record(_self, *args, **kwargs):
+                urls.append(args[0])
+                return post(_self, *args, **kwargs)
+            models.Subscription._post = record
+            response = self.client.post(reverse('digita-gw'), sensor_data_package, format='json')
+
+        # Then the data is submitted to both services while handling the request
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(sorted(urls), sorted([self.service.data_url, other_service.data_url]))
+        self.assertFalse(models.Delivery.objects.exists())
+
+    def test_values_are_not_sent_before_commit(self):
+        # Given a subscription
+        apsen_attr = self.apsen.attributes.create(attribute=self.temperature)
+        self.user.subscriptions.create(service=self.service).attributes.add(apsen_attr)
+        mock = MockSubscriptionRequests()
+
+        # When new values are handled in a transaction that is rolled back, e.g. to retry storing them
+        with mock, self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                value = apsen_attr.values.create(value=20)
+                models.Subscription.handle_new_values([value])
+                raise IntegrityError
+
+        # Then nothing is sent
+        self.assertIsNone(mock.last_request)
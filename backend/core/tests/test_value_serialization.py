@@ -0,0 +1,49 @@
+import json
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from core.models import ApartmentSensor, ApartmentSensorValue, SensorAttribute
+from core.models.subscription import VALUE_COLUMNS, ApartmentSensorValueSerializer, serialize_values
+
+
+class ValueSerializationTest(APITestCase):
+    def setUp(self):
+        apsen = ApartmentSensor.objects.create(identifier='A1')
+        self.apsen_attr = apsen.attributes.create(attribute=SensorAttribute.objects.create(description='co2'))
+
+    def assertSerializedAlike(self, values):
+        """
+        Assert that the fast path serializes `values` to the same JSON as ApartmentSensorValueSerializer.
+        """
+        expected = json.dumps(ApartmentSensorValueSerializer(values, many=True).data)
+        rows = [(value.apartment_sensor_attribute_id, value.value, value.updated_at) for value in values]
+        self.assertEqual(json.dumps(serialize_values(rows)), expected)
+
+    def test_stored_values(self):
+        # Given stored values with rounded, negative and whole values and timestamps with and without microseconds
+        now = timezone.now()
+        for i, value in enumerate(['21.5', '-3.2', '400', '0', '1234567.8']):
+            created = self.apsen_attr.values.create(value=value)
+            updated_at = now.replace(microsecond=0) if i % 2 else now - timedelta(seconds=i)
+            ApartmentSensorValue.objects.filter(id=created.id).update(updated_at=updated_at)
+        values = ApartmentSensorValue.objects.order_by('id')
+
+        # Then the rows of values_list are serialized like the model instances
+        expected = json.dumps(ApartmentSensorValueSerializer(values, many=True).data)
+        self.assertEqual(json.dumps(serialize_values(values.values_list(*VALUE_COLUMNS))), expected)
+
+    def test_decoded_values(self):
+        # Values created by ingest hold the decoded numbers until they are read back
+        updated_at = timezone.make_aware(datetime(2020, 1, 1, 12, 0, 0, 500))
+        self.assertSerializedAlike([
+            ApartmentSensorValue(apartment_sensor_attribute_id=self.apsen_attr.id, value=value, updated_at=updated_at)
+            for value in [20.5, 20.25, 20.35, 3, Decimal('7.55'), None]
+        ])
+
+    def test_current_time_zone(self):
+        value = ApartmentSensorValue(value='1.0', updated_at=timezone.make_aware(datetime(2020, 6, 1, 12)))
+        with timezone.override('Europe/Helsinki'):
+            self.assertSerializedAlike([value])
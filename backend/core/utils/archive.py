@@ -0,0 +1,80 @@
+"""
+Archival of expired raw sensor values.
+
+Values older than the retention period are exported to gzip-compressed CSV files, one per month and apartment
+sensor attribute, and then deleted from the database in small batches, each in its own transaction, so that the
+table is never locked for long. Rollups are kept forever and are not affected.
+
+Files are appended to, so that values can be archived in any number of runs. A run that is interrupted between
+exporting and deleting a batch exports that batch again on the next run, so an archive may contain some values
+twice.
+"""
+import csv
+import gzip
+import os
+import time
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from core.models import ApartmentSensorAttribute, ApartmentSensorRollup, ApartmentSensorValue
+from core.utils.partitions import month_start
+
+COLUMNS = ('id', 'updated_at', 'value')
+
+
+def retention_cutoff(days, now=None):
+    """
+    Return the start of the oldest day of which values are kept when keeping `days` days of values. Only whole days
+    are archived, so that the rollups of the days kept can be rebuilt from their values.
+    """
+    return ApartmentSensorRollup.period(ApartmentSensorRollup.DAY, (now or timezone.now()) - timedelta(days=days))
+
+
+def archive_path(directory, attr_id, month):
+    return os.path.join(directory, f'{month:%Y-%m}', f'attribute-{attr_id}.csv.gz')
+
+
+def write_values(directory, attr_id, rows):
+    """
+    Append the (id, updated_at, value) `rows` of one attribute, in time order, to the archive files of their months.
+    """
+    by_month = {}
+    for row in rows:
+        by_month.setdefault(month_start(row[1].astimezone(timezone.utc)), []).append(row)
+    for month, month_rows in by_month.items():
+        path = archive_path(directory, attr_id, month)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        new = not os.path.exists(path)
+        with gzip.open(path, 'at', newline='') as f:
+            writer = csv.writer(f)
+            if new:
+                writer.writerow(COLUMNS)
+            writer.writerows((value_id, updated_at.isoformat(), value) for value_id, updated_at, value in month_rows)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def archive_values(before, directory, batch_size=1000, pause=0):
+    """
+    Export the values stored before `before` to `directory` and delete them, one attribute and batch at a time,
+    sleeping `pause` seconds between batches. Yields the attribute id and number of values archived of every
+    attribute with expired values.
+    """
+    for attr_id in list(ApartmentSensorAttribute.objects.order_by('id').values_list('id', flat=True)):
+        values = ApartmentSensorValue.objects.filter(apartment_sensor_attribute=attr_id, updated_at__lt=before)
+        values = values.order_by('updated_at', 'id').values_list(*COLUMNS)
+        count = 0
+        while True:
+            rows = list(values[:batch_size])
+            if not rows:
+                break
+            write_values(directory, attr_id, rows)
+            with transaction.atomic():
+                ApartmentSensorValue.objects.filter(id__in=[row[0] for row in rows]).delete()
+            count += len(rows)
+            if pause:
+                time.sleep(pause)
+        if count:
+            yield attr_id, count
@@ -0,0 +1,140 @@
+"""
+Helpers for the benchmark management commands.
+
+Benchmarks run against a throwaway test database created from the configured database settings, so their results
+reflect the configured database engine (PostgreSQL in production, SQLite when configured so) without touching the
+data in it.
+"""
+import json
+import platform
+import statistics
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import django
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from django.utils import timezone
+
+
+@contextmanager
+def test_database(verbosity=0):
+    """
+    Run the block against a freshly created test database, destroyed afterwards.
+    """
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=verbosity, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+        teardown_test_environment()
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.requests += 1
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@contextmanager
+def stub_service():
+    """
+    Run a local HTTP server accepting any POST with 200 OK and yield it. Its URL is `server.url` and the number of
+    requests received `server.requests`.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+    server.daemon_threads = True
+    server.requests = 0
+    server.url = f'http://127.0.0.1:{server.server_port}/'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class Recorder:
+    """
+    Records the latency and number of queries of repeated operations.
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.queries = []
+
+    @contextmanager
+    def measure(self):
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            yield
+            self.latencies.append(time.perf_counter() - start)
+        self.queries.append(len(context.captured_queries))
+
+    def summary(self):
+        """
+        Return the number of operations, total time in seconds, and p50/p99 latency and mean queries per operation.
+        """
+        if not self.latencies:
+            return {'count': 0}
+        return {
+            'count': len(self.latencies),
+            'seconds': round(sum(self.latencies), 4),
+            'p50_ms': round(percentile(self.latencies, 50) * 1000, 3),
+            'p99_ms': round(percentile(self.latencies, 99) * 1000, 3),
+            'queries': round(statistics.mean(self.queries), 2),
+        }
+
+
+def percentile(values, percent):
+    """
+    Return the `percent` percentile of `values` with linear interpolation between the closest ranks.
+    """
+    values = sorted(values)
+    rank = (len(values) - 1) * percent / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def environment():
+    """
+    Return information about the environment to store with benchmark results.
+    """
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': timezone.now().isoformat(),
+        'database': connection.vendor,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+    }
+
+
+def write_results(path, benchmark, parameters, results):
+    """
+    Write benchmark results as JSON to `path` and return them.
+    """
+    data = {'benchmark': benchmark, 'environment': environment(), 'parameters': parameters, 'results': results}
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.write('\n')
+    return data
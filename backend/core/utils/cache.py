@@ -0,0 +1,73 @@
+"""
+Bounded in-process caches for mappings that rarely change, such as the ids of objects by their natural keys.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.db import transaction
+
+
+class LRUCache:
+    """
+    A thread-safe mapping holding at most `maxsize` entries, each for at most `ttl` seconds, evicting the least
+    recently used entries first.
+
+    Entries looked up from the database should be added with `set_many_on_commit`, so that the cache never holds
+    data of transactions that are rolled back or data read before the cache was last cleared.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        """
+        Return a dict of the cached values of `keys`, leaving out missing and expired ones.
+        """
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = self._data.get(key)
+                if entry is None:
+                    continue
+                value, expires = entry
+                if expires < now:
+                    del self._data[key]
+                    continue
+                self._data.move_to_end(key)
+                found[key] = value
+        return found
+
+    def set_many(self, items, generation=None):
+        """
+        Cache the values of the `items` dict, unless the cache has been cleared since `generation`.
+        """
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            for key, value in items.items():
+                self._data[key] = (value, expires)
+                self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def set_many_on_commit(self, items):
+        """
+        Cache the values of the `items` dict once the current transaction commits.
+        """
+        generation = self.generation
+        transaction.on_commit(lambda: self.set_many(items, generation))
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.generation += 1
+
+    def __len__(self):
+        return len(self._data)
@@ -1,5 +1,17 @@
+"""
+Decoder for the payloads of Elsys sensors.
+
+A payload is a sequence of measurements, each a type byte followed by a fixed number of data bytes. The decoder is
+driven by `TYPES`, a table of the data length, precompiled big-endian `struct.Struct` format, scale and field names
+of every type. A payload with an unknown type or a truncated measurement is rejected with ElsysDecodeError, since
+the length of an unknown measurement, and thus where the next one starts, can not be known.
+
+`decode_elsys_payloads` decodes many payloads at once into a NumPy structured array, for replay and backfill jobs.
+It requires NumPy, which is not needed otherwise.
+"""
 import binascii
-import logging
+import struct
+from collections import OrderedDict, namedtuple
 
 TYPE_TEMP = 0x01  # temp 2 bytes -3276.8°C -->3276.7°C
 TYPE_RH = 0x02  # Humidity 1 byte  0-100%
@@ -11,6 +23,85 @@ TYPE_VDD = 0x07  # VDD 2byte 0-65535mV
 TYPE_ANALOG1 = 0x08  # VDD 2byte 0-65535mV
 TYPE_GPS = 0x09  # 3bytes lat 3bytes long binary
 TYPE_PULSE1 = 0x0A  # 2bytes relative pulse count
+TYPE_PULSE1_ABS = 0x0B  # 4bytes no 0->0xFFFFFFFF
+TYPE_EXT_TEMP1 = 0x0C  # 2bytes -3276.5C-->3276.5C
+TYPE_EXT_DIGITAL = 0x0D  # 1bytes value 1 or 0
+TYPE_EXT_DISTANCE = 0x0E  # 2bytes distance in mm
+TYPE_ACC_MOTION = 0x0F  # 1byte number of vibration/motion
+TYPE_IR_TEMP = 0x10  # 2bytes internal temp 2bytes external temp -3276.5C-->3276.5C
+TYPE_OCCUPANCY = 0x11  # 1byte data
+TYPE_WATERLEAK = 0x12  # 1byte data 0-255
+TYPE_GRIDEYE = 0x13  # 65byte temperature data 1byte ref+64byte external temp
+TYPE_PRESSURE = 0x14  # 4byte pressure data (hPa)
+TYPE_SOUND = 0x15  # 2byte sound data (peak/avg)
+TYPE_PULSE2 = 0x16  # 2bytes 0-->0xFFFF
+TYPE_PULSE2_ABS = 0x17  # 4bytes no 0->0xFFFFFFFF
+TYPE_ANALOG2 = 0x18  # 2bytes voltage in mV
+TYPE_EXT_TEMP2 = 0x19  # 2bytes -3276.5C-->3276.5C
+TYPE_EXT_DIGITAL2 = 0x1A  # 1bytes value 1 or 0
+TYPE_EXT_ANALOG_UV = 0x1B  # 4 bytes signed int (uV)
+TYPE_TVOC = 0x1C  # 2 bytes (ppb)
+TYPE_DEBUG = 0x3D  # 4bytes debug
+
+
+class ElsysDecodeError(ValueError):
+    """
+    Raised when a payload can not be decoded.
+    """
+
+
+def _u24(high, low):
+    return high * 0x10000 + low
+
+
+ElsysType = namedtuple('ElsysType', 'name length struct scale fields convert')
+
+
+def _type(name, fmt, fields, scale=1, convert=None):
+    """
+    Define a measurement type with data in `fmt`, a big-endian struct format, unpacked into `fields`. Values are
+    divided by `scale`; `convert`, if given, combines the unpacked values into the values of the fields.
+    """
+    compiled = struct.Struct('>' + fmt)
+    return ElsysType(name, compiled.size, compiled, scale, fields, convert)
+
+
+TYPES = {
+    TYPE_TEMP: _type('temperature', 'h', ('temperature',), scale=10),
+    TYPE_RH: _type('humidity', 'B', ('humidity',)),
+    TYPE_ACC: _type('acceleration', 'bbb', ('x', 'y', 'z')),
+    TYPE_LIGHT: _type('light', 'H', ('light',)),
+    TYPE_MOTION: _type('motion', 'B', ('motion',)),
+    TYPE_CO2: _type('co2', 'H', ('co2',)),
+    TYPE_VDD: _type('vdd', 'H', ('vdd',)),
+    TYPE_ANALOG1: _type('analog1', 'H', ('analog1',)),
+    TYPE_GPS: _type('gps', 'BHBH', ('lat', 'long'), convert=lambda a, b, c, d: (_u24(a, b), _u24(c, d))),
+    TYPE_PULSE1: _type('pulse1', 'H', ('pulse1',)),
+    TYPE_PULSE1_ABS: _type('pulse1_abs', 'I', ('pulse1_abs',)),
+    TYPE_EXT_TEMP1: _type('external_temperature', 'h', ('external_temperature',), scale=10),
+    TYPE_EXT_DIGITAL: _type('digital', 'B', ('digital',)),
+    TYPE_EXT_DISTANCE: _type('distance', 'H', ('distance',)),
+    TYPE_ACC_MOTION: _type('acc_motion', 'B', ('acc_motion',)),
+    TYPE_IR_TEMP: _type(
+        'ir_temperature', 'hh', ('ir_internal_temperature', 'ir_external_temperature'), scale=10),
+    TYPE_OCCUPANCY: _type('occupancy', 'B', ('occupancy',)),
+    TYPE_WATERLEAK: _type('waterleak', 'B', ('waterleak',)),
+    # Grid-EYE frames are skipped, as they are not a single measurement
+    TYPE_GRIDEYE: _type('grideye', '65x', ()),
+    TYPE_PRESSURE: _type('pressure', 'I', ('pressure',), scale=1000),
+    TYPE_SOUND: _type('sound', 'BB', ('sound_peak', 'sound_avg')),
+    TYPE_PULSE2: _type('pulse2', 'H', ('pulse2',)),
+    TYPE_PULSE2_ABS: _type('pulse2_abs', 'I', ('pulse2_abs',)),
+    TYPE_ANALOG2: _type('analog2', 'H', ('analog2',)),
+    TYPE_EXT_TEMP2: _type('external_temperature2', 'h', ('external_temperature2',), scale=10),
+    TYPE_EXT_DIGITAL2: _type('digital2', 'B', ('digital2',)),
+    TYPE_EXT_ANALOG_UV: _type('analog_uv', 'i', ('analog_uv',)),
+    TYPE_TVOC: _type('tvoc', 'H', ('tvoc',)),
+    TYPE_DEBUG: _type('debug', '4x', ()),
+}
+
+# Every field a payload can contain, in table order
+FIELDS = tuple(OrderedDict.fromkeys(field for elsys_type in TYPES.values() for field in elsys_type.fields))
 
 
 def bin16dec(value):
@@ -27,63 +118,104 @@ def bin8dec(value):
     return num
 
 
-def decode_elsys_payload(data):
-    obj = {}
-
+def payload_layout(data):
+    """
+    Return the measurements of a payload as a list of (data offset, ElsysType) tuples.
+    """
+    layout = []
     i = 0
     while i < len(data):
-        val = data[i]
-
-        if val == TYPE_TEMP:
-            temp = (data[i + 1] << 8) | (data[i + 2])
-            temp = bin16dec(temp)
-            obj['temperature'] = temp / 10
-            i += 2
-        elif val == TYPE_RH:
-            rh = data[i + 1]
-            obj['humidity'] = rh
-            i += 1
-        elif val == TYPE_ACC:
-            obj['x'] = bin8dec(data[i + 1])
-            obj['y'] = bin8dec(data[i + 2])
-            obj['z'] = bin8dec(data[i + 3])
-            i += 3
-        elif val == TYPE_LIGHT:
-            light = (data[i + 1] << 8) | (data[i + 2])
-            obj['light'] = light
-            i += 2
-        elif val == TYPE_MOTION:
-            motion = data[i + 1]
-            obj['motion'] = motion
-            i += 1
-        elif val == TYPE_CO2:
-            co2 = (data[i + 1] << 8) | (data[i + 2])
-            obj['co2'] = co2
-            i += 2
-        elif val == TYPE_VDD:
-            vdd = (data[i + 1] << 8) | (data[i + 2])
-            obj['vdd'] = vdd
-            i += 2
-        elif val == TYPE_ANALOG1:
-            analog1 = (data[i + 1] << 8) | (data[i + 2])
-            obj['analog1'] = analog1
-            i += 2
-        elif val == TYPE_GPS:
-            obj['lat'] = (data[i + 1] << 16) | (data[i + 2] << 8) | (data[i + 3])
-            obj['long'] = (data[i + 4] << 16) | (data[i + 5] << 8) | (data[i + 6])
-            i += 6
-        elif val == TYPE_PULSE1:
-            pulse1 = (data[i + 1] << 8) | (data[i + 2])
-            obj['pulse1'] = pulse1
-            i += 2
-        else:
-            logging.warning(f'Unsupported value {val}')
-
-        i += 1  # compensate for first byte
+        elsys_type = TYPES.get(data[i])
+        if elsys_type is None:
+            raise ElsysDecodeError(f'Unknown type 0x{data[i]:02x} at byte {i}')
+        if i + 1 + elsys_type.length > len(data):
+            raise ElsysDecodeError(
+                f'Truncated {elsys_type.name} at byte {i}: expected {elsys_type.length} bytes, '
+                f'got {len(data) - i - 1}')
+        layout.append((i + 1, elsys_type))
+        i += 1 + elsys_type.length
+    return layout
 
+
+def _scaled(elsys_type, values):
+    if elsys_type.convert:
+        values = elsys_type.convert(*values)
+    if elsys_type.scale != 1:
+        values = [value / elsys_type.scale for value in values]
+    return values
+
+
+def decode_elsys_payload(data):
+    """
+    Decode a payload into a dict of field name: value. If a type occurs several times the last value is returned.
+    """
+    obj = {}
+    for offset, elsys_type in payload_layout(data):
+        values = _scaled(elsys_type, elsys_type.struct.unpack_from(data, offset))
+        obj.update(zip(elsys_type.fields, values))
     return obj
 
 
+_NUMPY_FORMATS = {'b': 'i1', 'B': 'u1', 'h': '>i2', 'H': '>u2', 'i': '>i4', 'I': '>u4'}
+
+
+def _layout_dtype(np, layout, size):
+    """
+    Return a NumPy dtype matching the raw values of payloads of `size` bytes with the given layout.
+    """
+    names, formats, offsets = [], [], []
+    for index, (offset, elsys_type) in enumerate(layout):
+        fmt = elsys_type.struct.format.lstrip('>')
+        for code in fmt if 'x' not in fmt else '':
+            names.append(f'{index}_{len(names)}')
+            formats.append(_NUMPY_FORMATS[code])
+            offsets.append(offset)
+            offset += struct.calcsize('>' + code)
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': size})
+
+
+def decode_elsys_payloads(payloads, strict=True):
+    """
+    Decode a sequence of payloads into a NumPy structured array with a float64 column for every field in `FIELDS`,
+    NaN where a payload has no value for it, and a boolean `valid` column.
+
+    Payloads with the same layout are decoded together, with a single vectorised read of their raw bytes. Payloads
+    that can not be decoded raise ElsysDecodeError, or are marked invalid if `strict` is false.
+    """
+    import numpy as np
+
+    result = np.zeros(len(payloads), dtype=[(field, 'f8') for field in FIELDS] + [('valid', '?')])
+    for field in FIELDS:
+        result[field] = np.nan
+
+    groups = OrderedDict()
+    for index, data in enumerate(payloads):
+        data = bytes(data)
+        try:
+            layout = payload_layout(data)
+        except ElsysDecodeError as err:
+            if strict:
+                raise ElsysDecodeError(f'Payload {index}: {err}')
+            continue
+        key = (len(data), tuple((offset, elsys_type.name) for offset, elsys_type in layout))
+        group = groups.setdefault(key, (layout, [], []))
+        group[1].append(index)
+        group[2].append(data)
+
+    for (size, _), (layout, indexes, datas) in groups.items():
+        raw = np.frombuffer(b''.join(datas), dtype=_layout_dtype(np, layout, size)) if size else None
+        rows = np.array(indexes)
+        result['valid'][rows] = True
+        column = 0
+        for index, (_, elsys_type) in enumerate(layout):
+            count = len(elsys_type.struct.format.lstrip('>')) if elsys_type.fields else 0
+            values = [raw[f'{index}_{column + i}'].astype('f8') for i in range(count)]
+            column += count
+            for field, value in zip(elsys_type.fields, _scaled(elsys_type, values)):
+                result[field][rows] = value
+    return result
+
+
 if __name__ == '__main__':
     payload = binascii.unhexlify('0100CD')
     decoded = decode_elsys_payload(payload)
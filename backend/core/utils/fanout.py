@@ -0,0 +1,68 @@
+"""
+Concurrent submission of requests to several services.
+
+Requests to different services run in parallel on a bounded, per-process thread pool, so the total time is roughly
+that of the slowest service rather than the sum of all of them, and a failing service does not affect the others.
+Requests to the same service are limited to `settings.SERVICE_MAX_CONCURRENCY` at a time.
+"""
+import os
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from core.utils import metrics
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    with _executor_lock:
+        # Threads do not survive a fork, so a pool created before gunicorn forks its workers is replaced
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.SERVICE_FANOUT_THREADS, thread_name_prefix='service-fanout')
+            _executor_pid = os.getpid()
+    return _executor
+
+
+def fan_out(tasks):
+    """
+    Run `tasks`, a list of (key, function) tuples, and return the exception raised by each function, or None, in
+    the same order. Functions with the same key, e.g. the same service, run at most
+    `settings.SERVICE_MAX_CONCURRENCY` at a time.
+
+    The functions run in threads of their own, outside any transaction of the caller, and must not access the
+    database.
+    """
+    errors = [None] * len(tasks)
+
+    def run(queue):
+        while True:
+            try:
+                index, function = queue.popleft()
+            except IndexError:
+                return
+            try:
+                function()
+            except Exception as e:
+                errors[index] = e
+
+    queues = OrderedDict()
+    for index, (key, function) in enumerate(tasks):
+        queues.setdefault(key, deque()).append((index, function))
+
+    limit = max(settings.SERVICE_MAX_CONCURRENCY, 1)
+    runners = [queue for queue in queues.values() for _ in range(min(limit, len(queue)))]
+    if len(runners) == 1:
+        run(runners[0])
+    else:
+        # Calls made in the pool are recorded in the metrics of the calling request
+        futures = [_get_executor().submit(metrics.propagate(run), queue) for queue in runners]
+        for future in futures:
+            future.result()
+    return errors
@@ -0,0 +1,65 @@
+"""
+Shared HTTP sessions for outgoing requests to services.
+
+Every process keeps one `requests.Session` per service host, so connections are kept alive and reused between
+requests instead of paying for a new TCP and TLS handshake every time. Requests are given a default timeout and
+are retried with backoff when connecting fails. Requests that reached the service, e.g. ones answered with 502 or
+504 by a proxy, may already have been processed, so they are never resent here but left to the delivery retries.
+"""
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _create_session():
+    retry = Retry(
+        total=settings.SERVICE_HTTP_RETRIES,
+        connect=settings.SERVICE_HTTP_RETRIES,
+        # Do not resend requests that may already have been processed
+        read=0,
+        status=0,
+        backoff_factor=settings.SERVICE_HTTP_RETRY_BACKOFF,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_maxsize=settings.SERVICE_HTTP_POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session(url):
+    """
+    Return the session for the host of `url`, creating it on first use.
+    """
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = _sessions[key] = _create_session()
+    return session
+
+
+def close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def post(url, **kwargs):
+    """
+    POST to `url` using the shared session of its host. Accepts the same arguments as `requests.post`.
+    """
+    kwargs.setdefault('timeout', settings.SERVICE_HTTP_TIMEOUT)
+    return get_session(url).post(url, **kwargs)
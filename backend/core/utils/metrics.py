@@ -0,0 +1,159 @@
+"""
+Prometheus metrics of API requests.
+
+`core.middleware.MetricsMiddleware` records, per view and HTTP method, the latency of every request, the number and
+total time of its SQL queries, and the number and total time of its outgoing HTTP calls to services (made through
+`Subscription._post`), as histograms. Views using `MetricsMixin` additionally record the time spent in the phases
+of DRF's request handling. The metrics of all worker processes are exposed at `/metrics`.
+
+gunicorn runs several worker processes, so when the environment variable `prometheus_multiproc_dir` is set to an
+empty directory before the workers start, values are kept in memory-mapped files there, one per process, and summed
+over all processes when scraped. The `child_exit` hook in `gunicorn.conf.py` marks exited workers dead, so that
+gauges added with `multiprocess_mode='live*'` do not report them. Recording a value only writes to memory, so the
+metrics can be left on in production.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest,
+                               multiprocess)
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+LABELS = ('view', 'method')
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500, float('inf'))
+
+REQUEST_SECONDS = Histogram('sensehel_request_duration_seconds', 'Time to respond to requests', LABELS)
+RESPONSES = Counter('sensehel_responses_total', 'Responses by status code', LABELS + ('status',))
+QUERIES = Histogram('sensehel_request_queries', 'SQL queries per request', LABELS, buckets=COUNT_BUCKETS)
+QUERY_SECONDS = Histogram('sensehel_request_query_duration_seconds', 'Total SQL query time per request', LABELS)
+SERVICE_CALLS = Histogram(
+    'sensehel_request_service_calls', 'Outgoing HTTP calls to services per request', LABELS, buckets=COUNT_BUCKETS)
+SERVICE_CALL_SECONDS = Histogram(
+    'sensehel_request_service_call_duration_seconds', 'Total time of outgoing HTTP calls to services per request',
+    LABELS)
+PHASE_SECONDS = Histogram(
+    'sensehel_view_phase_duration_seconds', 'Time spent in the phases of handling requests in views with MetricsMixin',
+    LABELS + ('phase',))
+
+_local = threading.local()
+
+
+class RequestMetrics:
+    """
+    Totals of one request, installed as a database execute wrapper while the request is handled.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.service_calls = 0
+        self.service_call_seconds = 0.0
+        # Services are called concurrently from the threads of core.utils.fanout
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.query_seconds += time.perf_counter() - start
+
+    def record_service_call(self, seconds):
+        with self._lock:
+            self.service_calls += 1
+            self.service_call_seconds += seconds
+
+    def observe(self, view, method, status, seconds):
+        labels = (view, method)
+        REQUEST_SECONDS.labels(*labels).observe(seconds)
+        RESPONSES.labels(*labels, str(status)).inc()
+        QUERIES.labels(*labels).observe(self.queries)
+        QUERY_SECONDS.labels(*labels).observe(self.query_seconds)
+        SERVICE_CALLS.labels(*labels).observe(self.service_calls)
+        SERVICE_CALL_SECONDS.labels(*labels).observe(self.service_call_seconds)
+
+
+def observe_phases(view, method, phases):
+    """
+    Record the seconds spent in each phase of the dict `phases` of handling a request.
+    """
+    for phase, seconds in phases.items():
+        PHASE_SECONDS.labels(view, method, phase).observe(seconds)
+
+
+def view_name(request):
+    """
+    Return the label of the view handling `request`: the name of its URL pattern.
+    """
+    match = request.resolver_match
+    return match.view_name if match else 'unresolved'
+
+
+def current():
+    """
+    Return the RequestMetrics of the request being handled by this thread, or None.
+    """
+    return getattr(_local, 'metrics', None)
+
+
+@contextmanager
+def collecting(request_metrics):
+    """
+    Record service calls of the block into `request_metrics`.
+    """
+    previous = current()
+    _local.metrics = request_metrics
+    try:
+        yield request_metrics
+    finally:
+        _local.metrics = previous
+
+
+def propagate(function):
+    """
+    Return `function` wrapped to record into the metrics of the current request when it runs in another thread.
+    """
+    request_metrics = current()
+    if request_metrics is None:
+        return function
+
+    def run(*args, **kwargs):
+        with collecting(request_metrics):
+            return function(*args, **kwargs)
+    return run
+
+
+@contextmanager
+def service_call():
+    """
+    Record the block as an outgoing HTTP call of the current request, if any.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        request_metrics = current()
+        if request_metrics is not None:
+            request_metrics.record_service_call(time.perf_counter() - start)
+
+
+def registry():
+    """
+    Return the registry to expose: the metrics of all processes in multiprocess mode, otherwise of this process.
+    """
+    if 'prometheus_multiproc_dir' not in os.environ:
+        return REGISTRY
+    collector_registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collector_registry)
+    return collector_registry
+
+
+def exposition():
+    """
+    Return all metrics in the Prometheus text format.
+    """
+    return generate_latest(registry())
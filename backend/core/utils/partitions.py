@@ -0,0 +1,98 @@
+"""
+Monthly range partitioning of the ApartmentSensorValue table on PostgreSQL.
+
+When enabled with `settings.PARTITION_SENSOR_VALUES` the table is partitioned by `updated_at`, one partition per
+month plus a default partition catching values outside of them. Range scans over a period then only touch the
+partitions for that period and old months can be detached or dropped as a whole.
+
+The table is converted by migration 0033; these helpers maintain the partitions afterwards.
+"""
+from datetime import datetime
+
+from django.utils import timezone
+
+TABLE = 'core_apartmentsensorvalue'
+DEFAULT_PARTITION = f'{TABLE}_default'
+
+
+def month_start(dt):
+    return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(month, months):
+    years, month_index = divmod(month.month - 1 + months, 12)
+    return month.replace(year=month.year + years, month=month_index + 1)
+
+
+def partition_name(month):
+    return f'{TABLE}_y{month.year}m{month.month:02d}'
+
+
+def is_partitioned(connection):
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)', [TABLE])
+        return cursor.fetchone() is not None
+
+
+def create_month_partition(cursor, month):
+    """
+    Create the partition for the month starting at `month` unless it already exists. Values for the month that
+    ended up in the default partition are moved to the new partition. Returns whether a partition was created.
+    """
+    name = partition_name(month)
+    cursor.execute('SELECT to_regclass(%s)', [name])
+    if cursor.fetchone()[0]:
+        return False
+
+    bounds = [month, add_months(month, 1)]
+    cursor.execute(f'CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS)')
+    cursor.execute('SELECT to_regclass(%s)', [DEFAULT_PARTITION])
+    if cursor.fetchone()[0]:
+        cursor.execute(f'''
+            WITH moved AS (
+                DELETE FROM {DEFAULT_PARTITION} WHERE updated_at >= %s AND updated_at < %s RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved''', bounds)
+    cursor.execute(f'ALTER TABLE {TABLE} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)', bounds)
+    return True
+
+
+def create_partitions(cursor, first_month, months_ahead):
+    """
+    Create monthly partitions from `first_month` until `months_ahead` months after the current month and return
+    the names of the partitions created.
+    """
+    created = []
+    month = month_start(first_month)
+    last_month = add_months(month_start(timezone.now()), months_ahead)
+    while month <= last_month:
+        if create_month_partition(cursor, month):
+            created.append(partition_name(month))
+        month = add_months(month, 1)
+    return created
+
+
+def drop_empty_partitions(cursor, before):
+    """
+    Drop the monthly partitions ending before `before` that contain no values, e.g. after their values have been
+    archived, and return their names.
+    """
+    cursor.execute(
+        'SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(%s)',
+        [TABLE])
+    dropped = []
+    for (name,) in cursor.fetchall():
+        if name == DEFAULT_PARTITION:
+            continue
+        month = datetime(int(name[-7:-3]), int(name[-2:]), 1, tzinfo=timezone.utc)
+        if add_months(month, 1) > before:
+            continue
+        cursor.execute(f'SELECT EXISTS (SELECT 1 FROM {name})')
+        if cursor.fetchone()[0]:
+            continue
+        cursor.execute(f'ALTER TABLE {TABLE} DETACH PARTITION {name}')
+        cursor.execute(f'DROP TABLE {name}')
+        dropped.append(name)
+    return dropped
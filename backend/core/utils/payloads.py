@@ -0,0 +1,113 @@
+"""
+Encodings of the sensor data POSTed to the `data_url` of services.
+
+Every service chooses one with `Service.data_encoding`:
+
+- `json`: a JSON object per request, with a list of value objects per subscription (the default)
+- `json-gzip`: the same, gzip-compressed with `Content-Encoding: gzip`
+- `columnar`: JSON with the values of a subscription as parallel arrays instead of a list of objects, which does not
+  repeat the keys of every value, as `application/vnd.sensehel.columnar+json`
+- `columnar-gzip`: the same, gzip-compressed
+- `msgpack`: the columnar layout as MessagePack, as `application/vnd.sensehel.columnar+msgpack`. Requires the
+  optional `msgpack` package.
+
+Every field of the values becomes a column, so rollups submitted as history keep their aggregates. For example the
+values of one subscription in the columnar layout are
+
+    {"uuid": "...", "auth_token": "...",
+     "values": {"attribute": [12, 12], "value": ["21.5", "21.6"], "timestamp": ["2020-...", "2020-..."]}}
+"""
+import gzip
+import json
+
+from django.core.exceptions import ImproperlyConfigured
+
+JSON = 'json'
+JSON_GZIP = 'json-gzip'
+COLUMNAR = 'columnar'
+COLUMNAR_GZIP = 'columnar-gzip'
+MSGPACK = 'msgpack'
+
+ENCODINGS = (
+    (JSON, 'JSON'),
+    (JSON_GZIP, 'Gzip-compressed JSON'),
+    (COLUMNAR, 'Columnar JSON'),
+    (COLUMNAR_GZIP, 'Gzip-compressed columnar JSON'),
+    (MSGPACK, 'Columnar MessagePack'),
+)
+
+COLUMNAR_JSON_TYPE = 'application/vnd.sensehel.columnar+json'
+COLUMNAR_MSGPACK_TYPE = 'application/vnd.sensehel.columnar+msgpack'
+
+
+def columns(values):
+    """
+    Return the list of value dicts `values` as a dict of field: list of the values of the field, with the fields of
+    all values in the order first seen, e.g. also those of rollups submitted as history. Values without a field
+    have None in its column.
+    """
+    fields = {}
+    for value in values:
+        fields.update(dict.fromkeys(value))
+    return {field: [value.get(field) for value in values] for field in fields}
+
+
+def columnar(data):
+    """
+    Return the payload `data`, for one subscription or a batch of subscriptions, with every list of values as
+    columns.
+    """
+    if 'subscriptions' in data:
+        return dict(data, subscriptions=[columnar(subscription) for subscription in data['subscriptions']])
+    return dict(data, values=columns(data['values']))
+
+
+def _msgpack():
+    try:
+        import msgpack
+    except ImportError:
+        raise ImproperlyConfigured('The msgpack data encoding requires the msgpack package')
+    return msgpack
+
+
+def check_encoding(encoding):
+    """
+    Raise ImproperlyConfigured if `encoding` can not be used in this environment.
+    """
+    if encoding == MSGPACK:
+        _msgpack()
+
+
+def encode(data, encoding):
+    """
+    Return the keyword arguments for `requests.post` sending the payload `data` in `encoding`.
+    """
+    if encoding in (JSON, ''):
+        return {'json': data}
+
+    if encoding == MSGPACK:
+        body = _msgpack().packb(columnar(data), use_bin_type=True)
+        return {'data': body, 'headers': {'Content-Type': COLUMNAR_MSGPACK_TYPE}}
+
+    content_type = 'application/json'
+    if encoding in (COLUMNAR, COLUMNAR_GZIP):
+        data = columnar(data)
+        content_type = COLUMNAR_JSON_TYPE
+    body = json.dumps(data, separators=(',', ':')).encode()
+    headers = {'Content-Type': content_type}
+    if encoding in (JSON_GZIP, COLUMNAR_GZIP):
+        body = gzip.compress(body, compresslevel=6)
+        headers['Content-Encoding'] = 'gzip'
+    return {'data': body, 'headers': headers}
+
+
+def decode(body, headers):
+    """
+    Return the payload of an encoded request body with the given headers, in the columnar layout if it was sent
+    so. The inverse of `encode`, for services and tests.
+    """
+    if headers.get('Content-Encoding') == 'gzip':
+        body = gzip.decompress(body)
+    if headers.get('Content-Type') == COLUMNAR_MSGPACK_TYPE:
+        return _msgpack().unpackb(body, raw=False)
+    return json.loads(body)
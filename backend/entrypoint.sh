@@ -3,4 +3,10 @@ RUN pip install -r requirements.txt
 python manage.py migrate
 python manage.py collectstatic --no-input --clear
 
+# Start with no metrics from earlier worker processes, see core/utils/metrics.py
+if [ -n "$prometheus_multiproc_dir" ]; then
+    rm -rf "$prometheus_multiproc_dir"
+    mkdir -p "$prometheus_multiproc_dir"
+fi
+
 exec "$@"
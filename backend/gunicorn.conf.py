@@ -0,0 +1,11 @@
+"""
+gunicorn settings shared by the backend and live services, see docker-compose.example.yml.
+"""
+import os
+
+
+def child_exit(server, worker):
+    # Drop the values of live gauges of an exited worker from the metrics, see core/utils/metrics.py
+    if os.environ.get('prometheus_multiproc_dir'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -48,6 +48,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -91,7 +92,18 @@ DATABASES = {
         'NAME': os.getenv('POSTGRES_DB') or 'forum',
     }
 }
-if 'test' in sys.argv:
+# Opt-in monthly partitioning of the sensor value table on PostgreSQL. Applied by migration
+# core.0033_partition_apartmentsensorvalue, so to change it later migrate back to core.0032 and forward again.
+# Partitions for the coming months are created with the `create_value_partitions` management command.
+PARTITION_SENSOR_VALUES = os.getenv('PARTITION_SENSOR_VALUES') == '1'
+
+# Days of raw sensor values to keep. Older values are exported to SENSOR_VALUE_ARCHIVE_DIR and deleted by the
+# `archive_values` management command; unset keeps values forever. Rollups are always kept.
+SENSOR_VALUE_RETENTION_DAYS = int(os.getenv('SENSOR_VALUE_RETENTION_DAYS', 0)) or None
+SENSOR_VALUE_ARCHIVE_DIR = os.getenv('SENSOR_VALUE_ARCHIVE_DIR') or os.path.join(BASE_DIR, 'archive')
+
+# Benchmarks with USE_SQLITE=1, and tests unless USE_SQLITE=0, run on SQLite
+if os.getenv('USE_SQLITE') == '1' or ('test' in sys.argv and os.getenv('USE_SQLITE') != '0'):
     DATABASES = {
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
@@ -136,6 +148,21 @@ REST_FRAMEWORK = {
 SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTOCOL', 'https')
 #SECURE_SSL_REDIRECT = not DEBUG
 
+# Payload decoders by (Sensor name, FPort) as dotted paths; None matches any sensor or port and the most specific
+# match is used. Decoders take the payload bytes and return a dict of payload key: value, see core.decoders.
+PAYLOAD_DECODERS = {
+    (None, None): 'core.utils.elsys.decode_elsys_payload',
+}
+
+# Lifetime in seconds of the cached available services of users, see Service.available_ids_for_user. Entries are
+# keyed on DataVersions, so changes take effect right away in all processes.
+AVAILABLE_SERVICES_CACHE_TIMEOUT = 60 * 60
+
+# Maximum number of entries and lifetime in seconds of the per-process caches of sensor and attribute ids used
+# when ingesting uplinks, see core.ingest
+INGEST_CACHE_SIZE = 10000
+INGEST_CACHE_TTL = 5 * 60
+
 # Digita GW API mapping settings
 # Dict key should match the key from decoding payload
 # Dict value should match the URI for attribute
@@ -146,6 +173,64 @@ DIGITA_GW_PAYLOAD_TO_ATTRIBUTES = {
     'co2': 'http://finto.fi/afo/en/page/p4770',
 }
 
+# Maximum number of uplinks accepted in one request to the Digita GW batch endpoint, which stores them all in one
+# transaction
+DIGITA_GW_MAX_BATCH = 1000
+
+# Outgoing requests to services: (connect, read) timeouts in seconds, retries for failed connections with
+# exponential backoff, and kept-alive connections per service host and process
+SERVICE_HTTP_TIMEOUT = (3.05, 10)
+SERVICE_HTTP_RETRIES = 2
+SERVICE_HTTP_RETRY_BACKOFF = 0.5
+SERVICE_HTTP_POOL_SIZE = 10
+
+# Number of values per request when submitting history to services
+HISTORY_PAGE_SIZE = 1000
+# Seconds a worker may take to send the next page of history before another worker takes over the submission
+HISTORY_LEASE = 5 * 60
+
+# Maximum number of buckets returned by the sensor history API; longer periods are divided into larger buckets
+HISTORY_MAX_POINTS = 1000
+
+# Requests to different services are made concurrently on a thread pool of this size per process, with at most
+# SERVICE_MAX_CONCURRENCY simultaneous requests to any one service
+SERVICE_FANOUT_THREADS = 8
+SERVICE_MAX_CONCURRENCY = 2
+
+# Queue sensor values for subscribed services in the Delivery outbox, to be submitted by the
+# `process_deliveries` worker. When disabled values are POSTed inline while handling the gateway request.
+SUBSCRIPTION_OUTBOX = True
+
+# Retry delay for failed deliveries in seconds, doubled after every failed attempt up to the maximum
+DELIVERY_RETRY_BACKOFF = 30
+DELIVERY_RETRY_MAX_BACKOFF = 60 * 60
+
+# Deliveries failing this many times are moved to the dead letters, to be resent with `replay_dead_letters`
+DELIVERY_MAX_ATTEMPTS = 20
+# Seconds a worker may take to submit the deliveries it has claimed before another worker attempts them again
+DELIVERY_LEASE = 5 * 60
+
+# After this many consecutive failed requests to a service no data is submitted to it for the retry backoff, and
+# admins are alerted of the outage at most once per SERVICE_ALERT_INTERVAL seconds
+SERVICE_CIRCUIT_THRESHOLD = 3
+SERVICE_ALERT_INTERVAL = 6 * 60 * 60
+
+# Whether this process serves live value streams. Streams stay open as long as the browser is connected, so only
+# the gevent workers started for them set LIVE_STREAMS=1; elsewhere /api/live/ answers 503 and clients poll instead
+LIVE_STREAMS = os.getenv('LIVE_STREAMS') == '1'
+
+# Seconds between keepalive comments on idle live value streams, and the number of messages a stream may fall
+# behind before the client is told to reload
+LIVE_KEEPALIVE = 30
+LIVE_QUEUE_SIZE = 100
+# Seconds a stream token is valid for opening a live value stream, see core.live.stream_token
+LIVE_TOKEN_MAX_AGE = 60
+# Seconds after which clients are told to try again when live value streams are not served by this process
+LIVE_RETRY_AFTER = 15 * 60
+
+# When set, scraping /metrics requires the header `Authorization: Bearer <METRICS_TOKEN>`, see core.utils.metrics
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
 # Uncomment to enable direct error emails; disabled now in favor of Sentry:
 # ADMINS = [['FVH Django admins', 'django-admins@forumvirium.fi']]
 
@@ -17,10 +17,12 @@ from django.conf.urls import url
 from django.contrib import admin
 from django.urls import include
 
+from core.api.views import prometheus_metrics
 from login.login import LoginTokenAPIView
 
 urlpatterns = [
     url(r'^admin/', admin.site.urls, name='admin'),
     url(r'^api/login', LoginTokenAPIView.as_view(), name='login'),
     url(r'^api/', include('core.api.urls')),
+    url(r'^metrics$', prometheus_metrics, name='metrics'),
 ]
@@ -30,16 +30,34 @@ class HomePage extends Component {
     await this.fetchSubscribedServices();
     await this.fetchSensorValues();
 
-    this.sensorValuesInterval = setInterval(
-      this.fetchSensorValues,
-      15 * 60 * 1000
+    this.liveValues = API.openLiveValues(
+      this.updateSensorValues,
+      this.refreshSensorValues,
+      this.onLiveConnected
     );
   }
 
   componentWillUnmount() {
+    this.liveValues.close();
     clearInterval(this.sensorValuesInterval);
   }
 
+  // Poll while the live value stream is down, e.g. when it is not routed to the live workers
+  onLiveConnected = connected => {
+    if (connected) {
+      if (this.sensorValuesInterval) {
+        clearInterval(this.sensorValuesInterval);
+        this.sensorValuesInterval = null;
+        this.refreshSensorValues();
+      }
+    } else if (!this.sensorValuesInterval) {
+      this.sensorValuesInterval = setInterval(
+        this.refreshSensorValues,
+        15 * 60 * 1000
+      );
+    }
+  };
+
   updateName = () => {
     const currentUser = JSON.parse(
       localStorage.getItem(LocalStorageKeys.CURRENT_USER)
@@ -94,6 +112,28 @@ class HomePage extends Component {
     }
   };
 
+  refreshSensorValues = async () => {
+    try {
+      const sensorValues = await API.refreshSensorValues();
+
+      this.setState({ sensorValues });
+    } catch (e) {
+      // Polled in the background, so keep showing the latest values
+    }
+  };
+
+  updateSensorValues = values => {
+    const updated = {};
+    values.forEach(v => { updated[v.id] = v; });
+    this.setState(({ sensorValues }) => ({
+      sensorValues: sensorValues.map(s =>
+        updated[s.attributeId]
+          ? { ...s, value: updated[s.attributeId].value, updatedAt: updated[s.attributeId].updated_at }
+          : s
+      )
+    }));
+  };
+
   handleChangeTab = () => {
     const { changeTab } = this.props;
     setTimeout(() => changeTab(1), 800);
@@ -5,6 +5,10 @@ import LocalStorageKeys from '../config/LocalStorageKeys';
 // const URL = 'http://127.0.0.1:8000/api/';
 const URL = '/api/';
 
+// Milliseconds to wait before reopening a failed live value stream, doubling after every further failure
+const LIVE_RETRY_INTERVAL = 30 * 1000;
+const LIVE_MAX_RETRY_INTERVAL = 15 * 60 * 1000;
+
 class Api {
   cache = {};
 
@@ -101,6 +105,7 @@ class Api {
       apartment.apartment_sensors.map(apsen =>
         _.filter(apsen.attributes, 'ui_type').map(
           ({
+            id: attributeId,
             description,
             uri,
             ui_type: uiType,
@@ -108,6 +113,7 @@ class Api {
             updated_at: updatedAt
           }) => ({
               id: `${apsen.id}-${description.substr(0, 5)}`,
+              attributeId,
               name: apsen.sensor.description,
               identifier: apsen.identifier,
               uri,
@@ -120,6 +126,61 @@ class Api {
       )
     );
   }
+
+  async refreshSensorValues() {
+    this.cache.apartment = null;
+    return this.getSensorValues();
+  }
+
+  async getLiveToken() {
+    const { token } = await this.api.post('live/token/');
+    return token;
+  }
+
+  // Streams new sensor values to onValues. The stream is opened with a short-lived stream token rather than the API
+  // token, which would end up in access logs, so it is reopened with a new token whenever it fails. onConnected is
+  // called with false while the stream is down, so that the caller can poll instead, and with true once it is open.
+  // Failed attempts are retried with a backoff that doubles up to LIVE_MAX_RETRY_INTERVAL, e.g. while the server
+  // answers 503 because it does not serve streams.
+  openLiveValues(onValues, onReload, onConnected) {
+    const live = { closed: false, source: null, retry: null, interval: LIVE_RETRY_INTERVAL };
+    const retry = () => {
+      onConnected(false);
+      if (live.closed) return;
+      live.retry = setTimeout(open, live.interval); // eslint-disable-line no-use-before-define
+      live.interval = Math.min(live.interval * 2, LIVE_MAX_RETRY_INTERVAL);
+    };
+    const open = async () => {
+      let token;
+      try {
+        token = await this.getLiveToken();
+      } catch (e) {
+        retry();
+        return;
+      }
+      if (live.closed) return;
+      const source = new EventSource(`${URL}live/?token=${encodeURIComponent(token)}`);
+      source.addEventListener('open', () => {
+        live.interval = LIVE_RETRY_INTERVAL;
+        onConnected(true);
+      });
+      source.addEventListener('values', event => onValues(JSON.parse(event.data).values));
+      source.addEventListener('reload', onReload);
+      source.addEventListener('error', () => {
+        source.close();
+        retry();
+      });
+      live.source = source;
+    };
+    open();
+    return {
+      close: () => {
+        live.closed = true;
+        clearTimeout(live.retry);
+        if (live.source) live.source.close();
+      }
+    };
+  }
 }
 
 const API = new Api(URL);